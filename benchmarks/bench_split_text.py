@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of Formatter.split_text over synthetic code-heavy responses.
+
+    python benchmarks/bench_split_text.py [--repeat N]
+
+The recursive splitter which split_text replaced is kept here as a baseline.
+"""
+import argparse
+import operator
+import os
+import random
+import re
+import sys
+import timeit
+from functools import reduce
+from itertools import compress
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bing_chat_bot.formatter import Formatter, TEXT_SPLIT_THRESHOLD  # noqa: E402
+
+SIZES = [10_000, 50_000, 100_000, 200_000]
+
+
+def legacy_split_text(text, limit_length):
+    try:
+        return _legacy_split_text_by_delimiter(text.strip(), limit_length, "\n\n")
+    except RuntimeError:
+        return _legacy_split_text_by_delimiter(text.strip(), limit_length, "\n")
+
+
+def _legacy_split_text_by_delimiter(text, limit_length, delimiter):
+    if len(text) <= limit_length:
+        return [text]
+    code_block_inds = [m.start(0) for m in re.finditer('```', text)]
+    code_block_ranges = [i for i in zip(code_block_inds[::2], code_block_inds[1::2])]
+    line_break_ind = [m.start() for m in re.finditer(delimiter, text)]
+    line_break_validity = [reduce(operator.and_, [True] + [i < start or i >= end for (start, end) in code_block_ranges] + [i < limit_length])
+                           for i in line_break_ind]
+    valid_line_break = [i for i in compress(line_break_ind, line_break_validity)]
+    if len(valid_line_break) == 0:
+        raise RuntimeError("Cannot find a valid line break")
+    break_point_ind = max(valid_line_break)
+    return [text[:break_point_ind].strip()] + legacy_split_text(text[break_point_ind:].strip(), limit_length)
+
+
+def generate_response(size: int, seed: int = 0) -> str:
+    """
+    Paragraphs mixed with code blocks, each code block short enough to fit in one message
+    """
+    rand = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        if rand.random() < 0.4:
+            lines = [f"    value_{i} = compute({i})  # {'x' * rand.randint(0, 40)}" for i in range(rand.randint(3, 25))]
+            part = "```python\n" + "\n".join(lines) + "\n```"
+        else:
+            part = " ".join(rand.choice(["Bing", "answer", "the", "of", "[^1^]", "response"]) for _ in range(rand.randint(10, 80)))
+        parts.append(part)
+        length += len(part) + 2
+    return "\n\n".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'chunks':>7} {'split_text (ms)':>16} {'legacy (ms)':>12} {'speedup':>8}")
+    for size in SIZES:
+        text = generate_response(size)
+        chunks = Formatter.split_text(text, TEXT_SPLIT_THRESHOLD)
+        current = min(timeit.repeat(lambda: Formatter.split_text(text, TEXT_SPLIT_THRESHOLD), number=1, repeat=args.repeat))
+        try:
+            legacy = min(timeit.repeat(lambda: legacy_split_text(text, TEXT_SPLIT_THRESHOLD), number=1, repeat=args.repeat))
+            legacy_column, speedup_column = f"{legacy * 1000:12.2f}", f"{legacy / current:7.1f}x"
+        except RuntimeError:
+            legacy_column, speedup_column = f"{'failed':>12}", f"{'-':>8}"
+        print(f"{size:>8} {len(chunks):>7} {current * 1000:16.2f} {legacy_column} {speedup_column}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Offline load test of the Discord bot.
+
+A local stand-in replaces EdgeGPT's Chatbot, and a fake Discord layer drives BotManager's on_message event and
+suggested-response buttons from N simulated channels. Nothing talks to Bing or Discord.
+
+    python benchmarks/load_test.py --channels 50 --requests 10 --profiles 3 --latency 2.0
+
+Each simulated channel sends a message, waits for the bot to answer, and clicks a suggested response now and then.
+The report shows end-to-end latency percentiles, time spent in Formatter.render and
+BotManager._respond_messages, and throughput.
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from discord import MessageType  # noqa: E402
+
+import bing_chat_bot.scheduler  # noqa: E402
+from bing_chat_bot.edge import import_edge_gpt  # noqa: E402
+from bing_chat_bot.formatter import Formatter  # noqa: E402
+from bing_chat_bot.initializer import BotManager  # noqa: E402
+from bing_chat_bot.tracing import TRACER, LoopLagMonitor  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+class FakeBingConfig:
+    def __init__(self, latency: float, error_rate: float, response_length: int, max_messages: int, seed: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.response_length = response_length
+        self.max_messages = max_messages
+        self.random = random.Random(seed)
+
+
+class FakeChatbot:
+    """
+    Stand-in for EdgeGPT.Chatbot. Answers with payloads shaped like Bing's item/result/throttling/messages/adaptiveCards.
+    """
+    config: FakeBingConfig = None
+
+    def __init__(self, proxy=None, cookies=None):
+        self.cookies = cookies
+        self._num_messages = 0
+
+    @staticmethod
+    async def create(proxy=None, cookies=None) -> 'FakeChatbot':
+        await asyncio.sleep(FakeChatbot.config.latency * 0.1)
+        return FakeChatbot(proxy, cookies)
+
+    async def close(self):
+        pass
+
+    async def reset(self):
+        self._num_messages = 0
+
+    async def ask(self, prompt: str, conversation_style=None, webpage_context=None, **kwargs) -> dict:
+        await asyncio.sleep(self._sample_latency())
+        return self._build_response(prompt)
+
+    async def ask_stream(self, prompt: str, conversation_style=None, webpage_context=None, **kwargs):
+        response = self._build_response(prompt)
+        messages = response['item']['messages']
+        text = messages[-1]['text'] if len(messages) > 0 else ""
+        steps = 10
+        for step in range(1, steps + 1):
+            await asyncio.sleep(self._sample_latency() / steps)
+            yield False, text[:len(text) * step // steps]
+        yield True, response
+
+    def _sample_latency(self) -> float:
+        return FakeChatbot.config.random.lognormvariate(0, 0.5) * FakeChatbot.config.latency
+
+    def _build_response(self, prompt: str) -> dict:
+        config = FakeChatbot.config
+        self._num_messages += 1
+        if config.random.random() < config.error_rate or self._num_messages > config.max_messages:
+            return {'item': {'result': {'value': 'Throttled', 'message': 'Request is throttled.'}, 'messages': []}}
+
+        text = self._generate_text(config)
+        citations = "\n\n".join(f'[{i}]: https://example{i}.com/page "Example page {i}"' for i in range(1, 4))
+        links = "Learn more: " + " ".join(f"[{i}. example{i}.com](https://example{i}.com/page)" for i in range(1, 4))
+        return {
+            'item': {
+                'result': {'value': 'Success', 'message': None},
+                'throttling': {
+                    'numUserMessagesInConversation': self._num_messages,
+                    'maxNumUserMessagesInConversation': config.max_messages
+                },
+                'messages': [
+                    {'author': 'user', 'text': prompt},
+                    {
+                        'author': 'bot',
+                        'text': text,
+                        'suggestedResponses': [{'text': f"Tell me more about topic {i}"} for i in range(3)],
+                        'adaptiveCards': [{'body': [{'text': f"{citations}\n\n{text}"}, {'text': links}]}]
+                    }
+                ]
+            }
+        }
+
+    @staticmethod
+    def _generate_text(config: FakeBingConfig) -> str:
+        length = int(config.random.uniform(0.2, 1.8) * config.response_length)
+        parts = []
+        while sum(len(part) for part in parts) < length:
+            if config.random.random() < 0.2:
+                lines = [f"    result_{i} = compute({i})" for i in range(config.random.randint(3, 20))]
+                parts.append("```python\n" + "\n".join(lines) + "\n```")
+            else:
+                words = config.random.choices(["Bing", "answer", "the", "search", "result[^1^]", "shows[^2^]"], k=config.random.randint(20, 80))
+                parts.append(" ".join(words))
+        return "\n\n".join(parts)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, bot: bool = False):
+        self.id = user_id
+        self.bot = bot
+        self.name = f"user-{user_id}"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: FakeGuild, api_latency: float):
+        self.id = channel_id
+        self.guild = guild
+        self.api_latency = api_latency
+        self.sent_messages: List[FakeMessage] = []
+
+    async def send(self, content=None, embed=None, view=None, file=None, reference=None, **kwargs) -> 'FakeMessage':
+        await asyncio.sleep(self.api_latency)
+        message = FakeMessage(self, BOT_USER, content or "", embed=embed, view=view, file=file, reference=reference)
+        self.sent_messages.append(message)
+        return message
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, author: FakeUser, content: str, embed=None, view=None, file=None, reference=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.file = file
+        self.reference = reference
+        self.type = MessageType.default
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def reply(self, content=None, mention_author=True, **kwargs) -> 'FakeMessage':
+        return await self.channel.send(content, reference=self, **kwargs)
+
+    async def edit(self, content=None, embed=None, view=None, **kwargs) -> 'FakeMessage':
+        await asyncio.sleep(self.channel.api_latency)
+        self.content, self.embed, self.view = content, embed, view
+        return self
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.api_latency)
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+
+    async def send_message(self, content=None, **kwargs):
+        self._interaction.message = await self._interaction.channel.send(content, **kwargs)
+
+
+class FakeInteraction:
+    def __init__(self, channel: FakeChannel, user: FakeUser):
+        self.channel = channel
+        self.channel_id = channel.id
+        self.user = user
+        self.message: Optional[FakeMessage] = None
+        self.response = FakeInteractionResponse(self)
+        self.followup = channel
+
+    async def original_response(self) -> FakeMessage:
+        return self.message
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeApplicationContext:
+    def __init__(self, message: FakeMessage):
+        self.message = message
+        self.channel_id = message.channel.id
+
+    def typing(self):
+        return FakeTyping()
+
+
+class FakeCommandGroup:
+    def __init__(self, bot: 'FakeBot', name: str):
+        self._bot = bot
+        self._name = name
+
+    def command(self, name=None, **kwargs):
+        def decorator(func):
+            self._bot.commands[f"{self._name} {name or func.__name__}"] = func
+            return func
+
+        return decorator
+
+
+class FakeBot:
+    """
+    The parts of discord.Bot which BotManager uses
+    """
+
+    def __init__(self):
+        self.user = BOT_USER
+        self.events: Dict[str, Callable] = {}
+        self.commands: Dict[str, Callable] = {}
+
+    def event(self, func):
+        self.events[func.__name__] = func
+        return func
+
+    def command(self, name=None, **kwargs):
+        return FakeCommandGroup(self, "").command(name, **kwargs)
+
+    def create_group(self, name: str, description: str = None, **kwargs) -> FakeCommandGroup:
+        return FakeCommandGroup(self, name)
+
+    async def get_application_context(self, message: FakeMessage) -> FakeApplicationContext:
+        return FakeApplicationContext(message)
+
+    async def change_presence(self, **kwargs):
+        pass
+
+
+BOT_USER = FakeUser(0, bot=True)
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, seconds: float):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap_sync(self, stage: str, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    def wrap_async(self, stage: str, func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        return wrapper
+
+
+def percentile(samples: List[float], p: float) -> float:
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def create_cookie_files(num_profiles: int) -> List[str]:
+    directory = tempfile.mkdtemp(prefix="bing-chat-bot-load-test-")
+    paths = []
+    for index in range(num_profiles):
+        path = os.path.join(directory, f"cookies-{index}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump([{'name': '_U', 'value': f"fake-{index}"}], f)
+        paths.append(path)
+    return paths
+
+
+async def simulate_channel(bot: FakeBot, channel: FakeChannel, user: FakeUser, args, stage_timer: StageTimer,
+                           pending: Dict[int, asyncio.Future], rand: random.Random):
+    for request_index in range(args.requests):
+        await asyncio.sleep(rand.uniform(0, args.think_time))
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+
+        last_reply = channel.sent_messages[-1] if len(channel.sent_messages) > 0 else None
+        if args.click_rate > 0 and last_reply is not None and last_reply.view is not None and rand.random() < args.click_rate:
+            # Click a suggested response of the last answer
+            button = last_reply.view.children[0]
+            interaction = FakeInteraction(channel, user)
+            pending[channel.id] = future
+            await button.callback(interaction)
+        else:
+            message = FakeMessage(channel, user, f"Question {request_index} from channel {channel.id}")
+            pending[channel.id] = future
+            await bot.events['on_message'](message)
+
+        try:
+            await asyncio.wait_for(future, timeout=args.timeout)
+            stage_timer.record('end_to_end', time.perf_counter() - start)
+        except asyncio.TimeoutError:
+            stage_timer.record('timeout', time.perf_counter() - start)
+
+
+async def run(args):
+    FakeChatbot.config = FakeBingConfig(args.latency, args.error_rate, args.response_length, args.max_messages, args.seed)
+    import_edge_gpt().Chatbot = FakeChatbot
+
+    stage_timer = StageTimer()
+    Formatter.render = stage_timer.wrap_sync('render', Formatter.render)
+    BotManager._respond_messages = stage_timer.wrap_async('respond_messages', BotManager._respond_messages)
+
+    if not args.rate_limits:
+        # Measure the bot itself rather than the guild and user token buckets
+        bing_chat_bot.scheduler.GUILD_REQUESTS_PER_MINUTE = bing_chat_bot.scheduler.USER_REQUESTS_PER_MINUTE = 1e9
+        bing_chat_bot.scheduler.GUILD_BURST = bing_chat_bot.scheduler.USER_BURST = 1e9
+
+    # A request is complete when the bot has answered it
+    pending: Dict[int, asyncio.Future] = {}
+
+    def complete(channel_id: int):
+        future = pending.pop(channel_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    original_converse_and_respond = BotManager._converse_and_respond
+
+    async def converse_and_respond(self, bot, session, request):
+        try:
+            await original_converse_and_respond(self, bot, session, request)
+        finally:
+            complete(request.channel_key)
+
+    BotManager._converse_and_respond = converse_and_respond
+
+    if args.trace:
+        TRACER.configure(args.trace)
+    loop_lag_monitor = LoopLagMonitor()
+    loop_lag_monitor.start()
+
+    bot_manager = BotManager(create_cookie_files(args.profiles))
+    bot_manager._formatter_options.stream_response = args.streaming
+    fake_bot = FakeBot()
+    bot_manager.initialize(fake_bot)
+    await fake_bot.events['on_ready']()
+
+    rand = random.Random(args.seed)
+    guilds = [FakeGuild(next(_ids)) for _ in range(args.guilds)]
+    channels = [FakeChannel(next(_ids), guilds[i % len(guilds)], args.discord_latency) for i in range(args.channels)]
+    if args.prefetch:
+        bot_manager.prefetcher.enable_channels(channel.id for channel in channels)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[simulate_channel(fake_bot, channel, FakeUser(next(_ids)), args, stage_timer, pending, rand)
+                           for channel in channels])
+    elapsed = time.perf_counter() - start
+    prefetch_stats = bot_manager.prefetcher.get_stats()
+    await loop_lag_monitor.stop()
+    await bot_manager.close()
+
+    end_to_end = stage_timer.samples.get('end_to_end', [])
+    print(f"channels={args.channels} requests/channel={args.requests} profiles={args.profiles} "
+          f"bing latency={args.latency}s streaming={args.streaming}")
+    print(f"completed={len(end_to_end)} timeouts={len(stage_timer.samples.get('timeout', []))} "
+          f"elapsed={elapsed:.2f}s throughput={len(end_to_end) / elapsed:.2f} req/s")
+    print(f"max loop lag={loop_lag_monitor.get_stats().max_lag * 1000:.1f}ms")
+    if args.prefetch:
+        print(f"prefetched={prefetch_stats.spent} hits={prefetch_stats.hits} hit rate={prefetch_stats.hit_rate:.2f}")
+    print(f"{'stage':<18} {'count':>7} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} {'total (s)':>10}")
+    for stage in ['end_to_end', 'render', 'respond_messages']:
+        samples = stage_timer.samples.get(stage, [])
+        print(f"{stage:<18} {len(samples):>7} {percentile(samples, 50) * 1000:>10.2f} {percentile(samples, 95) * 1000:>10.2f} "
+              f"{percentile(samples, 99) * 1000:>10.2f} {sum(samples):>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=20, help="Number of simulated channels")
+    parser.add_argument('--guilds', type=int, default=4, help="Number of guilds the channels are spread over")
+    parser.add_argument('--requests', type=int, default=5, help="Messages sent by each channel")
+    parser.add_argument('--profiles', type=int, default=2, help="Number of fake cookie profiles")
+    parser.add_argument('--latency', type=float, default=1.0, help="Median Bing answer latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.02, help="Probability of a non-Success result")
+    parser.add_argument('--max-messages', type=int, default=20, help="maxNumUserMessagesInConversation")
+    parser.add_argument('--response-length', type=int, default=2500, help="Average response length in characters")
+    parser.add_argument('--discord-latency', type=float, default=0.05, help="Latency of each Discord API call in seconds")
+    parser.add_argument('--think-time', type=float, default=0.5, help="Maximum pause before each message in seconds")
+    parser.add_argument('--click-rate', type=float, default=0.3, help="Probability of clicking a suggested response")
+    parser.add_argument('--streaming', action='store_true', help="Stream responses by editing messages")
+    parser.add_argument('--prefetch', action='store_true', help="Prefetch suggested responses in every channel")
+    parser.add_argument('--rate-limits', action='store_true', help="Keep the guild and user token buckets of the scheduler")
+    parser.add_argument('--timeout', type=float, default=120, help="Seconds before a request counts as timed out")
+    parser.add_argument('--trace', help="Write trace spans to this file, see trace_report.py")
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
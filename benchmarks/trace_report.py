@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Summarize the trace spans written by the bot when BING_CHAT_TRACE_PATH is set.
+
+    python benchmarks/trace_report.py /var/log/bing-chat-bot/trace.jsonl* [--slowest 5]
+
+Prints the duration percentiles and total time of each span name, then the slowest requests with their spans in order.
+Rotated files can be passed together, in any order.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List
+
+
+def percentile(samples: List[float], p: float) -> float:
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def load_spans(paths: List[str]) -> Dict[str, List[dict]]:
+    traces: Dict[str, List[dict]] = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    # The last line may be cut when the bot stops
+                    continue
+                traces.setdefault(span['trace'], []).append(span)
+    return traces
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="Trace files")
+    parser.add_argument('--slowest', type=int, default=5, help="Number of slowest requests to break down")
+    args = parser.parse_args()
+
+    traces = load_spans(args.paths)
+    if len(traces) == 0:
+        print("No spans found")
+        sys.exit(1)
+
+    durations: Dict[str, List[float]] = {}
+    for spans in traces.values():
+        for span in spans:
+            durations.setdefault(span['span'], []).append(span['duration_ms'])
+
+    print(f"traces={len(traces)} spans={sum(len(spans) for spans in traces.values())}")
+    print(f"{'span':<16} {'count':>7} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10} {'total (s)':>10}")
+    for name, samples in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:<16} {len(samples):>7} {percentile(samples, 50):>10.2f} {percentile(samples, 95):>10.2f} "
+              f"{percentile(samples, 99):>10.2f} {max(samples):>10.2f} {sum(samples) / 1000:>10.3f}")
+
+    handled = [spans for spans in traces.values() if any(span['span'] == 'handle' for span in spans)]
+    handled.sort(key=lambda spans: -max(span['duration_ms'] for span in spans if span['span'] == 'handle'))
+    for spans in handled[:args.slowest]:
+        spans.sort(key=lambda span: span['start'])
+        start = spans[0]['start']
+        print(f"\ntrace {spans[0]['trace']} channel={spans[0].get('channel')}")
+        for span in spans:
+            attrs = {k: v for k, v in span.items() if k not in ('trace', 'span', 'start', 'duration_ms', 'channel')}
+            print(f"  +{(span['start'] - start) * 1000:>9.1f}ms {span['span']:<16} {span['duration_ms']:>10.2f}ms {attrs if attrs else ''}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,35 @@
-import json
+import asyncio
 import logging
-from typing import List, Optional
+import time
+from collections import deque
+from typing import TYPE_CHECKING, AsyncIterator, Deque, List, Optional, Set, Tuple, Union
 
-import EdgeGPT
-from EdgeGPT import Chatbot, ConversationStyle
+from .cache import ResponseCache
+from .edge import CONVERSATION_STYLES, get_conversation_ids, import_edge_gpt, is_not_allowed_to_access, restore_chatbot
+from .metrics import BING_LATENCY, BING_REQUEST_SECONDS, ERRORS, HEDGES, RESETS
+from .profile import Profile, ProfileLease, ProfilePool
+from .tracing import TRACER
+from .warmer import ConversationWarmer
+
+if TYPE_CHECKING:
+    from EdgeGPT import Chatbot
+
+# Conversation style of a new conversation
+DEFAULT_STYLE = "balanced"
+
+# Bing requests which take longer than this are abandoned and the conversation is reset
+REQUEST_TIMEOUT_SECONDS = 120
+
+# Number of recent latencies needed before the hedging threshold is trusted
+HEDGE_MIN_SAMPLES = 20
+
+# Number of recent exchanges kept to seed another conversation with the context of this one
+RECENT_TURNS = 4
+# Maximum length of that context. The oldest part is cut.
+DIGEST_MAX_CHARS = 4000
+
+# When a conversation has this many messages left, the next one is prepared. At the limit, it continues with the recent exchanges as context.
+CARRY_OVER_TURNS_LEFT = 2
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +51,50 @@ class BingBotResponse:
         self.citations: Optional[str] = citations
 
 
+class BingBotOptions:
+    def __init__(self,
+                 request_timeout_seconds: float = REQUEST_TIMEOUT_SECONDS,
+                 hedge_percentile: Optional[float] = None,
+                 hedge_min_samples: int = HEDGE_MIN_SAMPLES,
+                 carry_over_turns_left: int = CARRY_OVER_TURNS_LEFT):
+        self.request_timeout_seconds: float = request_timeout_seconds
+        # If set, the first message of a conversation is sent again on another profile
+        # when it takes longer than this percentile of the recent latencies
+        self.hedge_percentile: Optional[float] = hedge_percentile
+        self.hedge_min_samples: int = hedge_min_samples
+        # 0 disables preparing the next conversation ahead of the limit. A message Bing rejects at the limit is still carried over.
+        self.carry_over_turns_left: int = carry_over_turns_left
+
+
+class BingBotState:
+    """
+    What is needed to continue a BingBot's conversation after a restart
+    """
+
+    def __init__(self, style, profile_path, conversation_ids=None, turns=0, pending_context=None, recent_turns=None, turns_left=None):
+        self.style: str = style
+        # Profiles are identified by their cookie file, the order of the files may change between restarts
+        self.profile_path: str = profile_path
+        self.conversation_ids: Optional[dict] = conversation_ids
+        self.turns: int = turns
+        self.pending_context: Optional[str] = pending_context
+        self.recent_turns: List[Tuple[str, str]] = recent_turns or []
+        self.turns_left: Optional[int] = turns_left
+
+
+class SpeculativeResponse:
+    """
+    The answer to a message on a conversation forked off a BingBot. The BingBot can adopt the conversation if the user sends that message.
+    """
+
+    def __init__(self, text, style, bot, lease, response):
+        self.text: str = text
+        self.style: str = style
+        self.bot: 'Chatbot' = bot
+        self.lease: ProfileLease = lease
+        self.response: dict = response
+
+
 class BingBotStatus:
     def __init__(self, current_style, profile_index, profile_total_num):
         self.current_style: str = current_style
@@ -32,63 +102,551 @@ class BingBotStatus:
         self.profile_total_num: int = profile_total_num
 
 
+async def create_chatbot(profile: Profile) -> 'Chatbot':
+    return await import_edge_gpt().Chatbot.create(cookies=profile.cookies)
+
+
 class BingBot:
-    def __init__(self, cookie_paths: List[str]):
-        self._cookie_paths = cookie_paths
-        self._profile_index = 0
+    def __init__(self,
+                 profile_pool: ProfilePool,
+                 response_cache: Optional[ResponseCache] = None,
+                 warmer: Optional[ConversationWarmer] = None,
+                 options: Optional[BingBotOptions] = None,
+                 state: Optional[BingBotState] = None):
+        self._pool = profile_pool
+        self._response_cache = response_cache
+        self._warmer = warmer
+        self._options = options if options is not None else BingBotOptions()
+        self._background_tasks: Set[asyncio.Task] = set()
+        # Number of answered messages in the current conversation
+        self._turns = 0
+        # Cached exchanges the current conversation has not seen yet. They are sent as context with the first message.
+        self._pending_context: Optional[str] = None
+        # (message, answer) of the recent exchanges
+        self._recent_turns: Deque[Tuple[str, str]] = deque(maxlen=RECENT_TURNS)
+        # Messages the current conversation accepts before its limit, as of the last answer
+        self._turns_left: Optional[int] = None
+        # The conversation which is continued when the current one reaches its limit
+        self._carry_over_task: Optional[asyncio.Task] = None
+
+        self._current_style = DEFAULT_STYLE
+        if state is not None:
+            self._restore(state)
+            return
+        self._lease = self._pool.acquire()
+        # Without a ready conversation, the conversation is created when the first message is sent
+        self._bot: Optional['Chatbot'] = self._warmer.take(self._lease.profile) if self._warmer is not None else None
 
-        self._bot = Chatbot(cookies=json.load(open(self._cookie_paths[0], encoding='utf-8')))
-        self._current_style = ConversationStyle.balanced
+    def _restore(self, state: BingBotState):
+        profile = next((p for p in self._pool.profiles if p.cookie_path == state.profile_path), None)
+        self._lease = self._pool.acquire(profile.index if profile is not None else None)
+        if state.style in CONVERSATION_STYLES:
+            self._current_style = state.style
+        self._bot = None
+        if profile is not None and state.conversation_ids is not None:
+            self._bot = restore_chatbot(state.conversation_ids, profile.cookies)
+            self._turns = state.turns
+            self._pending_context = state.pending_context
+            self._recent_turns.extend(tuple(turn) for turn in state.recent_turns)
+            self._turns_left = state.turns_left
+
+    def export_state(self) -> BingBotState:
+        return BingBotState(
+            self._current_style,
+            self._lease.profile.cookie_path,
+            get_conversation_ids(self._bot) if self._bot is not None else None,
+            self._turns,
+            self._pending_context,
+            list(self._recent_turns),
+            self._turns_left
+        )
+
+    def get_digest(self) -> Optional[str]:
+        """
+        The recent exchanges of the conversation as text, to give another conversation the same context
+        """
+        exchanges = [f"User: {text}\nBing: {answer}" for text, answer in self._recent_turns]
+        if self._pending_context is not None:
+            exchanges.insert(0, self._pending_context)
+        if len(exchanges) == 0:
+            return None
+        return "\n\n".join(exchanges)[-DIGEST_MAX_CHARS:]
+
+    async def speculate(self, text: str, lease: ProfileLease) -> Optional[SpeculativeResponse]:
+        """
+        Ask text on a new conversation of the leased profile, seeded with the recent exchanges.
+        Return None if Bing did not answer successfully. The lease is owned by the result from then on.
+        """
+        style = self._current_style
+        bot, lease, response = await asyncio.wait_for(self._ask_on_new_conversation(lease, text, self.get_digest(), mode="prefetch"),
+                                                      timeout=self._options.request_timeout_seconds)
+        if not self._is_success(response):
+            self.discard_speculation(SpeculativeResponse(text, style, bot, lease, response))
+            return None
+        return SpeculativeResponse(text, style, bot, lease, response)
+
+    async def adopt(self, speculation: SpeculativeResponse) -> Optional[BingBotResponse]:
+        """
+        Continue on the conversation of a speculative response and return its answer.
+        Return None if the speculation no longer fits, e.g. the style has changed since.
+        """
+        if speculation.style != self._current_style:
+            self.discard_speculation(speculation)
+            return None
+        recent_turns = list(self._recent_turns)
+        self._discard(self._replace_conversation(speculation.bot, speculation.lease))
+        # The new conversation has been given the recent exchanges as context
+        self._recent_turns.extend(recent_turns)
+        bing_resp = await self._parse_response(speculation.response)
+        if bing_resp.success:
+            self._record_turn(speculation.text, bing_resp)
+        return bing_resp
+
+    def discard_speculation(self, speculation: SpeculativeResponse):
+        speculation.lease.release()
+        self._discard(speculation.bot)
 
     def get_bot_status(self) -> BingBotStatus:
         return BingBotStatus(
-            self._current_style.name,
-            self._profile_index + 1,
-            len(self._cookie_paths)
+            self._current_style,
+            self._lease.profile.index + 1,
+            len(self._pool)
         )
 
     async def switch_profile(self):
         """
         Switch Bing profile (account)
         """
-        try:
+        await self._new_conversation(self._lease.profile.index + 1)
+
+    async def reset(self, reason: str = "command"):
+        """
+        Start a new conversation on the profile with the most headroom
+        """
+        RESETS.inc(reason=reason)
+        await self._new_conversation()
+
+    async def close(self):
+        self._drop_carry_over()
+        self._lease.release()
+        if self._bot is not None:
             await self._bot.close()
-        except Exception:
-            pass
-        self._profile_index = (self._profile_index + 1) % len(self._cookie_paths)
-        self._bot = Chatbot(cookies=json.load(open(self._cookie_paths[self._profile_index], encoding='utf-8')))
 
-    async def reset(self):
-        await self._bot.reset()
+    async def _new_conversation(self, profile_index: Optional[int] = None):
+        attempts = 1 if profile_index is not None else len(self._pool)
+        for attempt in range(attempts):
+            lease = self._pool.acquire(profile_index)
+            bot = self._warmer.take(lease.profile) if self._warmer is not None else None
+            try:
+                if bot is None:
+                    bot = await create_chatbot(lease.profile)
+            except Exception as e:
+                lease.release()
+                if not is_not_allowed_to_access(e):
+                    raise
+                lease.cooldown(f"Not allowed to access: {e}")
+                if attempt == attempts - 1:
+                    raise
+                continue
+            old_bot = self._replace_conversation(bot, lease)
+            if old_bot is None:
+                return
+            if self._warmer is not None:
+                # Close the old conversation off the hot path
+                self._warmer.discard(old_bot)
+                return
+            try:
+                await old_bot.close()
+            except Exception:
+                pass
+            return
+
+    async def _ensure_conversation(self) -> Optional[BingBotResponse]:
+        """
+        Create the conversation if it has not been created yet, or carry over to the next one if it has reached its limit.
+        Return an error response if no profile is allowed to create one.
+        """
+        if self._bot is not None and not self._is_exhausted():
+            return None
+        try:
+            if self._bot is None:
+                await self._new_conversation()
+            else:
+                await self._carry_over()
+        except Exception as e:
+            if not is_not_allowed_to_access(e):
+                raise
+            ERRORS.inc(reason="NotAllowedToAccess")
+            return BingBotResponse(False, f'Error: {str(e)}')
+        return None
+
+    def _replace_conversation(self, bot: 'Chatbot', lease: ProfileLease) -> Optional['Chatbot']:
+        """
+        Make bot the current conversation and return the old one, which the caller closes
+        """
+        old_bot = self._bot
+        self._drop_carry_over()
+        self._lease.release()
+        self._bot, self._lease = bot, lease
+        self._turns = 0
+        self._pending_context = None
+        self._recent_turns.clear()
+        self._turns_left = None
+        return old_bot
+
+    def _is_exhausted(self) -> bool:
+        return self._options.carry_over_turns_left > 0 and self._turns_left is not None and self._turns_left <= 0
+
+    def _maybe_prepare_carry_over(self):
+        """
+        Start creating the next conversation in the background if the current one is close to its limit
+        """
+        if self._options.carry_over_turns_left <= 0 or self._turns_left is None or self._turns_left > self._options.carry_over_turns_left:
+            return
+        if self._carry_over_task is None:
+            logger.info(f"Preparing the next conversation, {self._turns_left} messages left in the current one.")
+            self._carry_over_task = asyncio.get_running_loop().create_task(self._prepare_conversation())
+
+    async def _prepare_conversation(self) -> Tuple['Chatbot', ProfileLease]:
+        lease = self._pool.acquire()
+        bot = self._warmer.take(lease.profile) if self._warmer is not None else None
+        try:
+            if bot is None:
+                bot = await create_chatbot(lease.profile)
+        except BaseException:
+            lease.release()
+            raise
+        return bot, lease
+
+    async def _carry_over(self):
+        """
+        Continue on the prepared conversation, which is given the recent exchanges as context with the next message
+        """
+        digest = self.get_digest()
+        recent_turns = list(self._recent_turns)
+        task, self._carry_over_task = self._carry_over_task, None
+        prepared = None
+        if task is not None:
+            try:
+                prepared = await task
+            except Exception:
+                logger.exception("Error occurs during preparing the next conversation")
+        if prepared is not None:
+            self._discard(self._replace_conversation(*prepared))
+        else:
+            await self._new_conversation()
+        RESETS.inc(reason="carry_over")
+        logger.info("Carried over to the next conversation at the message limit.")
+        self._pending_context = digest
+        self._recent_turns.extend(recent_turns)
+
+    async def _carry_over_after_rejection(self) -> Optional[BingBotResponse]:
+        """
+        Carry over after Bing has rejected a message because the conversation is full, so that the message can be sent again.
+        Return an error response if no profile is allowed to create a conversation.
+        """
+        logger.info("Bing rejected the message at the conversation limit.")
+        ERRORS.inc(reason="ConversationLimit")
+        try:
+            await self._carry_over()
+        except Exception as e:
+            if not is_not_allowed_to_access(e):
+                raise
+            ERRORS.inc(reason="NotAllowedToAccess")
+            return BingBotResponse(False, f'Error: {str(e)}')
+        return None
+
+    def _is_conversation_full(self, response: dict) -> bool:
+        """
+        Whether Bing has rejected the message because the current conversation has reached its message limit, rather than the profile
+        being throttled. Only the conversation is exhausted then, so the profile is not cooled down.
+        """
+        response_item = response.get('item', {})
+        result = response_item.get('result', {}).get('value')
+        if result == 'Success':
+            return False
+        throttling = response_item.get('throttling')
+        if throttling is not None:
+            try:
+                return int(throttling['numUserMessagesInConversation']) >= int(throttling['maxNumUserMessagesInConversation'])
+            except (KeyError, TypeError, ValueError):
+                pass
+        # Without the counts, a conversation which has answered before and has no room left that we know of is taken to be full.
+        # If it is the profile after all, the fresh conversation is throttled too, and that result cools the profile down.
+        return result == 'Throttled' and self._turns > 0 and (self._turns_left is None or self._turns_left <= 0)
+
+    def _drop_carry_over(self):
+        task, self._carry_over_task = self._carry_over_task, None
+        if task is None:
+            return
+        if not task.done():
+            # The lease is released by the cancelled task itself
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            bot, lease = task.result()
+            lease.release()
+            self._discard(bot)
+
+    def _discard(self, bot: 'Chatbot'):
+        """
+        Close a conversation in the background
+        """
+        if self._warmer is not None:
+            self._warmer.discard(bot)
+            return
+        task = asyncio.get_running_loop().create_task(bot.close())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
 
     async def switch_style(self, style: str):
-        style_value = ConversationStyle[style]
-        if style_value is None:
-            raise f"Cannot find style {style}"
-        self._current_style = style_value
+        if style not in CONVERSATION_STYLES:
+            raise ValueError(f"Cannot find style {style}")
+        self._current_style = style
         print(f"Successfully switch style to {style}")
-        await self.reset()
+        await self.reset(reason="style")
 
     async def converse(self, text: str) -> BingBotResponse:
+        cached_resp = self._get_cached_response(text)
+        if cached_resp is not None:
+            return cached_resp
+        error_resp = await self._ensure_conversation()
+        if error_resp is not None:
+            return error_resp
         logger.info("Sending a request to Bing server.")
-        response = await self._bot.ask(prompt=text, conversation_style=self._current_style)
+        try:
+            response = await asyncio.wait_for(self._ask(text), timeout=self._options.request_timeout_seconds)
+            if self._is_conversation_full(response):
+                error_resp = await self._carry_over_after_rejection()
+                if error_resp is not None:
+                    return error_resp
+                response = await asyncio.wait_for(self._ask(text), timeout=self._options.request_timeout_seconds)
+        except asyncio.TimeoutError:
+            return await self._on_timeout()
+        logger.info("Received a response from Bing server.")
+        return self._after_response(text, await self._parse_response(response))
+
+    async def converse_stream(self, text: str) -> AsyncIterator[Tuple[bool, Union[str, BingBotResponse]]]:
+        """
+        Same as converse, but yields (False, partial text) while Bing is generating the answer,
+        and (True, BingBotResponse) when the answer is complete
+        """
+        cached_resp = self._get_cached_response(text)
+        if cached_resp is not None:
+            yield True, cached_resp
+            return
+        error_resp = await self._ensure_conversation()
+        if error_resp is not None:
+            yield True, error_resp
+            return
+        # A message rejected at the conversation limit is sent once more on the next conversation
+        for attempt in range(2):
+            logger.info("Sending a streaming request to Bing server.")
+            final_response = None
+            timed_out = False
+            deadline = time.monotonic() + self._options.request_timeout_seconds
+            lease = self._lease
+            try:
+                await asyncio.wait_for(lease.begin_request(), timeout=self._options.request_timeout_seconds)
+            except asyncio.TimeoutError:
+                yield True, await self._on_timeout()
+                return
+            start_time = time.perf_counter()
+            stream = self._bot.ask_stream(prompt=text, conversation_style=self._current_style, webpage_context=self._pending_context)
+            try:
+                with TRACER.span("bing_ask", mode="stream", profile=lease.profile.index + 1):
+                    while True:
+                        try:
+                            final, response = await asyncio.wait_for(stream.__anext__(), timeout=max(0.0, deadline - time.monotonic()))
+                        except StopAsyncIteration:
+                            break
+                        if final:
+                            final_response = response
+                        else:
+                            yield False, response
+            except asyncio.TimeoutError:
+                timed_out = True
+            finally:
+                lease.end_request()
+                await stream.aclose()
+            if timed_out:
+                yield True, await self._on_timeout()
+                return
+            if final_response is None:
+                ERRORS.inc(reason="NoFinalResponse")
+                return
+            elapsed = time.perf_counter() - start_time
+            BING_REQUEST_SECONDS.observe(elapsed, mode="stream")
+            BING_LATENCY.observe(elapsed)
+            if attempt > 0 or not self._is_conversation_full(final_response):
+                break
+            error_resp = await self._carry_over_after_rejection()
+            if error_resp is not None:
+                yield True, error_resp
+                return
         logger.info("Received a response from Bing server.")
+        yield True, self._after_response(text, await self._parse_response(final_response))
+
+    async def _ask(self, text: str) -> dict:
+        hedge_delay = self._get_hedge_delay()
+        if hedge_delay is None:
+            return await self._ask_on(self._bot, self._lease, text, self._pending_context)
+        return await self._ask_hedged(text, hedge_delay)
+
+    async def _ask_on(self, bot: 'Chatbot', lease: ProfileLease, text: str, webpage_context: Optional[str] = None, mode: str = "ask") -> dict:
+        await lease.begin_request()
+        start_time = time.perf_counter()
+        try:
+            with TRACER.span("bing_ask", mode=mode, profile=lease.profile.index + 1):
+                response = await bot.ask(prompt=text, conversation_style=self._current_style, webpage_context=webpage_context)
+        finally:
+            lease.end_request()
+        elapsed = time.perf_counter() - start_time
+        BING_REQUEST_SECONDS.observe(elapsed, mode=mode)
+        BING_LATENCY.observe(elapsed)
+        return response
+
+    def _get_hedge_delay(self) -> Optional[float]:
+        """
+        Seconds to wait for the current profile before hedging, or None if this request is not hedged
+        """
+        if self._options.hedge_percentile is None or len(BING_LATENCY) < self._options.hedge_min_samples:
+            return None
+        # Only a fresh conversation can be replaced by another one without losing context
+        if self._turns > 0 or self._pending_context is not None:
+            return None
+        return BING_LATENCY.percentile(self._options.hedge_percentile)
+
+    async def _ask_hedged(self, text: str, hedge_delay: float) -> dict:
+        """
+        Ask on the current conversation. If it has not answered after hedge_delay, ask again on a fresh conversation
+        of another profile. The first successful response wins, and the other request is cancelled and closed.
+        """
+        loop = asyncio.get_running_loop()
+        primary = loop.create_task(self._ask_on(self._bot, self._lease, text))
+        hedge: Optional[asyncio.Task] = None
+        winner: Optional[asyncio.Task] = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+            if primary in done:
+                return primary.result()
+            lease = self._pool.acquire_other(self._lease.profile)
+            if lease is None:
+                return await primary
+            logger.info(f"Hedging the request on profile {lease.profile.index + 1}.")
+            hedge = loop.create_task(self._ask_on_new_conversation(lease, text))
+            pending = {primary, hedge}
+            while len(pending) > 0 and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and self._is_success(task.result()[-1] if task is hedge else task.result()):
+                        winner = task
+                        break
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+            if hedge is not None and hedge is not winner and hedge.done() and not hedge.cancelled() and hedge.exception() is None:
+                bot, lease, _ = hedge.result()
+                lease.release()
+                self._discard(bot)
+
+        if winner is hedge:
+            HEDGES.inc(outcome="hedge")
+            bot, lease, response = hedge.result()
+            self._discard(self._replace_conversation(bot, lease))
+            return response
+        HEDGES.inc(outcome="primary" if winner is primary else "failed")
+        # If neither succeeded, the primary result is handled as usual
+        return primary.result()
+
+    async def _ask_on_new_conversation(self, lease: ProfileLease, text: str, webpage_context: Optional[str] = None,
+                                       mode: str = "ask") -> Tuple['Chatbot', ProfileLease, dict]:
+        bot = self._warmer.take(lease.profile) if self._warmer is not None else None
+        try:
+            if bot is None:
+                bot = await create_chatbot(lease.profile)
+            return bot, lease, await self._ask_on(bot, lease, text, webpage_context, mode)
+        except BaseException:
+            lease.release()
+            if bot is not None:
+                self._discard(bot)
+            raise
+
+    async def _on_timeout(self) -> BingBotResponse:
+        timeout = self._options.request_timeout_seconds
+        ERRORS.inc(reason="Timeout")
+        BING_LATENCY.observe(timeout)
+        # The conversation may be stuck, continue on a new one
+        try:
+            await self.reset(reason="timeout")
+        except Exception as e:
+            if not is_not_allowed_to_access(e):
+                raise
+            ERRORS.inc(reason="NotAllowedToAccess")
+            return BingBotResponse(False, f'Error: {str(e)}')
+        return BingBotResponse(False, f'Error: no response from Bing within {timeout:g} seconds. Conversation has been reset.')
+
+    @staticmethod
+    def _is_success(response: dict) -> bool:
+        response_item = response.get('item', {})
+        messages = response_item.get('messages') or []
+        return response_item.get('result', {}).get('value') == 'Success' and len(messages) > 0 and messages[-1].get('author') == 'bot'
+
+    def _get_cached_response(self, text: str) -> Optional[BingBotResponse]:
+        """
+        Look up the response cache. Only the first message of a conversation can be answered from the cache.
+        """
+        # A carried over conversation continues the previous exchanges, and an answer from the cache is a turn Bing has not seen yet
+        if self._response_cache is None or self._turns > 0 or len(self._recent_turns) > 0 or self._pending_context is not None:
+            return None
+        cached_resp = self._response_cache.get(text, self._current_style)
+        if cached_resp is not None:
+            logger.info("Answered from the response cache.")
+            # Bing has not seen this exchange. Send it as context with the next real message.
+            exchange = f"User: {text}\nBing: {cached_resp.message}"
+            self._pending_context = exchange if self._pending_context is None else f"{self._pending_context}\n\n{exchange}"
+        return cached_resp
+
+    def _after_response(self, text: str, bing_resp: BingBotResponse) -> BingBotResponse:
+        if not bing_resp.success:
+            return bing_resp
+        # A response which depends on cached context is not the answer to a fresh conversation
+        if self._response_cache is not None and self._turns == 0 and self._pending_context is None:
+            self._response_cache.put(text, self._current_style, bing_resp)
+        self._record_turn(text, bing_resp)
+        return bing_resp
+
+    def _record_turn(self, text: str, bing_resp: BingBotResponse):
+        self._turns += 1
+        self._pending_context = None
+        self._recent_turns.append((text, bing_resp.message))
+        self._maybe_prepare_carry_over()
+
+    async def _parse_response(self, response: dict) -> BingBotResponse:
         response_item = response['item']
         result = response_item['result']
         if result['value'] != 'Success':
+            ERRORS.inc(reason=result['value'])
+            self._lease.cooldown(result['value'])
             try:
-                await self.reset()
-            except EdgeGPT.NotAllowedToAccess as e:
+                await self.reset(reason="error")
+            except Exception as e:
+                if not is_not_allowed_to_access(e):
+                    raise
+                ERRORS.inc(reason="NotAllowedToAccess")
                 return BingBotResponse(False, f'Error: {str(e)}')
             return BingBotResponse(False, f'Error: conversation has been reset. Reason: {result["value"]}')
 
         throttling = response_item['throttling']
         cur_num, max_num = int(throttling['numUserMessagesInConversation']), int(
             throttling['maxNumUserMessagesInConversation'])
+        self._lease.record_throttling(cur_num, max_num)
+        self._turns_left = max_num - cur_num
 
         message = response_item['messages'][-1]
         if message['author'] is None or message['author'] != 'bot':
-            await self.reset()
+            ERRORS.inc(reason="NoResponse")
+            await self.reset(reason="error")
             return BingBotResponse(False, f'Error: No response from Bing Chat Bot')
         message_text = message['text']
 
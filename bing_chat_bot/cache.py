@@ -0,0 +1,90 @@
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Iterable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .bing import BingBotResponse
+
+RESPONSE_CACHE_TTL_SECONDS = 6 * 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 512
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCacheStats:
+    def __init__(self, entries, size_bytes, hits, misses):
+        self.entries: int = entries
+        self.size_bytes: int = size_bytes
+        self.hits: int = hits
+        self.misses: int = misses
+        # A field rather than a property, so that it is exported with the other stats
+        self.hit_rate: float = hits / (hits + misses) if hits + misses > 0 else 0.0
+
+
+class ResponseCache:
+    """
+    Cache the response to the first message of a conversation, keyed by the normalized prompt and the conversation style.
+    Only styles in enabled_styles are cached.
+    """
+
+    def __init__(self,
+                 enabled_styles: Iterable[str],
+                 ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self._enabled_styles = set(enabled_styles)
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+
+        # key -> (expire time, size in bytes, response)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, int, 'BingBotResponse']]" = OrderedDict()
+        self._size_bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def is_enabled(self, style: str) -> bool:
+        return style in self._enabled_styles
+
+    def get(self, prompt: str, style: str) -> Optional['BingBotResponse']:
+        if not self.is_enabled(style):
+            return None
+        key = (self._normalize(prompt), style)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def put(self, prompt: str, style: str, response: 'BingBotResponse'):
+        if not self.is_enabled(style) or not response.success:
+            return
+        key = (self._normalize(prompt), style)
+        if key in self._entries:
+            self._remove(key)
+        size = self._estimate_size(response)
+        self._entries[key] = (time.monotonic() + self._ttl_seconds, size, response)
+        self._size_bytes += size
+        while len(self._entries) > self._max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def get_stats(self) -> ResponseCacheStats:
+        return ResponseCacheStats(len(self._entries), self._size_bytes, self._hits, self._misses)
+
+    def _remove(self, key: Tuple[str, str]):
+        _, size, _ = self._entries.pop(key)
+        self._size_bytes -= size
+
+    @staticmethod
+    def _normalize(prompt: str) -> str:
+        return re.sub(r'[\s?!.。？！]+$', '', " ".join(prompt.lower().split()))
+
+    @staticmethod
+    def _estimate_size(response: 'BingBotResponse') -> int:
+        texts = [response.message, response.links, response.citations] + (response.suggested_responses or [])
+        return sum(len(text.encode('utf-8')) for text in texts if text is not None)
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Optional
+
+import discord
+
+# A worker which does not sync the commands looks them up on Discord this many times, waiting this long in between,
+# until the worker which syncs them has registered all of them
+COMMAND_LOOKUP_ATTEMPTS = 12
+COMMAND_LOOKUP_RETRY_SECONDS = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def hash_commands(bot: discord.Bot) -> str:
+    """
+    Hash of the application command tree as it is sent to Discord, together with the application it belongs to
+    """
+    payloads = sorted(json.dumps(command.to_dict(), sort_keys=True, default=str) for command in bot.pending_application_commands)
+    return hashlib.sha256("\n".join([str(bot.user.id)] + payloads).encode('utf-8')).hexdigest()
+
+
+def default_state_path(bot_token: str) -> str:
+    """
+    A state file in the temporary directory of its own for each bot token, so that bots sharing the machine do not skip each other's syncs
+    """
+    # The token itself must not show up in the file name
+    token_hash = hashlib.sha256(bot_token.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"bing-chat-bot-commands-{token_hash}.json")
+
+
+class CommandSyncState:
+    """
+    The hash of the commands registered by the last sync and the ids Discord gave them, kept in a JSON file
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def load(self) -> Optional[dict]:
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.exception(f"Error occurs during reading the command sync state {self._path}")
+            return None
+
+    def save(self, commands_hash: str, bot: discord.Bot):
+        state = {
+            'hash': commands_hash,
+            'ids': {command.name: command.id for command in bot.pending_application_commands if command.id is not None}
+        }
+        # Write to a temporary file first, so that a crash does not leave a truncated state behind
+        temp_path = f"{self._path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(temp_path, self._path)
+        except OSError:
+            logger.exception(f"Error occurs during writing the command sync state {self._path}")
+
+
+def _assign_command_id(bot: discord.Bot, command: discord.ApplicationCommand, command_id: str):
+    command.id = command_id
+    bot._application_commands[command_id] = command
+
+
+def restore_command_ids(bot: discord.Bot, state: CommandSyncState) -> bool:
+    """
+    Take the command ids from the state if the commands are the same as in the last sync, so that interactions are matched by id.
+    Return True if the ids were restored.
+    """
+    previous = state.load()
+    if previous is None or previous.get('hash') != hash_commands(bot):
+        return False
+    ids = previous.get('ids', {})
+    for command in bot.pending_application_commands:
+        command_id = ids.get(command.name)
+        if command_id is not None:
+            _assign_command_id(bot, command, command_id)
+    return True
+
+
+async def load_registered_command_ids(bot: discord.Bot,
+                                      attempts: int = COMMAND_LOOKUP_ATTEMPTS,
+                                      retry_seconds: float = COMMAND_LOOKUP_RETRY_SECONDS) -> bool:
+    """
+    Take the ids of the global commands registered on Discord, matched by name and type as a sync does.
+    This is for a worker which leaves the sync to another one. Without the ids, py-cord cannot match interactions in guilds with global commands.
+    Return True if every command was found.
+    """
+    for attempt in range(attempts):
+        if attempt > 0:
+            await asyncio.sleep(retry_seconds)
+        try:
+            registered = await bot.http.get_global_commands(bot.user.id)
+        except discord.HTTPException:
+            logger.exception("Error occurs during fetching the registered application commands")
+            continue
+        ids = {(command['name'], command.get('type')): command['id'] for command in registered}
+        missing = []
+        for command in bot.pending_application_commands:
+            command_id = ids.get((command.name, command.type))
+            if command_id is None:
+                missing.append(command.name)
+            else:
+                _assign_command_id(bot, command, command_id)
+        if len(missing) == 0:
+            logger.info("Loaded the ids of the registered application commands")
+            return True
+        # The worker which syncs the commands may not have registered the new ones yet
+        logger.info(f"Application commands {', '.join(missing)} are not registered yet")
+    logger.warning("Some application commands are not registered, they cannot be used on this worker")
+    return False
+
+
+async def sync_commands_if_changed(bot: discord.Bot, state: CommandSyncState) -> bool:
+    """
+    Sync the application commands with Discord, unless they are the same as in the last sync.
+    When the sync is skipped, the command ids are restored from the state so that interactions are matched by id.
+    Return True if the commands were synced.
+    """
+    commands_hash = hash_commands(bot)
+    if restore_command_ids(bot, state):
+        logger.info("Application commands are unchanged, skipped syncing them")
+        return False
+    await bot.sync_commands()
+    state.save(commands_hash, bot)
+    logger.info("Synced application commands")
+    return True
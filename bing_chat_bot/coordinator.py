@@ -0,0 +1,391 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from .profile import IN_FLIGHT_REQUESTS_PER_PROFILE, Profile, ProfilePool
+from .reload import ConfigReloader
+
+# Delay before a worker tries to reach the coordinator again
+COORDINATOR_RECONNECT_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+async def _send(writer: asyncio.StreamWriter, message: dict):
+    writer.write(json.dumps(message).encode('utf-8') + b"\n")
+    await writer.drain()
+
+
+class ProfileCoordinator:
+    """
+    Owns the profile state shared by the worker processes of the sharded mode.
+    Workers report their in-flight requests, throttling usage and failures over a Unix socket,
+    and receive the load of the other workers and the cooldowns in return.
+    The in-flight slots of each profile are granted here, so that the workers together never exceed them.
+    Settings changed in one worker, e.g. by /toggle, are relayed to the others.
+
+    Messages are JSON lines. Profiles are identified by their cookie file, since the processes may discover added files
+    in different orders. From a worker:
+        {"op": "load", "profiles": {cookie_path: [in_flight, usage, conversations], ...}}
+        {"op": "cooldown", "profile": cookie_path, "reason": reason}
+        {"op": "success", "profile": cookie_path}
+        {"op": "acquire", "profile": cookie_path, "id": id}
+        {"op": "release", "profile": cookie_path, "id": id}
+        {"op": "setting", "name": name, "value": value}
+    To a worker:
+        {"op": "state", "profiles": {cookie_path: [remote_in_flight, remote_usage, remote_conversations, cooldown_seconds, consecutive_failures], ...}}
+        {"op": "granted", "id": id}
+        {"op": "rejected", "id": id}, if the coordinator does not know the profile of the slot
+        {"op": "setting", "name": name, "value": value}
+    """
+
+    def __init__(self, cookie_paths: List[str], socket_path: str, max_in_flight_per_profile: int = IN_FLIGHT_REQUESTS_PER_PROFILE):
+        self._pool = ProfilePool(cookie_paths)
+        self._max_in_flight_per_profile = max_in_flight_per_profile
+        # Picks up changed and added cookie files like the workers do
+        self._reloader = ConfigReloader(self._pool, cookie_paths, on_profile_changed=lambda profile: self._schedule_broadcast())
+        self._socket_path = socket_path
+        self._server: Optional[asyncio.AbstractServer] = None
+        # Tasks reading from the connected workers
+        self._handlers: Set[asyncio.Task] = set()
+        # writer -> cookie path -> the load the worker reported for the profile
+        self._workers: Dict[asyncio.StreamWriter, Dict[str, Tuple[int, float, int]]] = {}
+        self._broadcast_handle: Optional[asyncio.Handle] = None
+        # writer -> {slot id: cookie path} of the slots granted to the worker
+        self._granted: Dict[asyncio.StreamWriter, Dict[int, str]] = {}
+        # cookie path -> (writer, slot id) of the workers waiting for a slot, in order
+        self._waiting: Dict[str, Deque[Tuple[asyncio.StreamWriter, int]]] = {}
+        # cookie path -> number of granted slots
+        self._slots_in_use: Dict[str, int] = {}
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._handle_worker, path=self._socket_path)
+        logger.info(f"Profile coordinator is listening on {self._socket_path}")
+        self._reloader.start()
+
+    async def close(self):
+        await self._reloader.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._workers):
+            writer.close()
+        # The readers see the end of their connection and forget the workers
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._workers[writer] = {}
+        self._granted[writer] = {}
+        self._handlers.add(asyncio.current_task())
+        await self._send_state(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._apply(writer, json.loads(line))
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception("Error occurs during reading from a worker")
+        finally:
+            # The requests, slots and conversations of a worker which is gone no longer count
+            self._workers.pop(writer, None)
+            self._drop_slots(writer)
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+            self._schedule_broadcast()
+
+    def _apply(self, writer: asyncio.StreamWriter, message: dict):
+        op = message.get('op')
+        if op == 'load':
+            # The coordinator may not have picked up a profile which has just been added to the worker
+            self._workers[writer] = {cookie_path: (int(in_flight), float(usage), int(conversations))
+                                     for cookie_path, (in_flight, usage, conversations) in message['profiles'].items()
+                                     if self._pool.get_profile(cookie_path) is not None}
+        elif op == 'cooldown':
+            profile = self._get_profile(message)
+            if profile is not None:
+                self._pool.cooldown(profile, message.get('reason', ""))
+        elif op == 'success':
+            profile = self._get_profile(message)
+            if profile is not None:
+                self._pool.record_success(profile)
+        elif op == 'acquire':
+            profile = self._get_profile(message)
+            if profile is None:
+                # The worker goes on with its own bound
+                asyncio.get_running_loop().create_task(self._send_quietly(writer, {'op': 'rejected', 'id': int(message['id'])}))
+                return
+            self._waiting.setdefault(profile.cookie_path, deque()).append((writer, int(message['id'])))
+            self._grant_slots(profile.cookie_path)
+            return
+        elif op == 'release':
+            self._release_slot(writer, int(message['id']), message.get('profile'))
+            return
+        elif op == 'setting':
+            for other in self._workers:
+                if other is not writer:
+                    asyncio.get_running_loop().create_task(self._send_quietly(other, message))
+            return
+        else:
+            logger.warning(f"Unknown message from a worker: {op}")
+            return
+        self._schedule_broadcast()
+
+    def _get_profile(self, message: dict) -> Optional[Profile]:
+        profile = self._pool.get_profile(message.get('profile'))
+        if profile is None:
+            logger.warning(f"Unknown profile {message.get('profile')!r} in a {message.get('op')} message from a worker")
+        return profile
+
+    def _grant_slots(self, cookie_path: str):
+        waiting = self._waiting.get(cookie_path)
+        while waiting and self._slots_in_use.get(cookie_path, 0) < self._max_in_flight_per_profile:
+            writer, slot_id = waiting.popleft()
+            self._granted[writer][slot_id] = cookie_path
+            self._slots_in_use[cookie_path] = self._slots_in_use.get(cookie_path, 0) + 1
+            asyncio.get_running_loop().create_task(self._send_quietly(writer, {'op': 'granted', 'id': slot_id}))
+
+    def _release_slot(self, writer: asyncio.StreamWriter, slot_id: int, cookie_path: str):
+        granted = self._granted.get(writer, {})
+        if slot_id in granted:
+            if granted[slot_id] != cookie_path:
+                logger.warning(f"A worker has released slot {slot_id} of {cookie_path!r}, but it was granted for {granted[slot_id]!r}")
+                return
+            del granted[slot_id]
+            self._slots_in_use[cookie_path] -= 1
+            self._grant_slots(cookie_path)
+            return
+        # The worker has given up waiting
+        waiting = self._waiting.get(cookie_path)
+        if waiting is not None and (writer, slot_id) in waiting:
+            waiting.remove((writer, slot_id))
+
+    def _drop_slots(self, writer: asyncio.StreamWriter):
+        for waiting in self._waiting.values():
+            for entry in [entry for entry in waiting if entry[0] is writer]:
+                waiting.remove(entry)
+        freed = set()
+        for cookie_path in self._granted.pop(writer, {}).values():
+            self._slots_in_use[cookie_path] -= 1
+            freed.add(cookie_path)
+        for cookie_path in freed:
+            self._grant_slots(cookie_path)
+
+    @staticmethod
+    async def _send_quietly(writer: asyncio.StreamWriter, message: dict):
+        try:
+            await _send(writer, message)
+        except ConnectionError:
+            pass
+
+    def _schedule_broadcast(self):
+        # Several reports arriving together are answered with one broadcast
+        if self._broadcast_handle is None:
+            self._broadcast_handle = asyncio.get_running_loop().call_soon(self._broadcast)
+
+    def _broadcast(self):
+        self._broadcast_handle = None
+        for writer in list(self._workers):
+            asyncio.get_running_loop().create_task(self._send_state(writer))
+
+    async def _send_state(self, writer: asyncio.StreamWriter):
+        now = time.monotonic()
+        profiles = {}
+        for profile in self._pool.profiles:
+            others = [loads[profile.cookie_path] for other, loads in self._workers.items() if other is not writer and profile.cookie_path in loads]
+            profiles[profile.cookie_path] = [
+                sum(load[0] for load in others),
+                sum(load[1] for load in others),
+                sum(load[2] for load in others),
+                max(0.0, profile.cooldown_until - now),
+                profile.consecutive_failures
+            ]
+        await self._send_quietly(writer, {'op': 'state', 'profiles': profiles})
+
+
+class CoordinatedProfilePool(ProfilePool):
+    """
+    The profile pool of a worker process in the sharded mode. Placement takes the load of the other workers into account,
+    cooldowns are shared, and the in-flight slots of the profiles are granted by the coordinator.
+    If the coordinator is unreachable, the pool keeps working on its local view and only bounds the slots of this worker.
+    """
+
+    def __init__(self, cookie_paths: List[str], socket_path: str):
+        super().__init__(cookie_paths)
+        self._socket_path = socket_path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connection_task: Optional[asyncio.Task] = None
+        # Messages waiting to be sent to the coordinator, in order
+        self._outbox: Deque[dict] = deque()
+        # Set when a message is posted or the load changes
+        self._outbox_ready = asyncio.Event()
+        # Set if the load has changed since it was last sent. Any number of changes is sent as one report.
+        self._load_changed = False
+        self._slot_ids = itertools.count(1)
+        # slot id -> resolved with True when the coordinator grants the slot, or False when the connection is lost
+        self._slot_waiters: Dict[int, asyncio.Future] = {}
+        # cookie path -> ids of the slots the coordinator has granted to this worker
+        self._granted_slots: Dict[str, List[int]] = {}
+        # Called with (name, value) when another worker has changed a setting
+        self.on_setting_changed: Optional[Callable[[str, object], None]] = None
+        # Called when the connection to the coordinator is lost. If set, the pool does not reconnect.
+        self.on_disconnected: Optional[Callable[[], None]] = None
+
+    async def connect(self):
+        """
+        Connect to the coordinator, and keep reconnecting in the background if the connection is lost
+        """
+        if self._connection_task is None:
+            self._connection_task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._connection_task is not None:
+            self._connection_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    def cooldown(self, profile: Profile, reason: str):
+        # Stop using the profile in this worker right away, the coordinator's answer follows
+        super().cooldown(profile, reason)
+        self._post({'op': 'cooldown', 'profile': profile.cookie_path, 'reason': reason})
+
+    def record_success(self, profile: Profile):
+        if profile.consecutive_failures > 0:
+            self._post({'op': 'success', 'profile': profile.cookie_path})
+        super().record_success(profile)
+
+    def publish_setting(self, name: str, value):
+        """
+        Apply a setting changed in this worker to the other workers too
+        """
+        self._post({'op': 'setting', 'name': name, 'value': value})
+
+    async def _acquire_slot(self, profile: Profile):
+        # The local bound holds even when the coordinator is unreachable
+        await super()._acquire_slot(profile)
+        if self._writer is None:
+            return
+        slot_id = next(self._slot_ids)
+        waiter = asyncio.get_running_loop().create_future()
+        self._slot_waiters[slot_id] = waiter
+        self._post({'op': 'acquire', 'profile': profile.cookie_path, 'id': slot_id})
+        try:
+            granted = await waiter
+        except BaseException:
+            self._slot_waiters.pop(slot_id, None)
+            # Gives the slot back if it has been granted meanwhile
+            self._post({'op': 'release', 'profile': profile.cookie_path, 'id': slot_id})
+            super()._release_slot(profile)
+            raise
+        if granted:
+            self._granted_slots.setdefault(profile.cookie_path, []).append(slot_id)
+
+    def _release_slot(self, profile: Profile):
+        granted_slots = self._granted_slots.get(profile.cookie_path)
+        if granted_slots:
+            self._post({'op': 'release', 'profile': profile.cookie_path, 'id': granted_slots.pop()})
+        super()._release_slot(profile)
+
+    def _changed(self):
+        if self._writer is not None:
+            self._load_changed = True
+            self._outbox_ready.set()
+
+    def _post(self, message: dict):
+        if self._writer is None:
+            return
+        self._outbox.append(message)
+        self._outbox_ready.set()
+
+    async def _send_outbox(self, writer: asyncio.StreamWriter):
+        """
+        Send the posted messages and the load, waiting for the coordinator to take each one, so that a slow coordinator
+        holds up the reports rather than filling the buffer of the connection
+        """
+        try:
+            while True:
+                await self._outbox_ready.wait()
+                self._outbox_ready.clear()
+                while self._outbox or self._load_changed:
+                    if self._outbox:
+                        message = self._outbox.popleft()
+                    else:
+                        self._load_changed = False
+                        message = {'op': 'load', 'profiles': {profile.cookie_path: [profile.in_flight + profile.reserved,
+                                                                                    sum(profile.conversation_usages.values()),
+                                                                                    len(profile.conversation_usages)]
+                                                              for profile in self._profiles}}
+                    await _send(writer, message)
+        except ConnectionError:
+            pass
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self._socket_path)
+            except OSError:
+                await asyncio.sleep(COORDINATOR_RECONNECT_SECONDS)
+                continue
+            self._writer = writer
+            sender = asyncio.get_running_loop().create_task(self._send_outbox(writer))
+            self._changed()
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = json.loads(line)
+                    if message.get('op') == 'state':
+                        self._apply_state(message['profiles'])
+                    elif message.get('op') in ('granted', 'rejected'):
+                        waiter = self._slot_waiters.pop(message['id'], None)
+                        if waiter is not None and not waiter.done():
+                            waiter.set_result(message['op'] == 'granted')
+                    elif message.get('op') == 'setting' and self.on_setting_changed is not None:
+                        try:
+                            self.on_setting_changed(message['name'], message['value'])
+                        except Exception:
+                            logger.exception(f"Error occurs during applying the setting {message['name']} from another worker")
+            except ConnectionError:
+                pass
+            except Exception:
+                logger.exception("Error occurs during reading from the profile coordinator")
+            finally:
+                self._writer = None
+                sender.cancel()
+                # The messages are about the state of this connection, which the coordinator forgets
+                self._outbox.clear()
+                self._load_changed = False
+                writer.close()
+                # The coordinator has forgotten the slots of this connection. Waiting requests go on with the local bound.
+                self._granted_slots.clear()
+                waiters, self._slot_waiters = self._slot_waiters, {}
+                for waiter in waiters.values():
+                    if not waiter.done():
+                        waiter.set_result(False)
+            if self.on_disconnected is not None:
+                logger.warning("Lost the connection to the profile coordinator")
+                self.on_disconnected()
+                return
+            logger.warning("Lost the connection to the profile coordinator, reconnecting")
+            await asyncio.sleep(COORDINATOR_RECONNECT_SECONDS)
+
+    def _apply_state(self, states: dict):
+        now = time.monotonic()
+        for profile in self._profiles:
+            if profile.cookie_path not in states:
+                # Not picked up by the coordinator yet
+                continue
+            in_flight, usage, conversations, cooldown_seconds, consecutive_failures = states[profile.cookie_path]
+            profile.remote_in_flight = in_flight
+            profile.remote_usage = usage
+            profile.remote_conversations = conversations
+            # A cooldown this worker has just reported may not have reached the coordinator yet
+            profile.cooldown_until = max(profile.cooldown_until, now + cooldown_seconds)
+            profile.consecutive_failures = consecutive_failures
@@ -0,0 +1,249 @@
+import asyncio
+import functools
+import io
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import discord
+from aiohttp.payload import IOBasePayload, Order, register_payload
+
+from .formatter import FormatterResponse, FormatterResponseType
+from .metrics import DISCORD_SEND_SECONDS, LARGE_TEXT_FALLBACKS
+from .scheduler import TokenBucket
+from .tracing import TRACER
+
+# Discord allows about 5 requests per 5 seconds per channel, for message sends, edits and deletes separately
+CHANNEL_REQUESTS_PER_SECOND = 1.0
+CHANNEL_BURST = 5
+
+# Idle buckets are dropped once there are more than this many of them
+MAX_CHANNEL_BUCKETS = 1024
+
+# Number of characters encoded at a time when an attachment is read or measured
+ATTACHMENT_ENCODE_CHARS = 16 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class TextAttachment(io.RawIOBase):
+    """
+    A readable file over a string, encoded to UTF-8 piece by piece while it is uploaded instead of as a whole copy.
+    The encoded size is measured the same way, so that the upload still has a Content-Length.
+    """
+
+    def __init__(self, text: str):
+        super().__init__()
+        self._text = text
+        self._size: Optional[int] = None
+        self._char_pos = 0
+        self._byte_pos = 0
+        # The encoded piece being read, and the position in it
+        self._piece = b""
+        self._piece_pos = 0
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            if self._text.isascii():
+                self._size = len(self._text)
+            else:
+                self._size = sum(len(self._text[start:start + ATTACHMENT_ENCODE_CHARS].encode('utf-8'))
+                                 for start in range(0, len(self._text), ATTACHMENT_ENCODE_CHARS))
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._byte_pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # Uploads only rewind to the start before a retry
+        if whence != io.SEEK_SET or offset not in (0, self._byte_pos):
+            raise io.UnsupportedOperation("Only rewinding to the start is supported")
+        if offset == 0:
+            self._char_pos, self._byte_pos, self._piece, self._piece_pos = 0, 0, b"", 0
+        return self._byte_pos
+
+    def readinto(self, buffer) -> int:
+        if self._piece_pos == len(self._piece):
+            if self._char_pos >= len(self._text):
+                return 0
+            end = self._char_pos + ATTACHMENT_ENCODE_CHARS
+            self._piece, self._piece_pos = self._text[self._char_pos:end].encode('utf-8'), 0
+            self._char_pos = end
+        size = min(len(buffer), len(self._piece) - self._piece_pos)
+        buffer[:size] = memoryview(self._piece)[self._piece_pos:self._piece_pos + size]
+        self._piece_pos += size
+        self._byte_pos += size
+        return size
+
+
+class TextAttachmentPayload(IOBasePayload):
+    """
+    Lets aiohttp send a TextAttachment with a Content-Length instead of chunked. It is read on aiohttp's executor,
+    so the encoding overlaps with the event loop instead of blocking it.
+    """
+    _value: TextAttachment
+
+    @property
+    def size(self) -> int:
+        return self._value.size - self._value.tell()
+
+
+def text_attachment_file(text: str, filename: str = "response.md") -> discord.File:
+    """
+    A Discord file of the text, which is encoded while it is uploaded
+    """
+    _register_text_attachment_payload()
+    return discord.File(TextAttachment(text), filename=filename)
+
+
+@functools.lru_cache(maxsize=None)
+def _register_text_attachment_payload():
+    # Once, when the first attachment is about to be sent. It only changes how aiohttp sends a TextAttachment.
+    register_payload(TextAttachmentPayload, TextAttachment, order=Order.try_first)
+
+
+class MessageDelivery:
+    """
+    Send, edit and delete Discord messages. Requests are paced per channel so that the parts of a long reply do not run into
+    Discord's rate limits and wait for a 429 retry.
+    Sends go out in the order they were made in each channel, as Discord does not keep the order of concurrent sends.
+    A reply can be queued, so that the request moves on while its parts are sent, and a later send in the channel waits for them.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[str, int], TokenBucket] = {}
+        # channel id -> the last send queued in the channel, which the next one waits for
+        self._tails: Dict[int, asyncio.Task] = {}
+        self._pending: Set[asyncio.Task] = set()
+
+    def queue(self, formatter_responses: List[FormatterResponse], original_message: discord.Message) -> asyncio.Task:
+        """
+        Send a formatted response as a reply to original_message in the background. Errors are logged.
+        """
+        return self._enqueue(original_message.channel.id, functools.partial(self._deliver, formatter_responses, original_message))
+
+    async def deliver(self, formatter_responses: List[FormatterResponse], original_message: discord.Message):
+        """
+        Send a formatted response as a reply to original_message, and wait until it is sent. Errors are logged.
+        """
+        await asyncio.shield(self.queue(formatter_responses, original_message))
+
+    async def send(self, original_message: discord.Message, reply: bool = False, **params) -> discord.Message:
+        """
+        Send a message once the messages queued before it in the channel are sent
+        """
+        # Not cancelled with the caller, so that the next send in the channel does not overtake it
+        return await asyncio.shield(self._enqueue(original_message.channel.id, functools.partial(self._send, original_message, reply, **params)))
+
+    async def edit(self, message: discord.Message, **params) -> discord.Message:
+        await self._acquire("edit", message.channel.id)
+        try:
+            with DISCORD_SEND_SECONDS.time(method="edit"), TRACER.span("discord_send", method="edit"):
+                return await message.edit(**params)
+        except discord.HTTPException as e:
+            self._on_http_exception(e, "edit", message.channel.id)
+            raise
+
+    async def delete(self, message: discord.Message):
+        await self._acquire("delete", message.channel.id)
+        try:
+            with DISCORD_SEND_SECONDS.time(method="delete"), TRACER.span("discord_send", method="delete"):
+                await message.delete()
+        except discord.HTTPException as e:
+            self._on_http_exception(e, "delete", message.channel.id)
+            raise
+
+    async def close(self):
+        """
+        Wait for the queued replies to be sent
+        """
+        if len(self._pending) > 0:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def _enqueue(self, channel_id: int, work: Callable[[], Awaitable]) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(self._run_after(self._tails.get(channel_id), work))
+        self._tails[channel_id] = task
+        self._pending.add(task)
+        task.add_done_callback(functools.partial(self._on_done, channel_id))
+        return task
+
+    def _on_done(self, channel_id: int, task: asyncio.Task):
+        self._pending.discard(task)
+        if self._tails.get(channel_id) is task:
+            del self._tails[channel_id]
+
+    @staticmethod
+    async def _run_after(previous: Optional[asyncio.Task], work: Callable[[], Awaitable]):
+        if previous is not None:
+            # Whether it has succeeded or not
+            await asyncio.wait({previous})
+        return await work()
+
+    async def _deliver(self, formatter_responses: List[FormatterResponse], original_message: discord.Message):
+        try:
+            await self._send_parts(formatter_responses, original_message)
+        except Exception:
+            logger.exception(f"Error occurs during delivering a response in channel {original_message.channel.id}")
+
+    async def _send_parts(self, formatter_responses: List[FormatterResponse], original_message: discord.Message):
+        if len(formatter_responses) == 0:
+            return
+        texts = [response.value for response in formatter_responses if response.type == FormatterResponseType.NORMAL]
+        embeds = [response.value for response in formatter_responses if response.type == FormatterResponseType.EMBED]
+        views = [response.value for response in formatter_responses if response.type == FormatterResponseType.VIEW]
+        large_texts = [response.value for response in formatter_responses if response.type == FormatterResponseType.LARGE_TEXT]
+        embed = embeds[0] if len(embeds) > 0 else None
+        view = views[0] if len(views) > 0 else None
+        large_text = large_texts[0] if len(large_texts) > 0 else None
+
+        if large_text is not None:
+            # Counted as sent, a rendered response may be sent again by /replay
+            LARGE_TEXT_FALLBACKS.inc()
+            await self._send(original_message, reply=True, file=text_attachment_file(large_text), embed=embed, view=view)
+            return
+
+        if len(texts) == 0:
+            return
+        # Build every message first, then send them back to back in order, each as soon as the bucket of the channel allows
+        messages_params = [{'content': text} for text in texts]
+        messages_params[-1]['embed'] = embed
+        messages_params[-1]['view'] = view
+        for index, params in enumerate(messages_params):
+            await self._send(original_message, reply=index == 0, **params)
+
+    async def _send(self, original_message: discord.Message, reply: bool = False, **params) -> discord.Message:
+        channel = original_message.channel
+        await self._acquire("send", channel.id)
+        try:
+            with DISCORD_SEND_SECONDS.time(method="send"), TRACER.span("discord_send", method="send"):
+                if reply:
+                    return await original_message.reply(mention_author=False, **params)
+                return await channel.send(**params)
+        except discord.HTTPException as e:
+            self._on_http_exception(e, "send", channel.id)
+            raise
+
+    async def _acquire(self, route: str, channel_id: int):
+        key = (route, channel_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_CHANNEL_BUCKETS:
+                for idle_key in [k for k, b in self._buckets.items() if b.full]:
+                    del self._buckets[idle_key]
+            bucket = TokenBucket(CHANNEL_REQUESTS_PER_SECOND, CHANNEL_BURST)
+            self._buckets[key] = bucket
+        with TRACER.span("discord_pace", route=route):
+            await bucket.acquire()
+
+    def _on_http_exception(self, e: discord.HTTPException, route: str, channel_id: int):
+        if e.status == 429:
+            # The pacing is ahead of Discord's view of the bucket. Start again from an empty bucket.
+            bucket = self._buckets.get((route, channel_id))
+            if bucket is not None:
+                bucket.drain()
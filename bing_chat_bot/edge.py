@@ -0,0 +1,51 @@
+import sys
+from types import ModuleType
+
+# Conversation styles of Bing Chat. EdgeGPT accepts their names in place of ConversationStyle.
+CONVERSATION_STYLES = ("creative", "balanced", "precise")
+
+
+def import_edge_gpt() -> ModuleType:
+    """
+    Import EdgeGPT on first use. It pulls in rich, prompt_toolkit and BingImageCreator and takes most of the startup time.
+    """
+    import EdgeGPT
+    return EdgeGPT
+
+
+def is_not_allowed_to_access(e: BaseException) -> bool:
+    # If EdgeGPT has not been imported yet, e cannot come from it
+    edge_gpt = sys.modules.get('EdgeGPT')
+    return edge_gpt is not None and isinstance(e, edge_gpt.NotAllowedToAccess)
+
+
+def get_conversation_ids(chatbot) -> dict:
+    """
+    The identifiers which continue the conversation of chatbot in another process
+    """
+    request = chatbot.chat_hub.request
+    return {
+        'conversation_id': request.conversation_id,
+        'client_id': request.client_id,
+        'conversation_signature': request.conversation_signature,
+        'invocation_id': request.invocation_id
+    }
+
+
+def restore_chatbot(conversation_ids: dict, cookies: list):
+    """
+    Continue a conversation from its identifiers, without a new handshake
+    """
+    edge_gpt = import_edge_gpt()
+    conversation = edge_gpt._Conversation(async_mode=True)
+    conversation.struct = {
+        'conversationId': conversation_ids['conversation_id'],
+        'clientId': conversation_ids['client_id'],
+        'conversationSignature': conversation_ids['conversation_signature'],
+        'result': {'value': 'Success', 'message': None}
+    }
+    chatbot = edge_gpt.Chatbot.__new__(edge_gpt.Chatbot)
+    chatbot.proxy = None
+    chatbot.chat_hub = edge_gpt._ChatHub(conversation, cookies=cookies)
+    chatbot.chat_hub.request.invocation_id = conversation_ids['invocation_id']
+    return chatbot
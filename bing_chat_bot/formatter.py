@@ -1,26 +1,43 @@
+import bisect
 import logging
-import operator
 import re
+import sys
 from enum import Enum, auto
-from functools import reduce
-from itertools import compress
-from typing import List
+from typing import List, Optional, Tuple
 
 import discord
 
 from .bing import BingBotResponse
+from .metrics import FORMAT_SECONDS, SPLIT_FAILURES
+from .tracing import TRACER
 
 # Text length greater than which value, the text needs to be split
 TEXT_SPLIT_THRESHOLD = 2000
 
+# A paragraph break is preferred over a later line break only if it fills the chunk at least to this ratio
+SPLIT_PARAGRAPH_MIN_FILL = 0.5
+
+# Appended to a chunk which ends inside a code block
+CODE_BLOCK_CLOSING = "\n```"
+
+# The language of a code block, which is re-opened with the code block
+_CODE_BLOCK_LANGUAGE_PATTERN = re.compile(r"[\w+#.-]*")
+
+_LINK_PATTERN = re.compile(r"\[([0-9]+\.\ \S+)\]\(([\S]+)\)")
+_CITATION_PATTERN = re.compile(r'\[(\d+)\]: (\S+) \"([^\"]+)\"')
+
+# Size of a RenderedResponse and its tuples besides the strings in them
+_RENDERED_RESPONSE_OVERHEAD_BYTES = 256
+
 logger = logging.getLogger(__name__)
 
 
 class FormatterOptions:
-    def __init__(self, show_embed: bool = True, show_links: bool = False, show_limits: bool = True):
+    def __init__(self, show_embed: bool = True, show_links: bool = False, show_limits: bool = True, stream_response: bool = False):
         self.show_citations: bool = show_embed
         self.show_links: bool = show_links
         self.show_limits: bool = show_limits
+        self.stream_response: bool = stream_response
 
 
 class FormatterResponseType(Enum):
@@ -44,6 +61,31 @@ class FormatterResponse:
         return self._obj
 
 
+class RenderedResponse:
+    """
+    A response after the parsing and splitting of the formatter, from which its Discord messages are built without repeating them
+    """
+    __slots__ = ('chunks', 'large_text', 'citations', 'citations_text', 'links', 'links_text', 'limits', 'suggested_responses', 'size')
+
+    def __init__(self, chunks, large_text, citations, citations_text, links, links_text, limits, suggested_responses):
+        self.chunks: Tuple[str, ...] = chunks
+        # If set, chunks holds the whole text, which is sent as a text file
+        self.large_text: bool = large_text
+        # (number, url, title) of the citations, or the raw citations text if they cannot be parsed
+        self.citations: Tuple[Tuple[str, str, str], ...] = citations
+        self.citations_text: Optional[str] = citations_text
+        # (hostname, url) of the links, or the raw links text if they cannot be parsed
+        self.links: Tuple[Tuple[str, str], ...] = links
+        self.links_text: Optional[str] = links_text
+        # (current, max) number of messages in the conversation
+        self.limits: Optional[Tuple[int, int]] = limits
+        self.suggested_responses: Tuple[str, ...] = suggested_responses
+        # Approximate memory held by the response in bytes
+        self.size: int = _RENDERED_RESPONSE_OVERHEAD_BYTES + sum(
+            sys.getsizeof(text) for text in (*chunks, *(part for citation in citations for part in citation), citations_text or "",
+                                             *(part for link in links for part in link), links_text or "", *suggested_responses))
+
+
 class SuggestedResponsesView(discord.ui.View):
     def __init__(self, suggested_responses: List[str], callback_generator=None):
         super().__init__()
@@ -59,29 +101,92 @@ class Formatter:
         self._suggested_response_callback_generator = suggested_response_callback_generator
 
     def format_message(self, bing_resp: BingBotResponse) -> List[FormatterResponse]:
-        results = []
+        return self.format_rendered(self.render(bing_resp))
+
+    def render(self, bing_resp: BingBotResponse) -> RenderedResponse:
+        """
+        Parse the citations and links of a response and split its text. The result does not depend on the formatter options.
+        """
+        with FORMAT_SECONDS.time(), TRACER.span("format", length=len(bing_resp.message)):
+            chunks, large_text = self._render_text(bing_resp)
+            citations, citations_text = self._render_citations(bing_resp)
+            links, links_text = self._render_links(bing_resp)
+            limits = None
+            if bing_resp.current_conversation_num is not None and bing_resp.max_conversation_num is not None:
+                limits = (bing_resp.current_conversation_num, bing_resp.max_conversation_num)
+            return RenderedResponse(chunks, large_text, citations, citations_text, links, links_text, limits,
+                                    tuple(bing_resp.suggested_responses or ()))
+
+    def format_rendered(self, rendered: RenderedResponse) -> List[FormatterResponse]:
+        """
+        Build the Discord messages of a rendered response with the current formatter options
+        """
+        with TRACER.span("build_messages"):
+            return self._build_messages(rendered)
+
+    def _build_messages(self, rendered: RenderedResponse) -> List[FormatterResponse]:
+        if rendered.large_text:
+            results = [FormatterResponse(FormatterResponseType.LARGE_TEXT, rendered.chunks[0])]
+        else:
+            results = [FormatterResponse(FormatterResponseType.NORMAL, chunk) for chunk in rendered.chunks]
 
-        results.extend(self._format_response_text(bing_resp))
-        embed = self._format_response_embed(bing_resp)
+        embed = self._format_response_embed(rendered)
         if embed is not None:
             results.append(FormatterResponse(FormatterResponseType.EMBED, embed))
 
-        view = self._format_response_view(bing_resp)
+        view = self._format_response_view(rendered)
         if view is not None:
             results.append(FormatterResponse(FormatterResponseType.VIEW, view))
 
         return results
 
-    def _format_response_text(self, bing_resp: BingBotResponse) -> List[FormatterResponse]:
+    @staticmethod
+    def format_partial_text(text: str) -> List[str]:
+        """
+        Split a partial response which is still being generated. Unlike the final response, it never falls back to a text file.
+        """
+        with TRACER.span("split", length=len(text), partial=True):
+            return Formatter.split_text(text, TEXT_SPLIT_THRESHOLD)
+
+    @staticmethod
+    def _render_text(bing_resp: BingBotResponse) -> Tuple[Tuple[str, ...], bool]:
         if len(bing_resp.message) <= TEXT_SPLIT_THRESHOLD:
-            return [FormatterResponse(FormatterResponseType.NORMAL, bing_resp.message)]
+            return (bing_resp.message,), False
         try:
-            return [FormatterResponse(FormatterResponseType.NORMAL, text_segment) for text_segment in Formatter.split_text(bing_resp.message, TEXT_SPLIT_THRESHOLD)]
+            with TRACER.span("split", length=len(bing_resp.message)) as span:
+                chunks = tuple(Formatter.split_text(bing_resp.message, TEXT_SPLIT_THRESHOLD))
+                span.set(chunks=len(chunks))
+            return chunks, False
         except RuntimeError as ex:
             print("Failed to split text for response. Use text file to send.")
-            return [FormatterResponse(FormatterResponseType.LARGE_TEXT, bing_resp.message)]
+            SPLIT_FAILURES.inc()
+            return (bing_resp.message,), True
+
+    @staticmethod
+    def _render_citations(bing_resp: BingBotResponse) -> Tuple[Tuple[Tuple[str, str, str], ...], Optional[str]]:
+        citations = bing_resp.citations
+        if citations is None:
+            return (), None
+        matches = _CITATION_PATTERN.findall(citations)
+        if len(matches) > 0:
+            return tuple(matches), None
+        if len(citations) > 4095:
+            citations = "Citations cannot show: too long"
+        return (), citations
 
-    def _format_response_embed(self, bing_resp: BingBotResponse):
+    @staticmethod
+    def _render_links(bing_resp: BingBotResponse) -> Tuple[Tuple[Tuple[str, str], ...], Optional[str]]:
+        links = bing_resp.links
+        if not links:
+            return (), None
+        matches = _LINK_PATTERN.findall(links)
+        if len(matches) > 0:
+            return tuple(matches), None
+        if len(links) > 1023:
+            links = "Message cannot show: too long."
+        return (), links
+
+    def _format_response_embed(self, rendered: RenderedResponse):
         has_value = False
 
         embed = discord.Embed()
@@ -89,89 +194,191 @@ class Formatter:
         embed.description = ""
 
         # Citations
-        if bing_resp.citations is not None and self._formatter_options.show_citations:
+        if (len(rendered.citations) > 0 or rendered.citations_text is not None) and self._formatter_options.show_citations:
             has_value = True
-            self._format_response_embed_add_citations(bing_resp, embed)
+            if len(rendered.citations) > 0:
+                embed.title = "Citations"
+                embed.description = "".join(f"[[{citation_num}] {title}]({url})\n\n" for citation_num, url, title in rendered.citations)
+            else:
+                embed.description = rendered.citations_text
 
         # Links
-        if bing_resp.links and self._formatter_options.show_links:
+        if (len(rendered.links) > 0 or rendered.links_text is not None) and self._formatter_options.show_links:
             has_value = True
-            self._format_response_embed_add_links(bing_resp, embed)
+            if len(rendered.links) > 0:
+                for hostname, url in rendered.links:
+                    embed.add_field(name=hostname, value=f"[Link]({url})")
+            else:
+                embed.add_field(name="Links", value=rendered.links_text)
 
         # Throttling Limit
-        if bing_resp.current_conversation_num is not None and bing_resp.max_conversation_num is not None and self._formatter_options.show_limits:
+        if rendered.limits is not None and self._formatter_options.show_limits:
             has_value = True
-            embed.add_field(name="Limit",
-                            value=f"({bing_resp.current_conversation_num}/{bing_resp.max_conversation_num})")
+            embed.add_field(name="Limit", value=f"({rendered.limits[0]}/{rendered.limits[1]})")
 
         return embed if has_value else None
 
-    def _format_response_embed_add_links(self, bing_resp: BingBotResponse, embed: discord.Embed):
-        links = bing_resp.links
-        if links is None or len(links) == 0:
-            return
-
-        pattern = re.compile(r"\[([0-9]+\.\ \S+)\]\(([\S]+)\)")
-        matches = re.findall(pattern, links)
-        if matches is None or len(matches) == 0:
-            if len(links) > 1023:
-                links = "Message cannot show: too long."
-            embed.add_field(name="Links", value=links)
-        else:
-            for match in matches:
-                hostname, url = match
-                embed.add_field(name=hostname, value=f"[Link]({url})")
-
-    def _format_response_embed_add_citations(self, bing_resp, embed):
-        citations = bing_resp.citations
-        if citations is None or len(citations) == 0:
-            return
-
-        pattern = re.compile(r'\[(\d+)\]: (\S+) \"([^\"]+)\"')
-        matches = re.findall(pattern, citations)
-        if matches is None or len(matches) == 0:
-            if len(citations) > 4095:
-                citations = "Citations cannot show: too long"
-            embed.description = citations
-        else:
-            embed.title = "Citations"
-            for match in matches:
-                citation_num, url, title = match
-                embed.description += f"[[{citation_num}] {title}]({url})\n\n"
-
-    def _format_response_view(self, bing_resp: BingBotResponse):
-        if bing_resp.suggested_responses is None or len(bing_resp.suggested_responses) == 0:
+    def _format_response_view(self, rendered: RenderedResponse):
+        if len(rendered.suggested_responses) == 0:
             return None
-        return SuggestedResponsesView(bing_resp.suggested_responses, self._suggested_response_callback_generator)
+        return SuggestedResponsesView(list(rendered.suggested_responses), self._suggested_response_callback_generator)
 
     @staticmethod
     def split_text(text, limit_length: int) -> List[str]:
-        try:
-            return Formatter._split_text_by_delimiter(text.strip(), limit_length, "\n\n")
-        except RuntimeError as e:
-            return Formatter._split_text_by_delimiter(text.strip(), limit_length, "\n")
-
-    @staticmethod
-    def _split_text_by_delimiter(text, limit_length: int, delimiter) -> List[str]:
         """
-        Recursively split large texts
+        Split large texts into chunks no longer than limit_length in a single pass.
+        Chunks break at the last paragraph break that fits, unless it leaves the chunk mostly empty and a later line break fits. Code blocks are kept whole if possible,
+        otherwise the code block is closed at the end of the chunk and re-opened at the start of the next chunk.
+        A line longer than the limit, even a fence line, is cut.
         """
+        text = text.strip()
         if len(text) <= limit_length:
             return [text]
-        # Find code block ranges. You don't want to split in the middle of code blocks
-        code_block_inds = [m.start(0) for m in re.finditer('```', text)]
-        code_block_ranges = [i for i in zip(code_block_inds[::2], code_block_inds[1::2])]
-
-        # Find all the delimiters. They are possible split point
-        line_break_ind = [m.start() for m in re.finditer(delimiter, text)]
-
-        # A valid break point should 1) not in a code block, and 2) smaller than the limit_length
-        line_break_validity = [reduce(operator.and_, [True] + [i < start or i >= end for (start, end) in code_block_ranges] + [i < limit_length])
-                               for i in line_break_ind]
-        valid_line_break = [i for i in compress(line_break_ind, line_break_validity)]
-        if len(valid_line_break) == 0:
-            raise RuntimeError("Cannot find a valid line break")
-        break_point_ind = max(valid_line_break)
-
-        # Recursively call this method until all blocks are split
-        return [text[:break_point_ind].strip()] + Formatter.split_text(text[break_point_ind:].strip(), limit_length)
+
+        # Find code block ranges once. A range starts at the opening fence and ends at the closing fence.
+        fence_inds = [m.start() for m in re.finditer('```', text)]
+        code_block_starts = fence_inds[:len(fence_inds) // 2 * 2:2]
+        code_block_ends = fence_inds[1::2]
+
+        # Find all the line breaks once, and classify them as possible break points
+        paragraph_breaks, line_breaks, code_line_breaks = [], [], []
+        block = 0
+        opened_block = -1
+        for m in re.finditer('\n', text):
+            i = m.start()
+            while block < len(code_block_ends) and code_block_ends[block] <= i:
+                block += 1
+            if block < len(code_block_starts) and code_block_starts[block] <= i:
+                if opened_block == block:
+                    code_line_breaks.append(i)
+                else:
+                    # The break right after the opening fence line would leave an empty code block in the chunk
+                    opened_block = block
+            elif text.startswith('\n\n', i):
+                paragraph_breaks.append(i)
+            else:
+                line_breaks.append(i)
+
+        chunks = []
+        start = 0
+        # The fence line (e.g. "```python") to re-open at the start of the chunk, if the chunk starts inside a code block
+        reopen_fence = ""
+        while True:
+            prefix_length = len(reopen_fence) + 1 if reopen_fence else 0
+            if len(text) - start + prefix_length <= limit_length:
+                Formatter._append_chunk(chunks, reopen_fence, text[start:], "")
+                return chunks
+
+            bound = start + limit_length - prefix_length
+            break_point = Formatter._last_break_point(paragraph_breaks, start, bound)
+            if break_point is None or break_point - start < (bound - start) * SPLIT_PARAGRAPH_MIN_FILL:
+                line_break_point = Formatter._last_break_point(line_breaks, start, bound)
+                if line_break_point is not None and (break_point is None or line_break_point > break_point):
+                    break_point = line_break_point
+            if break_point is not None:
+                Formatter._append_chunk(chunks, reopen_fence, text[start:break_point], "")
+                reopen_fence = ""
+                start = break_point + 1
+                continue
+
+            # No break point outside code blocks. Split the code block and leave room for the closing fence.
+            bound -= len(CODE_BLOCK_CLOSING)
+            break_point = Formatter._last_break_point(code_line_breaks, start, bound)
+            if break_point is None:
+                break_point = Formatter._hard_break_point(text, fence_inds, code_block_starts, code_block_ends, bound)
+                if break_point <= start:
+                    # The chunk starts with a fence line longer than the limit. Cut the line instead, and leave room to keep it apart from the closing fence.
+                    break_point = bound - 1
+                    fence = bisect.bisect_right(fence_inds, break_point) - 1
+                    language_end = _CODE_BLOCK_LANGUAGE_PATTERN.match(text, fence_inds[fence] + 3).end()
+                    if fence_inds[fence] > start and break_point < language_end:
+                        break_point = fence_inds[fence]
+                    elif break_point < language_end:
+                        reopen_fence = Formatter._cut_fence_language(chunks, reopen_fence, text, start, break_point, language_end,
+                                                                     code_block_starts, code_block_ends, limit_length)
+                        start = language_end
+                        continue
+            # The chunk ends inside a code block if the break point is after its opening fence, up to its closing fence
+            block = bisect.bisect_left(code_block_starts, break_point) - 1
+            if block >= 0 and break_point <= code_block_ends[block]:
+                suffix = CODE_BLOCK_CLOSING
+                fence_line_end = Formatter._fence_line_end(text, code_block_starts[block], code_block_ends[block])
+                if code_block_starts[block] >= start and not text[fence_line_end:break_point].strip():
+                    # The code in the chunk is only whitespace. Keep the fence line apart from the closing fence.
+                    suffix = "\n" + CODE_BLOCK_CLOSING
+                Formatter._append_chunk(chunks, reopen_fence, text[start:break_point], suffix)
+                reopen_fence = Formatter._reopen_fence(text, code_block_starts[block], code_block_ends[block], limit_length)
+            else:
+                # A single line longer than the limit outside code blocks, or a break right before a code block
+                Formatter._append_chunk(chunks, reopen_fence, text[start:break_point], "")
+                reopen_fence = ""
+            start = break_point + 1 if text.startswith('\n', break_point) else break_point
+
+    @staticmethod
+    def _hard_break_point(text: str, fence_inds: List[int], code_block_starts: List[int], code_block_ends: List[int], bound: int) -> int:
+        """
+        Break a line at bound, but never inside a fence or the opening fence line of a code block
+        """
+        fence = bisect.bisect_right(fence_inds, bound) - 1
+        if fence >= 0 and bound < _CODE_BLOCK_LANGUAGE_PATTERN.match(text, fence_inds[fence] + 3).end():
+            bound = fence_inds[fence]
+        block = bisect.bisect_right(code_block_starts, bound) - 1
+        if block >= 0 and bound <= code_block_ends[block] and bound <= Formatter._fence_line_end(text, code_block_starts[block], code_block_ends[block]):
+            bound = code_block_starts[block]
+        return bound
+
+    @staticmethod
+    def _fence_line_end(text: str, block_start: int, block_end: int) -> int:
+        fence_line_end = text.find('\n', block_start, block_end)
+        return block_end if fence_line_end < 0 else fence_line_end
+
+    @staticmethod
+    def _reopen_fence(text: str, block_start: int, block_end: int, limit_length: int) -> str:
+        """
+        The fence to re-open a code block with. It keeps the language of the code block if it is short, but not the code on the fence line.
+        """
+        language = text[block_start + 3:Formatter._fence_line_end(text, block_start, block_end)]
+        if _CODE_BLOCK_LANGUAGE_PATTERN.fullmatch(language) and len(language) <= limit_length // 4:
+            return "```" + language
+        return "```"
+
+    @staticmethod
+    def _cut_fence_language(chunks: List[str], reopen_fence: str, text: str, start: int, break_point: int, language_end: int,
+                            code_block_starts: List[int], code_block_ends: List[int], limit_length: int) -> str:
+        """
+        Cut the word right after the fence at the start of the chunk, e.g. "```" followed by a word longer than the limit.
+        Every piece of the word stays right after a fence, in its own code block if needed, and the last piece is returned as the fence to start the next chunk with.
+        """
+        block = bisect.bisect_left(code_block_starts, break_point) - 1
+        in_code_block = block >= 0 and break_point <= code_block_ends[block]
+        Formatter._append_chunk(chunks, reopen_fence, text[start:break_point], CODE_BLOCK_CLOSING if in_code_block else "")
+        language = text[break_point:language_end]
+        piece_length = limit_length - 3 - len(CODE_BLOCK_CLOSING)
+        while len(language) > limit_length // 4:
+            chunks.append("```" + language[:piece_length] + CODE_BLOCK_CLOSING)
+            language = language[piece_length:]
+        if in_code_block:
+            return "```" + language
+        # Outside code blocks, the last piece is closed right away
+        return "```" + language + CODE_BLOCK_CLOSING if language else ""
+
+    @staticmethod
+    def _last_break_point(break_points: List[int], start: int, bound: int) -> Optional[int]:
+        """
+        The last break point in (start, bound]
+        """
+        index = bisect.bisect_right(break_points, bound) - 1
+        if index < 0 or break_points[index] <= start:
+            return None
+        return break_points[index]
+
+    @staticmethod
+    def _append_chunk(chunks: List[str], reopen_fence: str, text: str, suffix: str):
+        if reopen_fence:
+            # Keep the indentation of the code
+            text = reopen_fence + "\n" + text.lstrip("\n").rstrip()
+        else:
+            text = text.strip()
+        text += suffix
+        if len(text) > 0:
+            chunks.append(text)
@@ -0,0 +1,350 @@
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Sequence, Set, Tuple
+
+from aiohttp import WSMsgType, web
+
+from .bing import DEFAULT_STYLE, BingBot, BingBotResponse
+from .edge import CONVERSATION_STYLES
+from .scheduler import RequestScheduler, ScheduledRequest
+from .session import SessionManager
+from .tracing import TRACER
+
+# The gateway only listens on the loopback interface unless another host is given
+GATEWAY_HOST = "127.0.0.1"
+
+# Maximum number of prompts in one batch request
+GATEWAY_MAX_BATCH = 50
+
+# The client of the requests if no token is required
+DEFAULT_CLIENT = "default"
+
+# How often a request in progress checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def session_key(session_id: str) -> int:
+    """
+    The session key of a gateway conversation. Keys are negative, so that they never collide with Discord channel ids.
+    """
+    digest = hashlib.sha256(session_id.encode('utf-8')).digest()
+    return -1 - int.from_bytes(digest[:8], 'big') // 2
+
+
+def response_to_json(bing_resp: BingBotResponse) -> dict:
+    return dict(vars(bing_resp))
+
+
+class GatewayCall:
+    """
+    A gateway request going through the scheduler. The scheduler's handler runs it,
+    and the client side reads (False, partial text) events, then one (True, final value) event.
+    """
+
+    def __init__(self, work: Callable[['GatewayCall'], Awaitable[None]]):
+        self._work = work
+        self.events: asyncio.Queue = asyncio.Queue()
+        # The request of the call in the scheduler
+        self.request: Optional[ScheduledRequest] = None
+        self._finished = False
+
+    def cancel(self):
+        """
+        The client has gone away. If the call has not started yet, the scheduler drops it and gives its tokens back.
+        """
+        if self.request is not None:
+            self.request.cancelled = True
+
+    def emit(self, final: bool, value):
+        self._finished = self._finished or final
+        self.events.put_nowait((final, value))
+
+    async def run(self):
+        try:
+            await self._work(self)
+        except Exception:
+            logger.exception("Error occurs during handling a gateway request")
+        finally:
+            if not self._finished:
+                self.emit(True, BingBotResponse(False, 'Error: No response from Bing Chat Bot'))
+
+
+class InvalidRequest(ValueError):
+    pass
+
+
+class Gateway:
+    """
+    Expose the conversations over HTTP and WebSocket for clients other than Discord.
+    Requests go through the same scheduler as the Discord messages, so they share the in-flight cap and the token buckets.
+    Each token is a client with a quota of its own, which is the guild bucket of the scheduler.
+
+        POST   /v1/conversations/{session_id}/messages  {"text": ..., "style": ..., "stream": false}
+        DELETE /v1/conversations/{session_id}
+        POST   /v1/batch                                 {"prompts": [...], "style": ...}
+        GET    /v1/ws                                    {"id": ..., "session": ..., "text": ..., "style": ..., "stream": true}
+    """
+
+    def __init__(self,
+                 sessions: SessionManager,
+                 scheduler: RequestScheduler,
+                 tokens: Optional[Sequence[str]] = None,
+                 max_batch: int = GATEWAY_MAX_BATCH):
+        self._sessions = sessions
+        self._scheduler = scheduler
+        # token -> the client of the token. Any request is from the default client if no token is given.
+        self._clients: Optional[Dict[str, str]] = None
+        if tokens:
+            self._clients = {token: hashlib.sha256(token.encode('utf-8')).hexdigest()[:12] for token in tokens}
+        self._max_batch = max_batch
+        self._runner: Optional[web.AppRunner] = None
+        # Each prompt of a batch has a queue of its own, so that the prompts run concurrently
+        self._batch_ids = itertools.count(1)
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._authenticate, self._cancel_on_disconnect])
+        app.router.add_post("/v1/conversations/{session_id}/messages", self._handle_message)
+        app.router.add_delete("/v1/conversations/{session_id}", self._handle_reset)
+        app.router.add_post("/v1/batch", self._handle_batch)
+        app.router.add_get("/v1/ws", self._handle_websocket)
+        return app
+
+    async def start(self, port: int, host: str = GATEWAY_HOST):
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Serving the gateway on {host}:{port}")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _authenticate(self, request: web.Request, handler):
+        if self._clients is None:
+            request['client'] = DEFAULT_CLIENT
+            return await handler(request)
+        authorization = request.headers.get("Authorization", "")
+        for token, client in self._clients.items():
+            if hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {token}".encode('utf-8')):
+                request['client'] = client
+                return await handler(request)
+        return web.json_response({'error': "Unauthorized"}, status=401)
+
+    @web.middleware
+    async def _cancel_on_disconnect(self, request: web.Request, handler):
+        # This aiohttp version keeps running the handler of a client which has gone away. Cancelling it cancels the client's calls.
+        watcher = asyncio.get_running_loop().create_task(self._watch_disconnect(request, asyncio.current_task()))
+        try:
+            return await handler(request)
+        finally:
+            watcher.cancel()
+
+    @staticmethod
+    async def _watch_disconnect(request: web.Request, handler_task: asyncio.Task):
+        while request.transport is not None and not request.transport.is_closing():
+            await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+        handler_task.cancel()
+
+    async def _handle_message(self, request: web.Request) -> web.StreamResponse:
+        try:
+            text, style, stream = self._parse_message(await self._read_json(request))
+        except InvalidRequest as e:
+            return web.json_response({'error': str(e)}, status=400)
+        call = self._submit_message(request['client'], request.match_info['session_id'], text, style, stream)
+        if call is None:
+            return self._too_many_requests()
+        try:
+            if not stream:
+                _, bing_resp = await self._next_final(call)
+                return web.json_response(response_to_json(bing_resp))
+            response = web.StreamResponse(headers={'Content-Type': "application/x-ndjson"})
+            await response.prepare(request)
+            while True:
+                final, value = await call.events.get()
+                line = {'response': response_to_json(value)} if final else {'partial': value}
+                await response.write(json.dumps(line).encode('utf-8') + b"\n")
+                if final:
+                    break
+            await response.write_eof()
+            return response
+        finally:
+            call.cancel()
+
+    async def _handle_reset(self, request: web.Request) -> web.Response:
+        key = session_key(request.match_info['session_id'])
+
+        async def reset(call: GatewayCall):
+            with self._sessions.use(key) as session:
+                try:
+                    await session.bing.reset(reason="command")
+                finally:
+                    self._sessions.save(session)
+            call.emit(True, None)
+
+        call = self._submit(GatewayCall(reset), key, request['client'], request.match_info['session_id'], "")
+        if call is None:
+            return self._too_many_requests()
+        try:
+            await self._next_final(call)
+        finally:
+            call.cancel()
+        return web.Response(status=204)
+
+    async def _handle_batch(self, request: web.Request) -> web.Response:
+        try:
+            payload = await self._read_json(request)
+            prompts = payload.get('prompts')
+            if not isinstance(prompts, list) or len(prompts) == 0 or not all(isinstance(p, str) and p for p in prompts):
+                raise InvalidRequest("prompts must be a non-empty list of strings")
+            if len(prompts) > self._max_batch:
+                raise InvalidRequest(f"At most {self._max_batch} prompts are allowed in a batch")
+            style = self._parse_style(payload)
+        except InvalidRequest as e:
+            return web.json_response({'error': str(e)}, status=400)
+
+        calls = []
+        for text in prompts:
+            # Every prompt starts a conversation of its own. The prompts wait for the tokens of the client's quota like other requests.
+            channel_key = ("batch", next(self._batch_ids))
+            call = self._submit(GatewayCall(lambda c, text=text: self._converse_detached(c, text, style)), channel_key, request['client'], channel_key, text)
+            if call is None:
+                for submitted in calls:
+                    submitted.cancel()
+                return self._too_many_requests()
+            calls.append(call)
+        try:
+            results = await asyncio.gather(*[self._next_final(call) for call in calls])
+        finally:
+            for call in calls:
+                call.cancel()
+        return web.json_response({'responses': [response_to_json(bing_resp) for _, bing_resp in results]})
+
+    async def _handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client = request['client']
+        tasks: Set[asyncio.Task] = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                task = asyncio.get_running_loop().create_task(self._handle_websocket_message(ws, client, msg.data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return ws
+
+    async def _handle_websocket_message(self, ws: web.WebSocketResponse, client: str, data: str):
+        call_id = None
+        try:
+            payload = json.loads(data)
+            if not isinstance(payload, dict):
+                raise InvalidRequest("The message must be a JSON object")
+            call_id = payload.get('id')
+            session_id = payload.get('session')
+            if not isinstance(session_id, str) or session_id == "":
+                raise InvalidRequest("session must be a non-empty string")
+            text, style, stream = self._parse_message(payload)
+        except ValueError as e:
+            await ws.send_json({'id': call_id, 'error': str(e), 'status': 400})
+            return
+
+        call = self._submit_message(client, session_id, text, style, stream)
+        if call is None:
+            await ws.send_json({'id': call_id, 'error': "Too many requests", 'status': 429})
+            return
+        try:
+            while True:
+                final, value = await call.events.get()
+                await ws.send_json({'id': call_id, 'response': response_to_json(value)} if final else {'id': call_id, 'partial': value})
+                if final:
+                    break
+        finally:
+            call.cancel()
+
+    def _submit_message(self, client: str, session_id: str, text: str, style: Optional[str], stream: bool) -> Optional[GatewayCall]:
+        key = session_key(session_id)
+        return self._submit(GatewayCall(lambda call: self._converse(call, key, text, style, stream)), key, client, session_id, text)
+
+    def _submit(self, call: GatewayCall, channel_key, client: str, user, text: str) -> Optional[GatewayCall]:
+        """
+        Queue the call in the scheduler, or return None if the queue of the conversation is full
+        """
+        trace = TRACER.start_trace(channel=channel_key, client=client)
+        # Gateway requests expect an answer each, so they are never merged
+        call.request = ScheduledRequest(channel_key, ("gateway", client), ("gateway", client, user), text, context=call, trace=trace, mergeable=False)
+        if not self._scheduler.submit(call.request).accepted:
+            return None
+        return call
+
+    async def _converse(self, call: GatewayCall, key: int, text: str, style: Optional[str], stream: bool):
+        with self._sessions.use(key) as session:
+            try:
+                if style is not None and style != session.bing.get_bot_status().current_style:
+                    await session.bing.switch_style(style)
+                await self._converse_on(call, session.bing, text, stream)
+            finally:
+                self._sessions.save(session)
+
+    async def _converse_detached(self, call: GatewayCall, text: str, style: Optional[str]):
+        bing = self._sessions.create_detached(style or DEFAULT_STYLE)
+        try:
+            await self._converse_on(call, bing, text, False)
+        finally:
+            await bing.close()
+
+    @staticmethod
+    async def _converse_on(call: GatewayCall, bing: BingBot, text: str, stream: bool):
+        if not stream:
+            call.emit(True, await bing.converse(text))
+            return
+        async for final, value in bing.converse_stream(text):
+            call.emit(final, value)
+
+    @staticmethod
+    async def _next_final(call: GatewayCall) -> Tuple[bool, object]:
+        while True:
+            final, value = await call.events.get()
+            if final:
+                return final, value
+
+    @staticmethod
+    async def _read_json(request: web.Request) -> dict:
+        try:
+            payload = await request.json()
+        except ValueError as e:
+            raise InvalidRequest(f"The body is not valid JSON: {e}") from e
+        if not isinstance(payload, dict):
+            raise InvalidRequest("The body must be a JSON object")
+        return payload
+
+    @classmethod
+    def _parse_message(cls, payload: dict) -> Tuple[str, Optional[str], bool]:
+        text = payload.get('text')
+        if not isinstance(text, str) or text.strip() == "":
+            raise InvalidRequest("text must be a non-empty string")
+        stream = payload.get('stream', False)
+        if not isinstance(stream, bool):
+            raise InvalidRequest("stream must be a boolean")
+        return text, cls._parse_style(payload), stream
+
+    @staticmethod
+    def _parse_style(payload: dict) -> Optional[str]:
+        style = payload.get('style')
+        if style is not None and style not in CONVERSATION_STYLES:
+            raise InvalidRequest(f"style must be one of {', '.join(CONVERSATION_STYLES)}")
+        return style
+
+    @staticmethod
+    def _too_many_requests() -> web.Response:
+        return web.json_response({'error': "Too many requests are waiting in this conversation"}, status=429)
@@ -0,0 +1,95 @@
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from .formatter import RenderedResponse
+
+# Number of recent responses kept per channel for /replay
+HISTORY_RESPONSES_PER_CHANNEL = 10
+
+# Memory budget of all the kept responses. The oldest responses of any channel are dropped first.
+HISTORY_MAX_BYTES = 16 * 1024 * 1024
+
+
+class ResponseHistoryStats:
+    def __init__(self, channels, entries, size_bytes, max_bytes, evictions):
+        self.channels: int = channels
+        self.entries: int = entries
+        self.size_bytes: int = size_bytes
+        self.max_bytes: int = max_bytes
+        self.evictions: int = evictions
+
+
+class HistoryEntry:
+    __slots__ = ('rendered', 'channel_id', 'message_id')
+
+    def __init__(self, rendered: RenderedResponse, channel_id: int, message_id: int):
+        self.rendered = rendered
+        # The message which the response replied to
+        self.channel_id = channel_id
+        self.message_id = message_id
+
+
+class ResponseHistory:
+    """
+    The last rendered responses of each channel, so that a replay is sent without parsing and splitting them again
+    """
+
+    def __init__(self, responses_per_channel: int = HISTORY_RESPONSES_PER_CHANNEL, max_bytes: int = HISTORY_MAX_BYTES):
+        self._responses_per_channel = responses_per_channel
+        self._max_bytes = max_bytes
+        # channel key -> entries, oldest first
+        self._channels: Dict[int, Deque[HistoryEntry]] = {}
+        # (channel key, entry) of all the channels in the order they were added. Entries dropped by the per-channel limit stay until they are reached.
+        self._order: Deque[Tuple[int, HistoryEntry]] = deque()
+        self._entries = 0
+        self._size = 0
+        self._evictions = 0
+
+    def add(self, channel_key: int, rendered: RenderedResponse, channel_id: int, message_id: int):
+        entries = self._channels.setdefault(channel_key, deque())
+        entry = HistoryEntry(rendered, channel_id, message_id)
+        entries.append(entry)
+        self._order.append((channel_key, entry))
+        self._entries += 1
+        self._size += rendered.size
+        if len(entries) > self._responses_per_channel:
+            self._drop(entries.popleft())
+        while self._size > self._max_bytes and len(self._order) > 0:
+            self._evict_oldest()
+        if len(self._order) > 2 * self._entries + self._responses_per_channel:
+            self._order = deque((key, entry) for key, entry in self._order if self._is_live(key, entry))
+
+    def get(self, channel_key: int, index: int = 1) -> Optional[HistoryEntry]:
+        """
+        The index-th latest response of the channel, 1 being the latest
+        """
+        entries = self._channels.get(channel_key)
+        if entries is None or index < 1 or index > len(entries):
+            return None
+        return entries[-index]
+
+    def __len__(self) -> int:
+        return self._entries
+
+    def get_stats(self) -> ResponseHistoryStats:
+        return ResponseHistoryStats(len(self._channels), self._entries, self._size, self._max_bytes, self._evictions)
+
+    def _evict_oldest(self):
+        channel_key, entry = self._order.popleft()
+        if not self._is_live(channel_key, entry):
+            return
+        entries = self._channels[channel_key]
+        entries.popleft()
+        if len(entries) == 0:
+            del self._channels[channel_key]
+        self._drop(entry)
+        self._evictions += 1
+
+    def _is_live(self, channel_key: int, entry: HistoryEntry) -> bool:
+        # The oldest live entry of a channel is always the first of its entries
+        entries = self._channels.get(channel_key)
+        return entries is not None and any(e is entry for e in entries)
+
+    def _drop(self, entry: HistoryEntry):
+        self._entries -= 1
+        self._size -= entry.rendered.size
@@ -1,34 +1,124 @@
+import asyncio
 import datetime
 import logging
-from io import BytesIO
-from typing import List, Optional
+import time
+from typing import List, Optional, Tuple
 
 import discord
 from discord import MessageType
 
-from .bing import BingBot, BingBotResponse
-from .formatter import Formatter, FormatterResponse, FormatterOptions, FormatterResponseType
+from .bing import BingBotOptions, BingBotResponse, BingBotStatus, create_chatbot
+from .cache import ResponseCache
+from .command_sync import CommandSyncState, load_registered_command_ids, restore_command_ids, sync_commands_if_changed
+from .coordinator import CoordinatedProfilePool
+from .delivery import MessageDelivery
+from .formatter import Formatter, FormatterResponse, FormatterOptions, RenderedResponse
+from .gateway import GATEWAY_HOST, Gateway, GatewayCall
+from .history import ResponseHistory
+from .metrics import COMPONENT_STATS, PROFILE_CONVERSATIONS, PROFILE_COOLING_DOWN, PROFILE_IN_FLIGHT, PROFILE_THROTTLING_USAGE
+from .prefetch import SuggestionPrefetcher
+from .profile import IN_FLIGHT_REQUESTS_PER_PROFILE, Profile, ProfilePool
+from .reload import ConfigReloader
+from .scheduler import RequestScheduler, ScheduledRequest
+from .session import BingSession, SessionManager
+from .startup import STARTUP_TIMER
+from .store import SessionStore
+from .streaming import StreamingReply
+from .tracing import TRACER
+from .warmer import ConversationWarmer
 
 AUTO_RESET_DIFF_SECONDS = 30 * 60
 
+# Prefix of the stored settings which record whether a channel has opted in to prefetching
+PREFETCH_CHANNEL_SETTING = "prefetch_channel:"
+
 logger = logging.getLogger(__name__)
 
 
 class BotManager:
-    def __init__(self, bing_bot_cookie_paths):
-        self.bing = BingBot(bing_bot_cookie_paths)
+    def __init__(self,
+                 bing_bot_cookie_paths,
+                 response_cache_styles: Optional[List[str]] = None,
+                 bing_options: Optional[BingBotOptions] = None,
+                 profile_pool: Optional[ProfilePool] = None,
+                 max_in_flight: Optional[int] = None,
+                 command_state_path: Optional[str] = None,
+                 session_store_path: Optional[str] = None,
+                 config_path: Optional[str] = None):
+        # In the sharded mode, the pool is shared with the other worker processes through the coordinator
+        self.profiles = profile_pool if profile_pool is not None else ProfilePool(bing_bot_cookie_paths)
+        # The response cache is opt-in, and only applies to the listed conversation styles
+        self.response_cache = ResponseCache(response_cache_styles) if response_cache_styles else None
+        # Conversations are created ahead of time, so that resets and switches are instant
+        self.warmer = ConversationWarmer(self.profiles, create_chatbot)
+        # Changed cookie files and config file are applied without a restart
+        self.reloader = ConfigReloader(self.profiles, bing_bot_cookie_paths, config_path,
+                                       on_profile_changed=self._on_profile_changed, on_config_changed=self._on_config_changed)
+        # Shared by every conversation, so that reloaded settings apply to them at once
+        self._bing_options = bing_options if bing_options is not None else BingBotOptions()
+        # Sessions and settings survive restarts if a store is configured
+        self.store = SessionStore(session_store_path) if session_store_path is not None else None
+        self.sessions = SessionManager(self.profiles, self.response_cache, self.warmer, bing_options=self._bing_options, store=self.store)
+        # Without a fixed cap, it follows the number of active profiles as the cookie files are reloaded
+        self._max_in_flight = max_in_flight
+        # Discord messages and gateway requests share the capacity
+        self._scheduler = RequestScheduler(self._handle_request, max_in_flight=self._get_max_in_flight())
         self._formatter_options = FormatterOptions()
-
-        self._bing_resp_cache = None
-        self._original_message_cache: Optional[discord.Message] = None
+        # The config file sets the defaults, and the toggles saved in the store override them
+        self._apply_config(self.reloader.config, {})
+        if self.store is not None:
+            vars(self._formatter_options).update(self.store.load_setting("formatter_options") or {})
+        # Suggested responses are answered ahead of the click in the channels which opted in
+        self.prefetcher = SuggestionPrefetcher(self.profiles, self._scheduler)
+        if self.store is not None:
+            self.prefetcher.enable_channels(int(name[len(PREFETCH_CHANNEL_SETTING):])
+                                            for name, enabled in self.store.load_settings(PREFETCH_CHANNEL_SETTING).items() if enabled)
+        if isinstance(self.profiles, CoordinatedProfilePool):
+            # The formatter toggles are global, so a toggle in one worker applies to the shards of the others too
+            self.profiles.on_setting_changed = self._on_setting_changed
+        self._delivery = MessageDelivery()
+        # Recent responses of each channel as they were rendered, for /replay
+        self.history = ResponseHistory()
 
         self._suggested_response_callback_generator = None
+        self._bot: Optional[discord.Bot] = None
+        self.gateway: Optional[Gateway] = None
+        # If set, the application commands are only synced with Discord when they have changed since the last sync
+        self._command_sync_state = CommandSyncState(command_state_path) if command_state_path is not None else None
+        self._command_lookup_task: Optional[asyncio.Task] = None
+        self._started = False
+        self._register_metrics()
 
     def initialize(self, bot: discord.Bot):
+        self._bot = bot
+
+        @bot.event
+        async def on_connect():
+            # Replaces discord.Bot.on_connect, which syncs the commands on every connect
+            if not self._started:
+                STARTUP_TIMER.mark("connect")
+            if bot.auto_sync_commands:
+                if self._command_sync_state is None:
+                    await bot.sync_commands()
+                else:
+                    await sync_commands_if_changed(bot, self._command_sync_state)
+            elif self._command_sync_state is None or not restore_command_ids(bot, self._command_sync_state):
+                # Another worker syncs the commands. Look up their ids in the background, as they may still be changing.
+                if self._command_lookup_task is None or self._command_lookup_task.done():
+                    self._command_lookup_task = asyncio.get_running_loop().create_task(load_registered_command_ids(bot))
+            if not self._started:
+                STARTUP_TIMER.mark("command sync")
+
         @bot.event
         async def on_ready():
             logger.info(f"{bot.user} is ready and online!")
-            await self._switch_bot_status(bot)
+            self.warmer.start()
+            self.reloader.start()
+            self.sessions.start()
+            await self._switch_bot_status(bot, self.sessions.get_default_status())
+            if not self._started:
+                self._started = True
+                STARTUP_TIMER.mark("ready")
 
         self._add_commands(bot)
         self._listen_on_message_event(bot)
@@ -36,6 +126,64 @@ class BotManager:
 
         self._formatter = Formatter(formatter_options=self._formatter_options, suggested_response_callback_generator=self._suggested_response_callback_generator)
 
+    def _on_profile_changed(self, profile: Profile):
+        # Ready conversations were created with the old cookies
+        self.warmer.discard_profile(profile)
+        self._scheduler.set_max_in_flight(self._get_max_in_flight())
+
+    def _get_max_in_flight(self) -> int:
+        if self._max_in_flight is not None:
+            return self._max_in_flight
+        return sum(1 for profile in self.profiles.profiles if not profile.retired) * IN_FLIGHT_REQUESTS_PER_PROFILE
+
+    def _on_config_changed(self, config: dict, previous: dict):
+        if self._apply_config(config, previous):
+            # Otherwise the saved toggles would override the new defaults after a restart
+            self._save_formatter_options()
+
+    def _apply_config(self, config: dict, previous: dict) -> bool:
+        """
+        Apply the settings of the config file which have changed since previous. Removed settings keep their current values.
+        Return whether a formatter setting has changed.
+        """
+        for name in ('request_timeout_seconds', 'hedge_percentile', 'carry_over_turns_left'):
+            if name in config and (name not in previous or config[name] != previous[name]):
+                setattr(self._bing_options, name, config[name])
+        if 'guild_weights' in config and config['guild_weights'] != previous.get('guild_weights'):
+            self._scheduler.set_guild_weights({int(guild_id): weight for guild_id, weight in config['guild_weights'].items()})
+        previous_formatter = previous.get('formatter', {})
+        changed = {name: value for name, value in config.get('formatter', {}).items()
+                   if name not in previous_formatter or value != previous_formatter[name]}
+        vars(self._formatter_options).update(changed)
+        return len(changed) > 0
+
+    def _register_metrics(self):
+        pool = self.profiles
+        PROFILE_THROTTLING_USAGE.set_function(lambda: [
+            sample
+            for profile in pool.profiles
+            for sample in [({'profile': profile.index + 1, 'stat': 'max'}, max(profile.conversation_usages.values(), default=0)),
+                           ({'profile': profile.index + 1, 'stat': 'sum'}, sum(profile.conversation_usages.values()))]
+        ])
+        PROFILE_IN_FLIGHT.set_function(lambda: [({'profile': profile.index + 1}, profile.in_flight) for profile in pool.profiles])
+        PROFILE_CONVERSATIONS.set_function(lambda: [({'profile': profile.index + 1}, len(profile.conversation_usages)) for profile in pool.profiles])
+        PROFILE_COOLING_DOWN.set_function(lambda: [({'profile': profile.index + 1}, int(profile.is_cooling_down())) for profile in pool.profiles])
+
+        def collect_component_stats():
+            components = [('sessions', self.sessions.get_stats()), ('warmer', self.warmer.get_stats()), ('scheduler', self._scheduler.get_stats())]
+            if self.response_cache is not None:
+                components.append(('response_cache', self.response_cache.get_stats()))
+            if self.store is not None:
+                components.append(('session_store', self.store.get_stats()))
+            components.append(('prefetch', self.prefetcher.get_stats()))
+            components.append(('history', self.history.get_stats()))
+            components.append(('reloader', self.reloader.get_stats()))
+            return [({'component': component, 'stat': name}, value)
+                    for component, stats in components
+                    for name, value in vars(stats).items()]
+
+        COMPONENT_STATS.set_function(collect_component_stats)
+
     def _add_commands(self, bot: discord.Bot):
         self._add_command_reset(bot)
         self._add_command_style(bot)
@@ -47,7 +195,10 @@ class BotManager:
         # Reset the conversation and start a new one
         @bot.command(name='reset', description="Reset the conversation")
         async def reset(ctx: discord.ApplicationContext):
-            await self.bing.reset()
+            with self.sessions.use(ctx.channel_id) as session:
+                self.prefetcher.cancel(session.key)
+                await session.bing.reset()
+                self.sessions.save(session)
             await ctx.respond("Reset the conversion")
 
     def _add_command_style(self, bot: discord.Bot):
@@ -69,9 +220,12 @@ class BotManager:
     def _add_command_switch_profile(self, bot):
         @bot.command(name='profile', description="Switch the profile")
         async def profile(ctx: discord.ApplicationContext):
-            await self.bing.switch_profile()
-            bing_status = self.bing.get_bot_status()
-            await self._switch_bot_status(bot)
+            with self.sessions.use(ctx.channel_id) as session:
+                self.prefetcher.cancel(session.key)
+                await session.bing.switch_profile()
+                self.sessions.save(session)
+                bing_status = session.bing.get_bot_status()
+            await self._switch_bot_status(bot, bing_status)
             await ctx.respond(f"Switch to profile: {bing_status.profile_index}/{bing_status.profile_total_num}")
             logger.info(f"Switch to profile: {bing_status.profile_index}/{bing_status.profile_total_num}")
 
@@ -80,34 +234,87 @@ class BotManager:
 
         @toggle_command_group.command(desciption="Toggle if showing citations")
         async def citations(ctx: discord.ApplicationContext):
-            self._formatter_options.show_citations = not self._formatter_options.show_citations
+            self._toggle_formatter_option("show_citations")
             await ctx.respond(f"Toggle configuration - showing citations. Current value: {self._formatter_options.show_citations}")
 
         @toggle_command_group.command(description="Toggle if showing links")
         async def links(ctx: discord.ApplicationContext):
-            self._formatter_options.show_links = not self._formatter_options.show_links
+            self._toggle_formatter_option("show_links")
             await ctx.respond(f"Toggle configuration - showing links. Current value: {self._formatter_options.show_links}")
 
         @toggle_command_group.command(description="Toggle if showing limits")
         async def limits(ctx: discord.ApplicationContext):
-            self._formatter_options.show_limits = not self._formatter_options.show_limits
+            self._toggle_formatter_option("show_limits")
             await ctx.respond(f"Toggle configuration - showing limits. Current value: {self._formatter_options.show_limits}")
 
+        @toggle_command_group.command(description="Toggle if streaming responses while they are generated")
+        async def streaming(ctx: discord.ApplicationContext):
+            self._toggle_formatter_option("stream_response")
+            await ctx.respond(f"Toggle configuration - streaming responses. Current value: {self._formatter_options.stream_response}")
+
+        @toggle_command_group.command(description="Toggle if prefetching suggested responses in this channel")
+        async def prefetch(ctx: discord.ApplicationContext):
+            enabled = not self.prefetcher.is_enabled(ctx.channel_id)
+            self.prefetcher.set_enabled(ctx.channel_id, enabled)
+            if self.store is not None:
+                # One setting per channel, as the channels of the other shards are toggled by other workers
+                self.store.save_setting(f"{PREFETCH_CHANNEL_SETTING}{ctx.channel_id}", enabled)
+            await ctx.respond(f"Toggle configuration - prefetching suggested responses in this channel. Current value: {enabled}")
+
     def _add_command_replay(self, bot: discord.Bot):
         @bot.command(name='replay', description="Re-present the last message")
-        async def replay(ctx: discord.ApplicationContext):
-            if self._bing_resp_cache is None or self._original_message_cache is None:
+        async def replay(ctx: discord.ApplicationContext,
+                         index: discord.Option(int, "Which previous answer to re-present, 1 being the last", min_value=1, default=1)):
+            entry = self.history.get(ctx.channel_id, index)
+            if entry is not None:
+                await ctx.respond("Re-presenting the last message" if index == 1 else f"Re-presenting the answer #{index} from the last")
+                # The entry belongs to this channel, which py-cord gives a type even when it is not cached
+                original_message = ctx.channel.get_partial_message(entry.message_id)
+                await self._respond_messages(self._formatter.format_rendered(entry.rendered), original_message)
+                return
+            if index > 1:
                 await ctx.respond("No message to replay")
+                return
+            # The history is not kept across restarts, but the last response of the session is
+            session = self.sessions.find(ctx.channel_id)
+            if session is not None and session.original_message_cache is None and session.original_message_ids is not None:
+                # Restored after a restart, reply to the message by its id. The session belongs to this channel.
+                _, message_id = session.original_message_ids
+                session.original_message_cache = ctx.channel.get_partial_message(message_id)
+            if session is None or session.bing_resp_cache is None or session.original_message_cache is None:
+                await ctx.respond("No message to replay")
+                return
             await ctx.respond("Re-presenting the last message")
-            await self._format_and_respond(self._bing_resp_cache, original_message=self._original_message_cache)
+            await self._format_and_respond(session.bing_resp_cache, original_message=session.original_message_cache)
+
+    def _toggle_formatter_option(self, name: str):
+        value = not getattr(self._formatter_options, name)
+        setattr(self._formatter_options, name, value)
+        self._save_formatter_options()
+        if isinstance(self.profiles, CoordinatedProfilePool):
+            self.profiles.publish_setting("formatter_options", {name: value})
+
+    def _on_setting_changed(self, name: str, value):
+        """
+        Apply a setting toggled in another worker. That worker has already saved it.
+        """
+        if name == "formatter_options":
+            vars(self._formatter_options).update(value)
+
+    def _save_formatter_options(self):
+        if self.store is not None:
+            self.store.save_setting("formatter_options", dict(vars(self._formatter_options)))
 
     async def switch_chat_style(self, ctx: discord.ApplicationContext, bot: discord.Bot, style: str):
-        await self.bing.switch_style(style)
+        with self.sessions.use(ctx.channel_id) as session:
+            self.prefetcher.cancel(session.key)
+            await session.bing.switch_style(style)
+            self.sessions.save(session)
+            bing_status = session.bing.get_bot_status()
         await ctx.respond(f"Switch chat style to {style.capitalize()}")
-        await self._switch_bot_status(bot)
+        await self._switch_bot_status(bot, bing_status)
 
-    async def _switch_bot_status(self, bot: discord.Bot):
-        bing_status = self.bing.get_bot_status()
+    async def _switch_bot_status(self, bot: discord.Bot, bing_status: BingBotStatus):
         status_name = f"{bing_status.current_style.capitalize()}, Profile: ({bing_status.profile_index}/{bing_status.profile_total_num})"
         await bot.change_presence(activity=discord.Game(status_name))
 
@@ -121,54 +328,134 @@ class BotManager:
                 # Should not respond system message
                 return
             logger.info("Received a msg from user.")
-            if self._original_message_cache is not None:
-                # If the new message comes more than AUTO_RESET_DIFF_SECONDS after the previous one, reset the conversation
-                time_diff = message.created_at - self._original_message_cache.created_at
-                time_diff_seconds = time_diff.total_seconds()
-                if time_diff_seconds >= AUTO_RESET_DIFF_SECONDS:
-                    await self.bing.reset()
-                    logger.info(f"Reset previous bing conversation: {time_diff_seconds} since last message.")
-            ctx: discord.ApplicationContext = await bot.get_application_context(message)
+            # The user has written something else than a suggested response
+            self.prefetcher.cancel(message.channel.id)
+            result = self._scheduler.submit(self._create_scheduled_request(message.content, message, message.author))
+            if not result.accepted:
+                await message.reply("Too many messages are waiting in this channel. Please try again later.", mention_author=False)
+            elif result.position > 0 and not result.merged:
+                await message.reply(f"Your message is queued. Position in the queue: {result.position}", mention_author=False)
+
+        @bot.event
+        async def on_typing(channel: discord.abc.Messageable, user: discord.abc.User, when: datetime.datetime):
+            if not user.bot:
+                # Typing means that the next message is probably not a suggested response
+                self.prefetcher.cancel(channel.id)
+
+    @staticmethod
+    def _create_scheduled_request(text: str, message: discord.Message, author: discord.abc.User) -> ScheduledRequest:
+        guild_id = message.guild.id if message.guild is not None else None
+        trace = TRACER.start_trace(channel=message.channel.id)
+        if trace is not None:
+            # From the message being created on Discord to the request being submitted
+            created_at = message.created_at.timestamp()
+            TRACER.record(trace, "receive", created_at, max(0.0, time.time() - created_at), message=message.id)
+        return ScheduledRequest(message.channel.id, guild_id, author.id, text, context=message, trace=trace)
+
+    async def start_gateway(self, port: int, host: str = GATEWAY_HOST, tokens: Optional[List[str]] = None):
+        """
+        Serve the conversations to clients other than Discord. Without Discord, this is what starts the background tasks.
+        """
+        self.gateway = Gateway(self.sessions, self._scheduler, tokens=tokens)
+        await self.gateway.start(port, host)
+        self.warmer.start()
+        self.reloader.start()
+        self.sessions.start()
+
+    async def close(self):
+        """
+        Stop the gateway and the background tasks, send the queued replies, and write the sessions and settings which are not stored yet
+        """
+        if self.gateway is not None:
+            await self.gateway.close()
+        await self._delivery.close()
+        await self.reloader.close()
+        await self.prefetcher.close()
+        await self.sessions.close()
+        await self.warmer.close()
+
+    async def _handle_request(self, request: ScheduledRequest):
+        """
+        The handler of the requests dispatched by the scheduler
+        """
+        queued = time.monotonic() - request.created_at
+        TRACER.record(request.trace, "queue", time.time() - queued, queued, merged=request.merged_count)
+        with TRACER.activate(request.trace), TRACER.span("handle", length=len(request.text)):
+            if isinstance(request.context, GatewayCall):
+                await request.context.run()
+            else:
+                await self._handle(self._bot, request)
+
+    async def _handle(self, bot: discord.Bot, request: ScheduledRequest):
+        message: discord.Message = request.context
+        with self.sessions.use(request.channel_key) as session:
+            # If the new message comes more than AUTO_RESET_DIFF_SECONDS after the previous one in the same channel, reset the conversation
+            time_diff_seconds = session.seconds_since_last_message(message.created_at)
+            if time_diff_seconds is not None and time_diff_seconds >= AUTO_RESET_DIFF_SECONDS:
+                await session.bing.reset(reason="idle")
+                logger.info(f"Reset previous bing conversation: {time_diff_seconds} since last message.")
+            try:
+                await self._converse_and_respond(bot, session, request)
+            finally:
+                self.sessions.save(session)
+
+    async def _converse_and_respond(self, bot: discord.Bot, session: BingSession, request: ScheduledRequest):
+        text = request.text
+        original_message: discord.Message = request.context
+        ctx: discord.ApplicationContext = await bot.get_application_context(original_message)
+        prefetched_resp = await self.prefetcher.take(session, text)
+        if prefetched_resp is not None:
+            rendered = self._cache_response(session, prefetched_resp, original_message)
+            self._prefetch(session, prefetched_resp, request)
+            # Sent in the background, so that the next request can start while the parts go out
+            self._delivery.queue(self._formatter.format_rendered(rendered), original_message)
+            return
+
+        if not self._formatter_options.stream_response:
+            async with ctx.typing():
+                bing_resp: BingBotResponse = await session.bing.converse(text)
+            rendered = self._cache_response(session, bing_resp, original_message)
+            self._prefetch(session, bing_resp, request)
+            self._delivery.queue(self._formatter.format_rendered(rendered), original_message)
+            return
+
+        streaming_reply = StreamingReply(original_message, self._delivery)
+        bing_resp = BingBotResponse(False, 'Error: No response from Bing Chat Bot')
+        try:
             async with ctx.typing():
-                bing_resp: BingBotResponse = await self.bing.converse(message.content)
-            self._bing_resp_cache = bing_resp
-            self._original_message_cache = message
-            await self._format_and_respond(bing_resp, original_message=message)
+                async for final, value in session.bing.converse_stream(text):
+                    if final:
+                        bing_resp = value
+                    else:
+                        await streaming_reply.update(value)
+        except Exception:
+            # Do not leave a half-written answer in the channel
+            await streaming_reply.abort()
+            raise
+        rendered = self._cache_response(session, bing_resp, original_message)
+        self._prefetch(session, bing_resp, request)
+        formatter_responses = self._formatter.format_rendered(rendered)
+        if not await streaming_reply.finish(formatter_responses):
+            self._delivery.queue(formatter_responses, original_message)
+
+    def _prefetch(self, session: BingSession, bing_resp: BingBotResponse, request: ScheduledRequest):
+        # On the quota of the guild and the user who asked
+        self.prefetcher.prefetch(session, bing_resp, request.guild_key, request.user_key)
+
+    def _cache_response(self, session: BingSession, bing_resp: BingBotResponse, message: discord.Message) -> RenderedResponse:
+        session.bing_resp_cache = bing_resp
+        session.original_message_cache = message
+        session.last_message_time = message.created_at
+        rendered = self._formatter.render(bing_resp)
+        self.history.add(session.key, rendered, message.channel.id, message.id)
+        return rendered
 
     async def _format_and_respond(self, bing_resp: BingBotResponse, original_message: discord.message):
         formatter_responses = self._formatter.format_message(bing_resp)
         await self._respond_messages(formatter_responses, original_message)
 
     async def _respond_messages(self, formatter_responses: List[FormatterResponse], original_message: discord.Message):
-        if len(formatter_responses) == 0:
-            return
-        texts = [response.value for response in formatter_responses if response.type == FormatterResponseType.NORMAL]
-        embeds = [response.value for response in formatter_responses if response.type == FormatterResponseType.EMBED]
-        views = [response.value for response in formatter_responses if response.type == FormatterResponseType.VIEW]
-        large_texts = [response.value for response in formatter_responses if response.type == FormatterResponseType.LARGE_TEXT]
-        embed = embeds[0] if len(embeds) > 0 else None
-        view = views[0] if len(views) > 0 else None
-        large_text = large_texts[0] if len(large_texts) > 0 else None
-
-        if large_text is not None:
-            params = {
-                'file': discord.File(BytesIO(large_text.encode('UTF-8')), filename="response.md"),
-                'embed': embed,
-                'view': view
-            }
-            await original_message.reply(mention_author=False, **params)
-        else:
-            for index, obj in enumerate(texts):
-                params = {
-                    'content': obj
-                }
-                if index == len(texts) - 1:
-                    params['embed'] = embed
-                    params['view'] = view
-                if index == 0:
-                    await original_message.reply(mention_author=False, **params)
-                else:
-                    await original_message.channel.send(**params)
+        await self._delivery.deliver(formatter_responses, original_message)
 
     def _create_suggested_response_callback_generator(self, bot: discord.Bot):
         """
@@ -185,23 +472,41 @@ class BotManager:
                 response_content = button.label
                 await interaction.response.send_message(f"From user: **{response_content}**")
                 message = await interaction.original_response()
-                ctx: discord.ApplicationContext = await bot.get_application_context(message)
-                async with ctx.typing():
-                    bing_resp: BingBotResponse = await self.bing.converse(response_content)
-                self._bing_resp_cache = bing_resp
-                self._original_message_cache = message
-                await self._format_and_respond(bing_resp, original_message=message)
+                result = self._scheduler.submit(self._create_scheduled_request(response_content, message, interaction.user))
+                if not result.accepted:
+                    await interaction.followup.send("Too many messages are waiting in this channel. Please try again later.")
 
             return _handle_suggested_response
 
         return callback_generator
 
 
-async def get_bot(bing_bot_cookie_paths) -> discord.Bot:
+async def get_bot(bing_bot_cookie_paths,
+                  response_cache_styles: Optional[List[str]] = None,
+                  bing_options: Optional[BingBotOptions] = None,
+                  profile_pool: Optional[ProfilePool] = None,
+                  shard_ids: Optional[List[int]] = None,
+                  shard_count: Optional[int] = None,
+                  max_in_flight: Optional[int] = None,
+                  command_state_path: Optional[str] = None,
+                  session_store_path: Optional[str] = None,
+                  config_path: Optional[str] = None,
+                  gateway_port: Optional[int] = None,
+                  gateway_host: str = GATEWAY_HOST,
+                  gateway_tokens: Optional[List[str]] = None) -> Tuple[discord.Bot, BotManager]:
     intents = discord.Intents.all()
-    bot = discord.Bot(intents=intents)
-
-    bot_manager = BotManager(bing_bot_cookie_paths=bing_bot_cookie_paths)
+    if shard_ids is not None:
+        # Application commands are global, the worker with shard 0 keeps them in sync
+        bot = discord.AutoShardedBot(intents=intents, shard_ids=shard_ids, shard_count=shard_count, auto_sync_commands=0 in shard_ids)
+    else:
+        bot = discord.Bot(intents=intents)
+
+    bot_manager = BotManager(bing_bot_cookie_paths=bing_bot_cookie_paths, response_cache_styles=response_cache_styles, bing_options=bing_options,
+                             profile_pool=profile_pool, max_in_flight=max_in_flight, command_state_path=command_state_path,
+                             session_store_path=session_store_path, config_path=config_path)
     bot_manager.initialize(bot)
+    if gateway_port is not None:
+        await bot_manager.start_gateway(gateway_port, gateway_host, gateway_tokens)
+    STARTUP_TIMER.mark("initialize")
 
-    return bot
+    return bot, bot_manager
@@ -0,0 +1,218 @@
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# The metrics endpoint has no authentication, so it only listens on the loopback interface unless another host is given
+METRICS_HOST = "127.0.0.1"
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _label_values(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"] + self._render_samples()
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0)
+
+    def _render_samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], Iterable[Tuple[Dict[str, str], float]]]] = None
+
+    def set(self, value: float, **labels):
+        self._values[self._label_values(labels)] = value
+
+    def set_function(self, function: Callable[[], Iterable[Tuple[Dict[str, str], float]]]):
+        """
+        Compute the value when the metrics are collected. The function returns (labels, value) pairs.
+        """
+        self._function = function
+
+    def _render_samples(self) -> List[str]:
+        values = dict(self._values)
+        if self._function is not None:
+            try:
+                values.update((self._label_values(labels), value) for labels, value in self._function())
+            except Exception:
+                logger.exception(f"Error occurs during collecting metric {self.name}")
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # label values -> (bucket counts, sum, count)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        bucket_counts, total, count = self._values.get(key) or ([0] * len(self._buckets), 0.0, 0)
+        for index, bound in enumerate(self._buckets):
+            if value <= bound:
+                bucket_counts[index] += 1
+                break
+        self._values[key] = (bucket_counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self) -> List[str]:
+        lines = []
+        for key, (bucket_counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets, bucket_counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class LatencyTracker:
+    """
+    Keep the most recent latencies to compute percentiles, e.g. for the hedging threshold
+    """
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self._samples) == 0:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Stage timings
+BING_REQUEST_SECONDS = REGISTRY.register(Histogram("bing_chat_bot_bing_request_seconds", "Round trip of a Bing request", ["mode"]))
+FORMAT_SECONDS = REGISTRY.register(Histogram("bing_chat_bot_format_seconds", "Time spent formatting a Bing response"))
+DISCORD_SEND_SECONDS = REGISTRY.register(Histogram("bing_chat_bot_discord_send_seconds", "Latency of a Discord message send or edit", ["method"]))
+LOOP_LAG_SECONDS = REGISTRY.register(Histogram("bing_chat_bot_loop_lag_seconds", "How late the event loop ran a timer",
+                                                buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)))
+
+# Recent Bing latencies, which the hedging threshold follows
+BING_LATENCY = LatencyTracker()
+BING_LATENCY_RECENT_SECONDS = REGISTRY.register(Gauge("bing_chat_bot_bing_latency_recent_seconds", "Percentiles of the recent Bing round trips", ["quantile"]))
+BING_LATENCY_RECENT_SECONDS.set_function(lambda: [({'quantile': p / 100}, BING_LATENCY.percentile(p))
+                                                  for p in (50, 90, 95, 99) if len(BING_LATENCY) > 0])
+
+# Events
+RESETS = REGISTRY.register(Counter("bing_chat_bot_resets_total", "Conversations reset", ["reason"]))
+SPLIT_FAILURES = REGISTRY.register(Counter("bing_chat_bot_split_failures_total", "Responses which cannot be split into Discord messages"))
+LARGE_TEXT_FALLBACKS = REGISTRY.register(Counter("bing_chat_bot_large_text_total", "Responses sent as a text file"))
+ERRORS = REGISTRY.register(Counter("bing_chat_bot_errors_total", "Failed requests", ["reason"]))
+PREFETCH_REQUESTS = REGISTRY.register(Counter("bing_chat_bot_prefetch_requests_total", "Bing requests sent to prefetch suggested responses"))
+PREFETCH_RESULTS = REGISTRY.register(Counter("bing_chat_bot_prefetch_results_total", "What became of prefetched suggested responses", ["outcome"]))
+LOOP_BLOCKS = REGISTRY.register(Counter("bing_chat_bot_loop_blocks_total", "Times a callback blocked the event loop longer than the threshold"))
+HEDGES = REGISTRY.register(Counter("bing_chat_bot_hedged_requests_total", "Requests sent again on another profile, by which request won", ["outcome"]))
+
+# Current state, collected when scraped
+PROFILE_THROTTLING_USAGE = REGISTRY.register(Gauge("bing_chat_bot_profile_throttling_usage",
+                                                   "numUserMessagesInConversation / maxNumUserMessagesInConversation of the live conversations of a profile",
+                                                   ["profile", "stat"]))
+PROFILE_IN_FLIGHT = REGISTRY.register(Gauge("bing_chat_bot_profile_in_flight", "Bing requests in flight on a profile", ["profile"]))
+PROFILE_CONVERSATIONS = REGISTRY.register(Gauge("bing_chat_bot_profile_conversations", "Live conversations on a profile", ["profile"]))
+PROFILE_COOLING_DOWN = REGISTRY.register(Gauge("bing_chat_bot_profile_cooling_down", "1 if the profile is cooling down", ["profile"]))
+COMPONENT_STATS = REGISTRY.register(Gauge("bing_chat_bot_component_stat", "Counters and sizes of the sessions, scheduler and response cache",
+                                          ["component", "stat"]))
+
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST, registry: MetricsRegistry = REGISTRY) -> web.AppRunner:
+    """
+    Serve the metrics in the Prometheus text format at /metrics
+    """
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on {host}:{port}/metrics")
+    return runner
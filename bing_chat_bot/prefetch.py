@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from typing import Dict, Hashable, Iterable, Optional, Set
+
+from .bing import BingBot, BingBotResponse, SpeculativeResponse
+from .metrics import PREFETCH_REQUESTS, PREFETCH_RESULTS
+from .profile import ProfileLease, ProfilePool
+from .scheduler import RequestScheduler
+from .session import BingSession
+
+# Number of suggested responses prefetched after an answer. Bing lists the most likely ones first.
+PREFETCH_SUGGESTIONS_PER_CHANNEL = 2
+
+# Prefetched responses are dropped after this, and their conversations closed
+PREFETCH_TTL_SECONDS = 2 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class SuggestionPrefetcherStats:
+    def __init__(self, channels, in_flight, spent, hits):
+        self.channels: int = channels
+        self.in_flight: int = in_flight
+        self.spent: int = spent
+        self.hits: int = hits
+        # A field rather than a property, so that it is exported with the other stats
+        self.hit_rate: float = hits / spent if spent > 0 else 0.0
+
+
+class _ChannelSpeculation:
+    def __init__(self, bing: BingBot, tasks: Dict[str, asyncio.Task], expire_handle: asyncio.TimerHandle):
+        self.bing = bing
+        # suggested response -> task speculating on it
+        self.tasks = tasks
+        self.expire_handle = expire_handle
+
+
+class SuggestionPrefetcher:
+    """
+    Send the suggested responses of an answer to forked conversations on idle profiles, so that a click on a suggestion
+    is answered at once. Only channels which opted in are prefetched. Speculation is cancelled when the user sends
+    or starts typing something else, and expires after a while.
+    Speculation only starts in the scheduler's spare capacity, and draws from the token buckets of the guild and the user.
+    """
+
+    def __init__(self,
+                 profile_pool: ProfilePool,
+                 scheduler: RequestScheduler,
+                 suggestions_per_channel: int = PREFETCH_SUGGESTIONS_PER_CHANNEL,
+                 ttl_seconds: float = PREFETCH_TTL_SECONDS):
+        self._pool = profile_pool
+        self._scheduler = scheduler
+        self._suggestions_per_channel = suggestions_per_channel
+        self._ttl_seconds = ttl_seconds
+
+        self._enabled_channels: Set[int] = set()
+        self._speculations: Dict[int, _ChannelSpeculation] = {}
+
+        self._spent = 0
+        self._hits = 0
+
+    def is_enabled(self, channel_key: int) -> bool:
+        return channel_key in self._enabled_channels
+
+    def set_enabled(self, channel_key: int, enabled: bool):
+        if enabled:
+            self._enabled_channels.add(channel_key)
+        else:
+            self._enabled_channels.discard(channel_key)
+            self.cancel(channel_key)
+
+    def enable_channels(self, channel_keys: Iterable[int]):
+        self._enabled_channels.update(channel_keys)
+
+    def prefetch(self, session: BingSession, bing_resp: BingBotResponse, guild_key: Optional[Hashable], user_key: Hashable):
+        """
+        Start prefetching the suggested responses of the answer the session has just received, on the quota of the guild and the user
+        who asked. Speculation on the previous answer is dropped.
+        """
+        self.cancel(session.key, outcome="unused")
+        if session.key not in self._enabled_channels or not bing_resp.success or not bing_resp.suggested_responses:
+            return
+        loop = asyncio.get_running_loop()
+        tasks = {}
+        for text in bing_resp.suggested_responses[:self._suggestions_per_channel]:
+            # Speculation only uses capacity which nothing else is using
+            if not self._scheduler.take_speculative_tokens(guild_key, user_key):
+                break
+            # The profile counts as busy at once, so that the next speculation goes to another one
+            lease = self._pool.acquire_idle()
+            if lease is None:
+                break
+            PREFETCH_REQUESTS.inc()
+            self._spent += 1
+            task = loop.create_task(self._speculate(session.bing, text, lease))
+            # A task cancelled before it has started never runs the code releasing the lease. Releasing twice does nothing.
+            task.add_done_callback(lambda t, lease=lease: lease.release() if t.cancelled() or t.exception() is not None or t.result() is None else None)
+            tasks[text] = task
+        if len(tasks) > 0:
+            self._speculations[session.key] = _ChannelSpeculation(session.bing, tasks, loop.call_later(self._ttl_seconds, self.cancel, session.key, "expired"))
+
+    async def take(self, session: BingSession, text: str) -> Optional[BingBotResponse]:
+        """
+        If text has been prefetched for the session, continue the session on the prefetched conversation and return its answer.
+        A prefetch which is still running is waited for.
+        """
+        speculation = self._speculations.pop(session.key, None)
+        if speculation is None:
+            return None
+        speculation.expire_handle.cancel()
+        # If the session has been replaced since, its speculation is of no use
+        task = speculation.tasks.pop(text, None) if speculation.bing is session.bing else None
+        self._close(speculation, "unused")
+        if task is None:
+            return None
+
+        try:
+            result = await task
+        except Exception:
+            logger.exception("Error occurs during prefetching a suggested response")
+            result = None
+        if result is None:
+            PREFETCH_RESULTS.inc(outcome="failed")
+            return None
+        bing_resp = await session.bing.adopt(result)
+        if bing_resp is None:
+            PREFETCH_RESULTS.inc(outcome="stale")
+            return None
+        self._hits += 1
+        PREFETCH_RESULTS.inc(outcome="hit")
+        logger.info("Answered a suggested response from the prefetched conversation.")
+        return bing_resp
+
+    async def _speculate(self, bing: BingBot, text: str, lease: ProfileLease) -> Optional[SpeculativeResponse]:
+        async with self._scheduler.speculative_slot() as admitted:
+            if not admitted:
+                # The spare capacity has been taken since the prefetch started
+                return None
+            return await bing.speculate(text, lease)
+
+    def cancel(self, channel_key: int, outcome: str = "cancelled"):
+        """
+        Drop the speculation of the channel
+        """
+        speculation = self._speculations.pop(channel_key, None)
+        if speculation is None:
+            return
+        speculation.expire_handle.cancel()
+        self._close(speculation, outcome)
+
+    def get_stats(self) -> SuggestionPrefetcherStats:
+        in_flight = sum(1 for speculation in self._speculations.values() for task in speculation.tasks.values() if not task.done())
+        return SuggestionPrefetcherStats(len(self._enabled_channels), in_flight, self._spent, self._hits)
+
+    async def close(self):
+        for channel_key in list(self._speculations):
+            self.cancel(channel_key)
+
+    @staticmethod
+    def _close(speculation: _ChannelSpeculation, outcome: str):
+        for task in speculation.tasks.values():
+            PREFETCH_RESULTS.inc(outcome=outcome)
+            if not task.done():
+                # The conversation is closed and the lease released by the cancelled task itself
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None and task.result() is not None:
+                speculation.bing.discard_speculation(task.result())
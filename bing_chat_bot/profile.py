@@ -0,0 +1,264 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+# Cooldown of a profile after its first failure. It doubles on each consecutive failure.
+PROFILE_COOLDOWN_SECONDS = 60
+PROFILE_MAX_COOLDOWN_SECONDS = 30 * 60
+
+# Maximum number of concurrent Bing requests per profile
+IN_FLIGHT_REQUESTS_PER_PROFILE = 2
+
+logger = logging.getLogger(__name__)
+
+
+def expand_cookie_paths(paths: List[str]) -> List[str]:
+    """
+    The cookie files of paths. A directory stands for the .json files in it, in the order of their names.
+    """
+    cookie_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            cookie_paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.json'))
+        else:
+            cookie_paths.append(path)
+    return cookie_paths
+
+
+def load_cookies(cookie_path: str) -> List[dict]:
+    """
+    Read a cookie file exported from the browser. Raise ValueError if it is not a list of cookies with the _U cookie of Bing.
+    """
+    with open(cookie_path, encoding='utf-8') as f:
+        try:
+            cookies = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{cookie_path} is not valid JSON: {e}") from e
+    if not isinstance(cookies, list) or not all(isinstance(cookie, dict) and isinstance(cookie.get('name'), str) and 'value' in cookie
+                                                for cookie in cookies):
+        raise ValueError(f"{cookie_path} is not a list of cookies with a name and a value")
+    if not any(cookie['name'] == '_U' for cookie in cookies):
+        raise ValueError(f"{cookie_path} has no _U cookie")
+    return cookies
+
+
+class Profile:
+    """
+    A Bing account, identified by its cookie file
+    """
+
+    def __init__(self, index: int, cookie_path: str, cookies: List[dict]):
+        self.index = index
+        self.cookie_path = cookie_path
+        self.cookies = cookies
+        # A retired profile's cookie file has been removed. Its conversations go on, but no new conversation is placed on it.
+        self.retired = False
+
+        self.in_flight = 0
+        # Leases taken for a request which has not begun yet, e.g. a speculation which is starting
+        self.reserved = 0
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        # Throttling usage (numUserMessagesInConversation / maxNumUserMessagesInConversation) of each live conversation
+        self.conversation_usages: Dict[int, float] = {}
+
+        # In-flight requests, throttling usage and live conversations of the other worker processes in the sharded mode
+        self.remote_in_flight = 0
+        self.remote_usage = 0.0
+        self.remote_conversations = 0
+
+    @property
+    def load(self) -> float:
+        """
+        In-flight requests plus how much of the throttling limit the live conversations have used. Lower has more headroom.
+        """
+        return self.in_flight + self.reserved + self.remote_in_flight + sum(self.conversation_usages.values()) + self.remote_usage
+
+    @property
+    def conversations(self) -> int:
+        return len(self.conversation_usages) + self.remote_conversations
+
+    def is_cooling_down(self, now: Optional[float] = None) -> bool:
+        return (now if now is not None else time.monotonic()) < self.cooldown_until
+
+
+class ProfileLease:
+    """
+    A conversation's hold on a profile. The conversation reports its requests and throttling state through the lease.
+    """
+
+    def __init__(self, pool: 'ProfilePool', profile: Profile, reserved: bool = False):
+        self._pool = pool
+        self.profile = profile
+        self._released = False
+        # If set, the profile counts the request as in flight until it begins
+        self._reserved = reserved
+        if reserved:
+            profile.reserved += 1
+        profile.conversation_usages[id(self)] = 0.0
+        pool._changed()
+
+    async def begin_request(self):
+        """
+        Wait for an in-flight slot of the profile. Every begin_request which returns is paired with an end_request.
+        """
+        await self._pool._acquire_slot(self.profile)
+        self.profile.in_flight += 1
+        self._end_reservation()
+        self._pool._changed()
+
+    def end_request(self):
+        self.profile.in_flight -= 1
+        self._pool._release_slot(self.profile)
+        self._pool._changed()
+
+    def record_throttling(self, current_num: int, max_num: int):
+        if not self._released and max_num > 0:
+            self.profile.conversation_usages[id(self)] = current_num / max_num
+            self._pool._changed()
+        self._pool.record_success(self.profile)
+
+    def cooldown(self, reason: str):
+        self._pool.cooldown(self.profile, reason)
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._end_reservation()
+        self.profile.conversation_usages.pop(id(self), None)
+        self._pool._changed()
+
+    def _end_reservation(self):
+        if self._reserved:
+            self._reserved = False
+            self.profile.reserved -= 1
+
+
+class ProfilePool:
+    """
+    All the Bing profiles. New conversations are placed on the profile with the most headroom,
+    and requests wait for one of the in-flight slots of their profile.
+    """
+
+    def __init__(self, cookie_paths: List[str], max_in_flight_per_profile: int = IN_FLIGHT_REQUESTS_PER_PROFILE):
+        self._max_in_flight_per_profile = max_in_flight_per_profile
+        # profile index -> the in-flight slots of the profile, created on first use
+        self._slots: Dict[int, asyncio.Semaphore] = {}
+        self._profiles: List[Profile] = []
+        for index, cookie_path in enumerate(expand_cookie_paths(cookie_paths)):
+            self._profiles.append(Profile(index, cookie_path, load_cookies(cookie_path)))
+        if len(self._profiles) == 0:
+            raise ValueError(f"No cookie file in {cookie_paths}")
+
+    def __len__(self):
+        return len(self._profiles)
+
+    @property
+    def profiles(self) -> List[Profile]:
+        return list(self._profiles)
+
+    def get_profile(self, cookie_path: str) -> Optional[Profile]:
+        return next((p for p in self._profiles if p.cookie_path == cookie_path), None)
+
+    def acquire(self, profile_index: Optional[int] = None) -> ProfileLease:
+        """
+        Lease a profile for a new conversation. If profile_index is not given, the profile with the lowest load
+        which is not cooling down is chosen. If every profile is cooling down, the one that recovers first is chosen.
+        """
+        active = [profile for profile in self._profiles if not profile.retired]
+        if profile_index is not None:
+            # The given profile, or the next active one if it has been retired
+            profile_index %= len(self._profiles)
+            return ProfileLease(self, min(active, key=lambda p: (p.index - profile_index) % len(self._profiles)))
+
+        now = time.monotonic()
+        available = [profile for profile in active if not profile.is_cooling_down(now)]
+        if len(available) == 0:
+            profile = min(active, key=lambda p: p.cooldown_until)
+        else:
+            profile = min(available, key=lambda p: (p.load, p.conversations, p.index))
+        return ProfileLease(self, profile)
+
+    def acquire_other(self, profile: Profile) -> Optional[ProfileLease]:
+        """
+        Lease the profile with the lowest load other than the given one, or None if every other profile is cooling down
+        """
+        now = time.monotonic()
+        available = [p for p in self._profiles if p is not profile and not p.retired and not p.is_cooling_down(now)]
+        if len(available) == 0:
+            return None
+        return ProfileLease(self, min(available, key=lambda p: (p.load, p.conversations, p.index)))
+
+    def acquire_idle(self) -> Optional[ProfileLease]:
+        """
+        Lease a profile which has no request in flight and is not cooling down, or None if there is none.
+        The profile counts as busy from now on, until the request of the lease begins or the lease is released.
+        """
+        now = time.monotonic()
+        idle = [p for p in self._profiles
+                if p.in_flight + p.reserved + p.remote_in_flight == 0 and not p.retired and not p.is_cooling_down(now)]
+        if len(idle) == 0:
+            return None
+        return ProfileLease(self, min(idle, key=lambda p: (p.load, p.conversations, p.index)), reserved=True)
+
+    def update_profile(self, cookie_path: str, cookies: List[dict]) -> Profile:
+        """
+        Swap the cookies of the profile of cookie_path, or add a profile for a new file. Conversations which have already
+        started keep their cookies, and new conversations use the new ones. New cookies end the cooldown of the profile.
+        """
+        profile = self.get_profile(cookie_path)
+        if profile is None:
+            profile = Profile(len(self._profiles), cookie_path, cookies)
+            self._profiles.append(profile)
+            logger.info(f"Added profile {profile.index + 1} from {cookie_path}")
+        else:
+            profile.cookies = cookies
+            profile.retired = False
+            profile.cooldown_until = 0.0
+            profile.consecutive_failures = 0
+            logger.info(f"Reloaded the cookies of profile {profile.index + 1} from {cookie_path}")
+        self._changed()
+        return profile
+
+    def retire_profile(self, cookie_path: str) -> Optional[Profile]:
+        """
+        Stop placing new conversations on the profile of cookie_path. The last active profile is never retired.
+        """
+        profile = next((p for p in self._profiles if p.cookie_path == cookie_path and not p.retired), None)
+        if profile is None:
+            return None
+        if all(p.retired for p in self._profiles if p is not profile):
+            logger.warning(f"Keeping profile {profile.index + 1}, the cookie file of the last active profile has been removed: {cookie_path}")
+            return None
+        profile.retired = True
+        logger.info(f"Retired profile {profile.index + 1}, its cookie file has been removed: {cookie_path}")
+        self._changed()
+        return profile
+
+    def cooldown(self, profile: Profile, reason: str):
+        seconds = min(PROFILE_COOLDOWN_SECONDS * 2 ** profile.consecutive_failures, PROFILE_MAX_COOLDOWN_SECONDS)
+        profile.consecutive_failures += 1
+        profile.cooldown_until = time.monotonic() + seconds
+        logger.warning(f"Profile {profile.index + 1} is cooling down for {seconds} seconds. Reason: {reason}")
+
+    def record_success(self, profile: Profile):
+        profile.consecutive_failures = 0
+
+    async def _acquire_slot(self, profile: Profile):
+        slots = self._slots.get(profile.index)
+        if slots is None:
+            slots = self._slots[profile.index] = asyncio.Semaphore(self._max_in_flight_per_profile)
+        await slots.acquire()
+
+    def _release_slot(self, profile: Profile):
+        self._slots[profile.index].release()
+
+    def _changed(self):
+        """
+        Called when a lease changes the load of a profile
+        """
+        pass
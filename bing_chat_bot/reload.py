@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .formatter import FormatterOptions
+from .profile import Profile, ProfilePool, expand_cookie_paths, load_cookies
+
+# How often the cookie files and the config file are checked for changes
+RELOAD_POLL_SECONDS = 5.0
+
+# Settings of the config file and their types. The formatter settings are those of FormatterOptions.
+_CONFIG_TYPES = {
+    'request_timeout_seconds': (int, float),
+    'hedge_percentile': (int, float, type(None)),
+    'carry_over_turns_left': (int,),
+    'guild_weights': (dict,),
+    'formatter': (dict,)
+}
+
+logger = logging.getLogger(__name__)
+
+
+def load_config(config_path: str) -> dict:
+    """
+    Read the JSON config file, e.g. {"request_timeout_seconds": 60, "guild_weights": {"<guild id>": 2}, "formatter": {"show_links": true}}.
+    Raise ValueError if a setting is unknown or invalid.
+    """
+    with open(config_path, encoding='utf-8') as f:
+        try:
+            config = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{config_path} is not valid JSON: {e}") from e
+    if not isinstance(config, dict):
+        raise ValueError(f"{config_path} is not a JSON object")
+    for name, value in config.items():
+        if name not in _CONFIG_TYPES:
+            raise ValueError(f"Unknown setting {name} in {config_path}")
+        if isinstance(value, bool) or not isinstance(value, _CONFIG_TYPES[name]):
+            raise ValueError(f"Setting {name} in {config_path} has a wrong type: {value!r}")
+    if config.get('request_timeout_seconds', 1) <= 0:
+        raise ValueError(f"request_timeout_seconds in {config_path} must be positive")
+    if config.get('hedge_percentile') is not None and not 0 < config['hedge_percentile'] <= 100:
+        raise ValueError(f"hedge_percentile in {config_path} must be in (0, 100]")
+    if config.get('carry_over_turns_left', 0) < 0:
+        raise ValueError(f"carry_over_turns_left in {config_path} cannot be negative")
+    for guild_id, weight in config.get('guild_weights', {}).items():
+        if not guild_id.isdigit() or isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight <= 0:
+            raise ValueError(f"Invalid guild weight {guild_id} in {config_path}: {weight!r}")
+    formatter_names = vars(FormatterOptions()).keys()
+    for name, value in config.get('formatter', {}).items():
+        if name not in formatter_names or not isinstance(value, bool):
+            raise ValueError(f"Invalid formatter setting {name} in {config_path}: {value!r}")
+    return config
+
+
+def _signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ConfigReloaderStats:
+    def __init__(self, reloads, rejected):
+        self.reloads: int = reloads
+        self.rejected: int = rejected
+
+
+class ConfigReloader:
+    """
+    Watch the cookie files, the directories they are listed from, and the config file, and apply their changes without a restart.
+    Only the profiles whose file has changed are swapped, the conversations on the other profiles are not affected.
+    A file which fails validation is ignored until it changes again, and its previous contents stay in use.
+    """
+
+    def __init__(self,
+                 profile_pool: ProfilePool,
+                 cookie_paths: List[str],
+                 config_path: Optional[str] = None,
+                 on_profile_changed: Optional[Callable[[Profile], None]] = None,
+                 on_config_changed: Optional[Callable[[dict, dict], None]] = None,
+                 interval: float = RELOAD_POLL_SECONDS):
+        self._pool = profile_pool
+        self._cookie_paths = cookie_paths
+        self._config_path = config_path
+        self._on_profile_changed = on_profile_changed
+        self._on_config_changed = on_config_changed
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+        # path -> (mtime, size) of the cookie files the profiles were loaded from
+        self._signatures: Dict[str, Tuple[int, int]] = {}
+        for path in expand_cookie_paths(cookie_paths):
+            signature = _signature(path)
+            if signature is not None:
+                self._signatures[path] = signature
+        self._config_signature = _signature(config_path) if config_path is not None else None
+        # Settings which are missing from the file keep their current values
+        self.config: dict = load_config(config_path) if config_path is not None else {}
+
+        self._reloads = 0
+        self._rejected = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_stats(self) -> ConfigReloaderStats:
+        return ConfigReloaderStats(self._reloads, self._rejected)
+
+    def check(self):
+        """
+        Apply the changes made since the last check
+        """
+        self._check_cookie_files()
+        if self._config_path is not None:
+            self._check_config()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Error occurs during reloading the configuration")
+
+    def _check_cookie_files(self):
+        current = {}
+        for path in expand_cookie_paths(self._cookie_paths):
+            signature = _signature(path)
+            if signature is not None:
+                current[path] = signature
+
+        for path in [path for path in self._signatures if path not in current]:
+            del self._signatures[path]
+            profile = self._pool.retire_profile(path)
+            if profile is not None and self._on_profile_changed is not None:
+                self._on_profile_changed(profile)
+
+        for path, signature in current.items():
+            if self._signatures.get(path) == signature:
+                continue
+            self._signatures[path] = signature
+            try:
+                cookies = load_cookies(path)
+            except (OSError, ValueError) as e:
+                self._rejected += 1
+                logger.warning(f"Ignoring the changed cookie file: {e}")
+                continue
+            self._reloads += 1
+            profile = self._pool.update_profile(path, cookies)
+            if self._on_profile_changed is not None:
+                self._on_profile_changed(profile)
+
+    def _check_config(self):
+        signature = _signature(self._config_path)
+        if signature is None or signature == self._config_signature:
+            return
+        self._config_signature = signature
+        try:
+            config = load_config(self._config_path)
+        except (OSError, ValueError) as e:
+            self._rejected += 1
+            logger.warning(f"Ignoring the changed config file: {e}")
+            return
+        previous, self.config = self.config, config
+        self._reloads += 1
+        logger.info(f"Reloaded the config from {self._config_path}")
+        if self._on_config_changed is not None:
+            self._on_config_changed(config, previous)
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, Optional, Set
+
+from .metrics import ERRORS
+
+# Maximum number of requests waiting in a channel. New messages are rejected beyond this value.
+MAX_QUEUE_PER_CHANNEL = 5
+
+# Messages from the same user are merged into one prompt if they are sent within this many seconds
+COALESCE_SECONDS = 5.0
+
+# Token buckets shared by all channels of a guild, and by all messages of a user
+GUILD_REQUESTS_PER_MINUTE = 20
+GUILD_BURST = 10
+USER_REQUESTS_PER_MINUTE = 6
+USER_BURST = 4
+
+# Idle buckets are dropped once there are more than this many of them
+MAX_BUCKETS = 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledRequest:
+    def __init__(self, channel_key: Hashable, guild_key: Optional[Hashable], user_key: Hashable, text: str, context=None, trace=None,
+                 mergeable: bool = True):
+        self.channel_key = channel_key
+        # None for a direct message, which only draws from the bucket of its user
+        self.guild_key = guild_key
+        self.user_key = user_key
+        self.text = text
+        # Opaque to the scheduler, e.g. the discord message to reply to
+        self.context = context
+        # The trace which the handling of the request is recorded in, if tracing is enabled
+        self.trace = trace
+        # Chat messages can be merged into one prompt, but a request which expects its own answer cannot
+        self.mergeable = mergeable
+        # Set when nobody waits for the answer anymore. The scheduler drops the request without charging its tokens.
+        self.cancelled = False
+
+        self.created_at = time.monotonic()
+        self.updated_at = self.created_at
+        self.merged_count = 1
+
+    def merge(self, text: str):
+        self.text = f"{self.text}\n{text}"
+        self.merged_count += 1
+        self.updated_at = time.monotonic()
+
+
+class SubmitResult:
+    def __init__(self, accepted: bool, position: int, merged: bool = False):
+        self.accepted: bool = accepted
+        # Number of requests ahead in the channel. 0 means the request starts right away.
+        self.position: int = position
+        self.merged: bool = merged
+
+
+class SchedulerStats:
+    def __init__(self, in_flight, queued, rejected, merged):
+        self.in_flight: int = in_flight
+        self.queued: int = queued
+        self.rejected: int = rejected
+        self.merged: int = merged
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self._rate = rate_per_second
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self._capacity
+
+    @property
+    def available(self) -> bool:
+        self._refill()
+        return self._tokens >= 1
+
+    def try_acquire(self) -> float:
+        """
+        Take a token. Return 0 on success, otherwise the seconds to wait until a token is available.
+        """
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def refund(self):
+        """
+        Give back a token taken for work which has not been done
+        """
+        self._refill()
+        self._tokens = min(self._capacity, self._tokens + 1)
+
+    def drain(self):
+        self._refill()
+        self._tokens = 0
+
+    async def acquire(self):
+        while (wait_seconds := self.try_acquire()) > 0:
+            await asyncio.sleep(wait_seconds)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+class RequestScheduler:
+    """
+    Sit between the chat events and Bing.
+    Requests are handled strictly in order within a channel, the number of requests in flight is capped globally,
+    and guilds and users share the capacity through weighted token buckets.
+    """
+
+    def __init__(self,
+                 handler: Callable[[ScheduledRequest], Awaitable[None]],
+                 max_in_flight: int,
+                 max_queue_per_channel: int = MAX_QUEUE_PER_CHANNEL,
+                 coalesce_seconds: float = COALESCE_SECONDS,
+                 guild_weights: Optional[Dict[Hashable, float]] = None):
+        self._handler = handler
+        self._max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        # Slots still to be taken out of circulation after the cap was lowered. They are taken as they are released.
+        self._excess_slots = 0
+        self._withhold_task: Optional[asyncio.Task] = None
+        self._max_queue_per_channel = max_queue_per_channel
+        self._coalesce_seconds = coalesce_seconds
+        self._guild_weights = guild_weights if guild_weights is not None else {}
+
+        self._queues: Dict[Hashable, Deque[ScheduledRequest]] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        # Channels with a request being handled
+        self._running: Set[Hashable] = set()
+        self._guild_buckets: Dict[Hashable, TokenBucket] = {}
+        self._user_buckets: Dict[Hashable, TokenBucket] = {}
+
+        self._in_flight = 0
+        self._rejected = 0
+        self._merged = 0
+
+    def submit(self, request: ScheduledRequest) -> SubmitResult:
+        queue = self._queues.setdefault(request.channel_key, deque())
+        running = 1 if request.channel_key in self._running else 0
+
+        if len(queue) > 0:
+            last_request = queue[-1]
+            if (last_request.mergeable and request.mergeable and last_request.user_key == request.user_key
+                    and time.monotonic() - last_request.updated_at <= self._coalesce_seconds):
+                last_request.merge(request.text)
+                self._merged += 1
+                return SubmitResult(True, len(queue) - 1 + running, merged=True)
+
+        if len(queue) >= self._max_queue_per_channel:
+            self._rejected += 1
+            return SubmitResult(False, len(queue))
+
+        queue.append(request)
+        if request.channel_key not in self._workers:
+            self._workers[request.channel_key] = asyncio.get_running_loop().create_task(self._run_channel(request.channel_key))
+            return SubmitResult(True, 0)
+        return SubmitResult(True, len(queue) - 1 + running)
+
+    def take_speculative_tokens(self, guild_key: Optional[Hashable], user_key: Hashable) -> bool:
+        """
+        Take the tokens for work nobody is waiting for yet, e.g. prefetching, if an in-flight slot is free with no request waiting
+        for one, and the guild and the user have a token to spare right now. The work then runs in speculative_slot.
+        """
+        if self._semaphore.locked():
+            return False
+        buckets = [self._get_bucket(self._user_buckets, user_key, 1, USER_REQUESTS_PER_MINUTE, USER_BURST)]
+        if guild_key is not None:
+            buckets.append(self._get_bucket(self._guild_buckets, guild_key, self._guild_weights.get(guild_key, 1), GUILD_REQUESTS_PER_MINUTE, GUILD_BURST))
+        if not all(bucket.available for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.try_acquire()
+        return True
+
+    @asynccontextmanager
+    async def speculative_slot(self) -> AsyncIterator[bool]:
+        """
+        Hold an in-flight slot for speculative work if one is free right now. Yield whether it is held.
+        Speculative work never waits for a slot, so that it never delays the requests users are waiting for.
+        """
+        if self._semaphore.locked():
+            yield False
+            return
+        # Free, so it is taken without waiting
+        async with self._slot():
+            self._in_flight += 1
+            try:
+                yield True
+            finally:
+                self._in_flight -= 1
+
+    def set_guild_weights(self, guild_weights: Dict[Hashable, float]):
+        """
+        Replace the guild weights. The buckets of the guilds whose weight has changed start over with the new rate.
+        """
+        changed = set(guild_weights.keys()) ^ set(self._guild_weights.keys())
+        changed.update(key for key, weight in guild_weights.items() if self._guild_weights.get(key) != weight)
+        self._guild_weights = dict(guild_weights)
+        for key in changed:
+            self._guild_buckets.pop(key, None)
+
+    def set_max_in_flight(self, max_in_flight: int):
+        """
+        Change the cap on the requests in flight. Requests already in flight keep their slots, a lower cap applies as they complete.
+        """
+        change = max_in_flight - self._max_in_flight
+        self._max_in_flight = max_in_flight
+        if change > 0:
+            # Slots which have not been taken out yet stay in circulation, the rest are added
+            kept = min(change, self._excess_slots)
+            self._excess_slots -= kept
+            for _ in range(change - kept):
+                self._semaphore.release()
+        elif change < 0:
+            self._excess_slots -= change
+            # Free slots are taken out right away
+            if self._withhold_task is None or self._withhold_task.done():
+                self._withhold_task = asyncio.get_running_loop().create_task(self._withhold_free_slots())
+
+    def get_stats(self) -> SchedulerStats:
+        return SchedulerStats(self._in_flight, sum(len(queue) for queue in self._queues.values()), self._rejected, self._merged)
+
+    async def _run_channel(self, channel_key: Hashable):
+        queue = self._queues[channel_key]
+        try:
+            while len(queue) > 0:
+                # The request stays in the queue while waiting for tokens, so that follow-up messages can still be merged into it
+                request = queue[0]
+                if request.cancelled:
+                    queue.popleft()
+                    continue
+                buckets = [self._get_bucket(self._user_buckets, request.user_key, 1, USER_REQUESTS_PER_MINUTE, USER_BURST)]
+                if request.guild_key is not None:
+                    buckets.insert(0, self._get_bucket(self._guild_buckets, request.guild_key, self._guild_weights.get(request.guild_key, 1),
+                                                       GUILD_REQUESTS_PER_MINUTE, GUILD_BURST))
+                for bucket in buckets:
+                    await bucket.acquire()
+                async with self._slot():
+                    queue.popleft()
+                    if request.cancelled:
+                        # Cancelled while waiting for the tokens or a slot
+                        for bucket in buckets:
+                            bucket.refund()
+                        continue
+                    self._in_flight += 1
+                    self._running.add(channel_key)
+                    try:
+                        await self._handler(request)
+                    except Exception as e:
+                        ERRORS.inc(reason=type(e).__name__)
+                        logger.exception(f"Error occurs during handling a request in channel {channel_key}")
+                    finally:
+                        self._in_flight -= 1
+                        self._running.discard(channel_key)
+        finally:
+            del self._workers[channel_key]
+            if len(queue) == 0:
+                del self._queues[channel_key]
+
+    @asynccontextmanager
+    async def _slot(self) -> AsyncIterator[None]:
+        await self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            if self._excess_slots > 0:
+                # Taken out of circulation, until the cap is raised again
+                self._excess_slots -= 1
+            else:
+                self._semaphore.release()
+
+    async def _withhold_free_slots(self):
+        # Acquiring a slot which is free does not wait
+        while self._excess_slots > 0 and not self._semaphore.locked():
+            await self._semaphore.acquire()
+            self._excess_slots -= 1
+
+    @staticmethod
+    def _get_bucket(buckets: Dict[Hashable, TokenBucket], key: Hashable, weight: float, requests_per_minute: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= MAX_BUCKETS:
+                for idle_key in [k for k, b in buckets.items() if b.full]:
+                    del buckets[idle_key]
+            bucket = TokenBucket(requests_per_minute * weight / 60, max(1.0, burst * weight))
+            buckets[key] = bucket
+        return bucket
@@ -0,0 +1,265 @@
+import asyncio
+import datetime
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional, Set, Tuple
+
+from .bing import BingBot, BingBotOptions, BingBotResponse, BingBotState, BingBotStatus, DEFAULT_STYLE
+from .cache import ResponseCache
+from .profile import ProfilePool
+from .store import SessionStore
+from .warmer import ConversationWarmer
+
+# Maximum number of live Bing conversations kept at the same time
+MAX_SESSIONS = 64
+
+# Sessions idle longer than this value are closed. A conversation idle for this long would be reset anyway.
+SESSION_IDLE_SECONDS = 30 * 60
+
+# Interval of evicting the idle sessions when no request comes in
+SESSION_SWEEP_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManagerStats:
+    def __init__(self, size, max_size, hits, misses, evictions):
+        self.size: int = size
+        self.max_size: int = max_size
+        self.hits: int = hits
+        self.misses: int = misses
+        self.evictions: int = evictions
+
+
+class BingSession:
+    """
+    A Bing conversation bound to a Discord channel (or thread)
+    """
+
+    def __init__(self, key: int, bing: BingBot):
+        self.key = key
+        self.bing = bing
+
+        self.bing_resp_cache: Optional[BingBotResponse] = None
+        # The discord message which the last response replied to
+        self.original_message_cache = None
+        # (channel id, message id) of the message which the last response replied to, if the session was restored from the store
+        self.original_message_ids: Optional[Tuple[int, int]] = None
+        self.last_message_time: Optional[datetime.datetime] = None
+        self.last_active = time.monotonic()
+        # Number of requests and commands using the conversation. A pinned session is not evicted.
+        self.pins = 0
+
+    def to_state(self) -> dict:
+        original_message_ids = self.original_message_ids
+        if self.original_message_cache is not None:
+            original_message_ids = (self.original_message_cache.channel.id, self.original_message_cache.id)
+        return {
+            'bing': vars(self.bing.export_state()),
+            'last_message_time': self.last_message_time.isoformat() if self.last_message_time is not None else None,
+            'last_response': vars(self.bing_resp_cache) if self.bing_resp_cache is not None else None,
+            'original_message_ids': original_message_ids
+        }
+
+    def restore(self, state: dict):
+        if state.get('last_message_time') is not None:
+            self.last_message_time = datetime.datetime.fromisoformat(state['last_message_time'])
+        if state.get('last_response') is not None:
+            self.bing_resp_cache = BingBotResponse(**state['last_response'])
+        if state.get('original_message_ids') is not None:
+            self.original_message_ids = tuple(state['original_message_ids'])
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def seconds_since_last_message(self, message_time: datetime.datetime) -> Optional[float]:
+        if self.last_message_time is None:
+            return None
+        return (message_time - self.last_message_time).total_seconds()
+
+
+class SessionManager:
+    """
+    Hold a bounded number of Bing conversations keyed by channel. Least recently used and idle sessions are evicted,
+    except those in use, which are evicted once released. Once started, idle sessions are also evicted without traffic.
+    With a store, sessions are saved as they change and a channel's session is restored the first time it is used after a restart.
+    """
+
+    def __init__(self,
+                 profile_pool: ProfilePool,
+                 response_cache: Optional[ResponseCache] = None,
+                 warmer: Optional[ConversationWarmer] = None,
+                 max_sessions: int = MAX_SESSIONS,
+                 idle_seconds: float = SESSION_IDLE_SECONDS,
+                 bing_options: Optional[BingBotOptions] = None,
+                 store: Optional[SessionStore] = None,
+                 sweep_seconds: float = SESSION_SWEEP_SECONDS):
+        self._pool = profile_pool
+        self._store = store
+        self._bing_options = bing_options
+        self._response_cache = response_cache
+        self._warmer = warmer
+        self._max_sessions = max_sessions
+        self._idle_seconds = idle_seconds
+        self._sweep_seconds = sweep_seconds
+
+        self._sessions: "OrderedDict[int, BingSession]" = OrderedDict()
+        self._closing_tasks: Set[asyncio.Task] = set()
+        self._sweep_task: Optional[asyncio.Task] = None
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def start(self):
+        """
+        Evict the idle sessions periodically, so that their conversations and profile leases are freed without traffic
+        """
+        if self._sweep_task is None or self._sweep_task.done():
+            self._sweep_task = asyncio.get_running_loop().create_task(self._sweep())
+
+    def get(self, key: int) -> BingSession:
+        """
+        Get the session of the channel, creating one if it does not exist
+        """
+        session = self._sessions.get(key)
+        if session is not None:
+            self._hits += 1
+            self._sessions.move_to_end(key)
+            session.touch()
+            self._evict_sessions(keep=key)
+            return session
+        return self._add_session(key, self._load_state(key))
+
+    @contextmanager
+    def use(self, key: int) -> Iterator[BingSession]:
+        """
+        Get the session of the channel, and keep it from being evicted while the enclosed code talks to Bing
+        """
+        session = self.get(key)
+        session.pins += 1
+        try:
+            yield session
+        finally:
+            session.pins -= 1
+            if self._sessions.get(key) is session:
+                session.touch()
+                self._sessions.move_to_end(key)
+            self._evict_sessions()
+
+    def save(self, session: BingSession):
+        """
+        Record the current state of the session in the store. The write happens in the background.
+        """
+        if self._store is not None:
+            self._store.save_session(session.key, session.to_state())
+
+    def find(self, key: int) -> Optional[BingSession]:
+        """
+        Get the session of the channel if it is live or stored, without creating a new one
+        """
+        session = self._sessions.get(key)
+        if session is None and self._store is not None:
+            state = self._load_state(key)
+            if state is not None:
+                session = self._add_session(key, state)
+        return session
+
+    def create_detached(self, style: str = DEFAULT_STYLE) -> BingBot:
+        """
+        A conversation outside of the sessions, e.g. for a one-off prompt. The caller closes it.
+        """
+        # A state without a conversation only carries the style
+        return BingBot(self._pool, self._response_cache, self._warmer, self._bing_options, BingBotState(style, None))
+
+    def get_default_status(self) -> BingBotStatus:
+        """
+        Status of a channel which has not talked to the bot yet
+        """
+        return BingBotStatus(DEFAULT_STYLE, 1, len(self._pool))
+
+    def get_stats(self) -> SessionManagerStats:
+        return SessionManagerStats(len(self._sessions), self._max_sessions, self._hits, self._misses, self._evictions)
+
+    async def close(self):
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+        sessions = list(self._sessions.values())
+        for session in sessions:
+            self.save(session)
+        self._sessions.clear()
+        await asyncio.gather(*[self._close_session(session) for session in sessions])
+        if len(self._closing_tasks) > 0:
+            await asyncio.gather(*self._closing_tasks)
+        if self._store is not None:
+            await self._store.close()
+
+    def _load_state(self, key: int) -> Optional[dict]:
+        if self._store is None:
+            return None
+        try:
+            return self._store.load_session(key)
+        except Exception:
+            logger.exception(f"Error occurs during loading the session of channel {key}")
+            return None
+
+    def _add_session(self, key: int, state: Optional[dict]) -> BingSession:
+        self._misses += 1
+        session = self._create_session(key, state)
+        self._sessions[key] = session
+        session.touch()
+        self._evict_sessions(keep=key)
+        return session
+
+    def _create_session(self, key: int, state: Optional[dict]) -> BingSession:
+        if state is None:
+            return BingSession(key, BingBot(self._pool, self._response_cache, self._warmer, self._bing_options))
+        logger.info(f"Restore the session of channel {key}.")
+        session = BingSession(key, BingBot(self._pool, self._response_cache, self._warmer, self._bing_options, BingBotState(**state['bing'])))
+        session.restore(state)
+        return session
+
+    def _evict_sessions(self, keep: Optional[int] = None):
+        """
+        Evict the idle sessions, then the least recently used ones beyond the limit. Sessions in use and keep are skipped.
+        """
+        now = time.monotonic()
+        evicted = []
+        excess = len(self._sessions) - self._max_sessions
+        # Sessions are ordered by last use, so the scan stops at the first session which is neither idle nor beyond the limit
+        for key, session in self._sessions.items():
+            if excess <= 0 and now - session.last_active < self._idle_seconds:
+                break
+            if session.pins == 0 and key != keep:
+                evicted.append(key)
+                excess -= 1
+        for key in evicted:
+            self._evict(key, self._sessions.pop(key))
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self._sweep_seconds)
+            try:
+                self._evict_sessions()
+            except Exception:
+                logger.exception("Error occurs during evicting the idle sessions")
+
+    def _evict(self, key: int, session: BingSession):
+        self._evictions += 1
+        # The stored state outlives the session in memory
+        self.save(session)
+        logger.info(f"Evict the session of channel {key}.")
+        # Closing the conversation involves network I/O, do it in the background
+        task = asyncio.get_running_loop().create_task(self._close_session(session))
+        self._closing_tasks.add(task)
+        task.add_done_callback(self._closing_tasks.discard)
+
+    @staticmethod
+    async def _close_session(session: BingSession):
+        try:
+            await session.bing.close()
+        except Exception:
+            logger.exception(f"Error occurs during closing the session of channel {session.key}")
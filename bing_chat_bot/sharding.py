@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from typing import Awaitable, Callable, List
+
+from .coordinator import CoordinatedProfilePool, ProfileCoordinator
+
+# Interval of checking whether the worker processes are still running
+WORKER_POLL_SECONDS = 1.0
+
+# Time the workers have to flush their state after SIGTERM before they are killed
+WORKER_STOP_SECONDS = 10.0
+
+logger = logging.getLogger(__name__)
+
+# (profile pool, worker index, shard ids) -> runs the bot of a worker until it stops
+WorkerRunner = Callable[[CoordinatedProfilePool, int, List[int]], Awaitable[None]]
+
+
+def get_worker_shard_ids(worker_index: int, worker_count: int, shard_count: int) -> List[int]:
+    return list(range(worker_index, shard_count, worker_count))
+
+
+def run_sharded(cookie_paths: List[str], worker_count: int, shard_count: int, socket_path: str, run_worker: WorkerRunner):
+    """
+    Run the profile coordinator in this process and the bot in worker_count worker processes,
+    each handling every worker_count-th Discord shard. Blocks until every worker has exited,
+    or until this process gets SIGTERM or SIGINT, which stops the workers too.
+    """
+    if shard_count < worker_count:
+        raise ValueError(f"Cannot run {worker_count} workers on {shard_count} shards")
+    if os.path.exists(socket_path):
+        # Left over from a previous run
+        os.unlink(socket_path)
+
+    # Workers are forked before this process starts an event loop, they connect once the coordinator is listening
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for worker_index in range(worker_count):
+        shard_ids = get_worker_shard_ids(worker_index, worker_count, shard_count)
+        process = context.Process(target=_run_worker_process, args=(run_worker, cookie_paths, socket_path, worker_index, shard_ids),
+                                  name=f"bing-chat-bot-worker-{worker_index}")
+        process.start()
+        logger.info(f"Started worker {worker_index} (pid {process.pid}) with shards {shard_ids}")
+        processes.append(process)
+
+    try:
+        asyncio.run(_run_coordinator(cookie_paths, socket_path, processes))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(WORKER_STOP_SECONDS)
+            if process.is_alive():
+                logger.warning(f"Killing {process.name} (pid {process.pid}), it has not stopped in {WORKER_STOP_SECONDS} seconds")
+                process.kill()
+                process.join()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+async def _run_coordinator(cookie_paths: List[str], socket_path: str, processes: List[multiprocessing.Process]):
+    # SIGTERM, e.g. from a deploy, and SIGINT stop the coordinator, and then the workers are stopped by run_sharded
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, asyncio.current_task().cancel)
+    coordinator = ProfileCoordinator(cookie_paths, socket_path)
+    await coordinator.start()
+    try:
+        while any(process.is_alive() for process in processes):
+            await asyncio.sleep(WORKER_POLL_SECONDS)
+        logger.info("Every worker has exited")
+    except asyncio.CancelledError:
+        logger.info("Stopping the workers")
+    finally:
+        await coordinator.close()
+
+
+def _run_worker_process(run_worker: WorkerRunner, cookie_paths: List[str], socket_path: str, worker_index: int, shard_ids: List[int]):
+    async def run():
+        profile_pool = CoordinatedProfilePool(cookie_paths, socket_path)
+        # The coordinator is the parent process. Without it the worker would be orphaned, so it stops like on SIGTERM.
+        profile_pool.on_disconnected = asyncio.current_task().cancel
+        await profile_pool.connect()
+        try:
+            await run_worker(profile_pool, worker_index, shard_ids)
+        except asyncio.CancelledError:
+            pass  # stopped before the bot has started
+        finally:
+            await profile_pool.close()
+
+    asyncio.run(run())
@@ -0,0 +1,23 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Log how long each startup phase took, and the time since the process started
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        logger.info(f"Startup phase '{phase}' took {now - self._last:.3f}s ({now - self._start:.3f}s since start)")
+        self._last = now
+
+
+# Started when the package is first imported
+STARTUP_TIMER = StartupTimer()
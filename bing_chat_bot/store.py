@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+# Pending writes are flushed in one transaction at this interval
+STORE_FLUSH_INTERVAL_SECONDS = 1.0
+
+# Stored sessions older than this are not restored. A conversation idle for this long would be reset anyway.
+STORE_MAX_AGE_SECONDS = 30 * 60
+
+# Sessions older than the max age are deleted from the store at most this often
+STORE_PRUNE_INTERVAL_SECONDS = 10 * 60
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    key INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class SessionStoreStats:
+    def __init__(self, pending, flushes, written, loaded):
+        self.pending: int = pending
+        self.flushes: int = flushes
+        self.written: int = written
+        self.loaded: int = loaded
+
+
+class SessionStore:
+    """
+    Keep session states and settings in SQLite, so that a restart resumes the conversations.
+    Writes are coalesced per key and flushed in batches on a background thread. Reads are single-row lookups by key.
+    """
+
+    def __init__(self, path: str, flush_interval: float = STORE_FLUSH_INTERVAL_SECONDS, max_age_seconds: float = STORE_MAX_AGE_SECONDS):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._max_age_seconds = max_age_seconds
+
+        # One thread owns the write connection, and the event loop reads through its own connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self._read_connection = self._connect()
+        self._read_connection.executescript(_SCHEMA)
+        self._write_connection: Optional[sqlite3.Connection] = None
+
+        # key -> latest state, None to delete
+        self._pending_sessions: Dict[int, Optional[dict]] = {}
+        self._pending_settings: Dict[str, object] = {}
+        # The writes being committed by the writer thread, still read from until the commit has finished
+        self._flushing_sessions: Dict[int, Optional[dict]] = {}
+        self._flushing_settings: Dict[str, object] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # Expired sessions are pruned with the first flush
+        self._pruned_at = 0.0
+
+        self._flushes = 0
+        self._written = 0
+        self._loaded = 0
+
+    def load_session(self, key: int) -> Optional[dict]:
+        """
+        The stored state of the session, or None if there is none or it is too old
+        """
+        for writes in (self._pending_sessions, self._flushing_sessions):
+            if key in writes:
+                return writes[key]
+        row = self._read_connection.execute("SELECT state, updated_at FROM sessions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > self._max_age_seconds:
+            self.delete_session(key)
+            return None
+        self._loaded += 1
+        return json.loads(row[0])
+
+    def save_session(self, key: int, state: dict):
+        self._pending_sessions[key] = state
+        self._schedule_flush()
+
+    def delete_session(self, key: int):
+        self._pending_sessions[key] = None
+        self._schedule_flush()
+
+    def load_setting(self, name: str):
+        for writes in (self._pending_settings, self._flushing_settings):
+            if name in writes:
+                return writes[name]
+        row = self._read_connection.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def load_settings(self, prefix: str) -> Dict[str, object]:
+        """
+        The settings whose names start with prefix, e.g. the per-channel settings of one kind
+        """
+        rows = self._read_connection.execute("SELECT name, value FROM settings WHERE substr(name, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+        settings = {name: json.loads(value) for name, value in rows}
+        for writes in (self._flushing_settings, self._pending_settings):
+            settings.update((name, value) for name, value in writes.items() if name.startswith(prefix))
+        return settings
+
+    def save_setting(self, name: str, value):
+        self._pending_settings[name] = value
+        self._schedule_flush()
+
+    def get_stats(self) -> SessionStoreStats:
+        return SessionStoreStats(len(self._pending_sessions) + len(self._pending_settings), self._flushes, self._written, self._loaded)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_write_connection)
+        self._executor.shutdown()
+        self._read_connection.close()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self._flush_interval)
+        await self._flush()
+
+    async def _flush(self):
+        if len(self._pending_sessions) == 0 and len(self._pending_settings) == 0:
+            return
+        sessions, self._pending_sessions = self._pending_sessions, {}
+        settings, self._pending_settings = self._pending_settings, {}
+        self._flushing_sessions, self._flushing_settings = sessions, settings
+        # Serialize on the event loop, so that the writer thread never sees a state which is being modified
+        now = time.time()
+        session_rows = [(key, json.dumps(state), now) for key, state in sessions.items() if state is not None]
+        deleted_keys = [(key,) for key, state in sessions.items() if state is None]
+        setting_rows = [(name, json.dumps(value)) for name, value in settings.items()]
+        expired_before = None
+        if now - self._pruned_at >= STORE_PRUNE_INTERVAL_SECONDS:
+            self._pruned_at = now
+            expired_before = now - self._max_age_seconds
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, session_rows, deleted_keys, setting_rows, expired_before)
+        except Exception:
+            logger.exception(f"Error occurs during writing {len(sessions)} sessions to the store")
+            return
+        finally:
+            if self._flushing_sessions is sessions:
+                self._flushing_sessions, self._flushing_settings = {}, {}
+        self._flushes += 1
+        self._written += len(session_rows) + len(deleted_keys) + len(setting_rows)
+
+    def _write(self, session_rows: list, deleted_keys: list, setting_rows: list, expired_before: Optional[float] = None):
+        if self._write_connection is None:
+            self._write_connection = self._connect()
+        with self._write_connection:
+            if expired_before is not None:
+                # Sessions which cannot be restored any more, e.g. of channels which have stopped talking to the bot
+                self._write_connection.execute("DELETE FROM sessions WHERE updated_at < ?", (expired_before,))
+            self._write_connection.executemany("INSERT OR REPLACE INTO sessions (key, state, updated_at) VALUES (?, ?, ?)", session_rows)
+            self._write_connection.executemany("DELETE FROM sessions WHERE key = ?", deleted_keys)
+            self._write_connection.executemany("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", setting_rows)
+
+    def _close_write_connection(self):
+        if self._write_connection is not None:
+            self._write_connection.close()
+            self._write_connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        # WAL lets the event loop read while the writer thread commits
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+import discord
+
+from .delivery import MessageDelivery
+from .formatter import Formatter, FormatterResponse, FormatterResponseType
+
+# Minimum interval between two flushes of a streaming reply. Discord allows about 5 message edits per 5 seconds in a channel.
+EDIT_INTERVAL_SECONDS = 1.2
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingReply:
+    """
+    Show a response which is still being generated by editing the reply in place.
+    Once the text exceeds the Discord message limit, the remaining text rolls over to new messages.
+    """
+
+    def __init__(self, original_message: discord.Message, delivery: MessageDelivery, edit_interval: float = EDIT_INTERVAL_SECONDS):
+        self._original_message = original_message
+        self._delivery = delivery
+        self._edit_interval = edit_interval
+
+        self._messages: List[discord.Message] = []
+        self._contents: List[str] = []
+        self._latest_text = ""
+        self._last_flush_time = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+        # Set once the scheduled flush is past its delay. From then on it is awaited rather than cancelled,
+        # so that a message it has sent is always tracked.
+        self._flushing = False
+        self._lock = asyncio.Lock()
+
+    async def update(self, text: str):
+        """
+        Record the latest partial text. Edits are debounced: at most one flush happens in each edit interval,
+        and it always shows the latest text.
+        """
+        self._latest_text = text
+        if self._flush_task is not None and not self._flush_task.done():
+            # The scheduled flush will pick up the latest text
+            return
+        delay = max(0.0, self._last_flush_time + self._edit_interval - time.monotonic())
+        self._flushing = False
+        self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush(delay))
+
+    async def finish(self, formatter_responses: List[FormatterResponse]) -> bool:
+        """
+        Replace the partial text with the final formatted response.
+        Return False if the final response cannot be shown by editing (e.g. it needs a file upload);
+        streamed messages are removed in that case and the caller should send the response normally.
+        """
+        await self._stop_flush()
+        texts = [response.value for response in formatter_responses if response.type == FormatterResponseType.NORMAL]
+        embeds = [response.value for response in formatter_responses if response.type == FormatterResponseType.EMBED]
+        views = [response.value for response in formatter_responses if response.type == FormatterResponseType.VIEW]
+        large_texts = [response.value for response in formatter_responses if response.type == FormatterResponseType.LARGE_TEXT]
+
+        if len(large_texts) > 0 or len(texts) == 0:
+            await self._flush([])
+            return False
+
+        last_message_params = {
+            'embed': embeds[0] if len(embeds) > 0 else None,
+            'view': views[0] if len(views) > 0 else None
+        }
+        await self._flush(texts, last_message_params)
+        return True
+
+    async def abort(self):
+        """
+        Remove the streamed messages, e.g. when the response failed midway
+        """
+        await self._stop_flush()
+        try:
+            await self._flush([])
+        except discord.HTTPException:
+            logger.exception("Error occurs during removing the streaming reply")
+
+    async def _delayed_flush(self, delay: float):
+        await asyncio.sleep(delay)
+        self._flushing = True
+        chunks = [chunk for chunk in Formatter.format_partial_text(self._latest_text) if len(chunk) > 0]
+        try:
+            await self._flush(chunks)
+        except discord.HTTPException:
+            # A failed partial update is not fatal, the next flush shows the latest text again
+            logger.exception("Error occurs during updating the streaming reply")
+
+    async def _stop_flush(self):
+        """
+        Drop the scheduled flush if it is still waiting, otherwise wait for it to complete
+        """
+        if self._flush_task is None or self._flush_task.done():
+            return
+        if not self._flushing:
+            self._flush_task.cancel()
+        try:
+            await self._flush_task
+        except asyncio.CancelledError:
+            pass
+
+    async def _flush(self, chunks: List[str], last_message_params: Optional[dict] = None):
+        async with self._lock:
+            for index, chunk in enumerate(chunks):
+                params = {'content': chunk}
+                if last_message_params is not None and index == len(chunks) - 1:
+                    params.update(last_message_params)
+                if index < len(self._messages):
+                    if self._contents[index] != chunk or len(params) > 1:
+                        self._messages[index] = await self._delivery.edit(self._messages[index], **params)
+                        self._contents[index] = chunk
+                else:
+                    self._messages.append(await self._delivery.send(self._original_message, reply=index == 0, **params))
+                    self._contents.append(chunk)
+
+            # The final split may need fewer messages than the partial one
+            while len(self._messages) > len(chunks):
+                message = self._messages.pop()
+                self._contents.pop()
+                await self._delivery.delete(message)
+            self._last_flush_time = time.monotonic()
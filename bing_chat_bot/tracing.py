@@ -0,0 +1,212 @@
+import asyncio
+import atexit
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Optional
+
+from .metrics import LOOP_BLOCKS, LOOP_LAG_SECONDS
+
+# The trace file is rotated at this size
+TRACE_FILE_MAX_BYTES = 50 * 1024 * 1024
+# Number of rotated trace files kept besides the current one
+TRACE_FILE_BACKUPS = 3
+
+# How often the event loop is checked
+LOOP_LAG_INTERVAL_SECONDS = 0.1
+# A callback which blocks the event loop longer than this is logged with its stack
+LOOP_BLOCK_THRESHOLD_SECONDS = 0.25
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    """
+    The spans of one request
+    """
+
+    def __init__(self, trace_id: str, attrs: dict):
+        self.trace_id = trace_id
+        # Written with every span of the trace, e.g. the channel
+        self.attrs = attrs
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('bing_chat_bot_trace', default=None)
+
+
+class Span:
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Tracer:
+    """
+    Write the spans of each request as JSON lines to a rotating file. Spans are recorded in the task handling the request,
+    and files are written on a background thread. Nothing is recorded until the tracer is configured.
+    """
+
+    def __init__(self):
+        self._queue_handler: Optional[logging.handlers.QueueHandler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        # Trace ids are unique across the worker processes writing to the same directory
+        self._id_prefix = f"{os.getpid():x}"
+        self._ids = itertools.count(1)
+
+    @property
+    def enabled(self) -> bool:
+        return self._queue_handler is not None
+
+    def configure(self, path: str, max_bytes: int = TRACE_FILE_MAX_BYTES, backups: int = TRACE_FILE_BACKUPS):
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        records = queue.SimpleQueue()
+        self._queue_handler = logging.handlers.QueueHandler(records)
+        self._listener = logging.handlers.QueueListener(records, file_handler)
+        self._listener.start()
+        atexit.register(self.close)
+        logger.info(f"Writing trace spans to {path}")
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self._queue_handler = None
+
+    def start_trace(self, **attrs) -> Optional[Trace]:
+        """
+        A new trace for a request, or None if tracing is not enabled
+        """
+        if not self.enabled:
+            return None
+        return Trace(f"{self._id_prefix}-{next(self._ids)}", attrs)
+
+    @contextmanager
+    def activate(self, trace: Optional[Trace]):
+        """
+        Record the spans of the current task, and of the tasks it creates, in trace
+        """
+        token = _current_trace.set(trace)
+        try:
+            yield
+        finally:
+            _current_trace.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Record the enclosed code as a span of the current trace. Attributes can be added to the yielded span.
+        """
+        trace = _current_trace.get()
+        if trace is None or not self.enabled:
+            yield Span(name, attrs)
+            return
+        span = Span(name, attrs)
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            self.record(trace, name, start_time, time.perf_counter() - start, **span.attrs)
+
+    def record(self, trace: Optional[Trace], name: str, start_time: float, duration: float, **attrs):
+        """
+        Record a span which has already ended. start_time is in seconds since the epoch.
+        """
+        if trace is None or not self.enabled:
+            return
+        line = json.dumps({'trace': trace.trace_id, 'span': name, 'start': round(start_time, 6), 'duration_ms': round(duration * 1000, 3),
+                           **trace.attrs, **attrs}, default=str)
+        self._queue_handler.emit(logging.makeLogRecord({'msg': line}))
+
+
+TRACER = Tracer()
+
+
+class LoopLagMonitorStats:
+    def __init__(self, max_lag, blocks):
+        self.max_lag: float = max_lag
+        self.blocks: int = blocks
+
+
+class LoopLagMonitor:
+    """
+    Measure how late the event loop runs a periodic timer. A watchdog thread logs the stack of the loop thread
+    while a callback blocks it for longer than the threshold, which shows what the callback is doing.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS, block_threshold: float = LOOP_BLOCK_THRESHOLD_SECONDS):
+        self._interval = interval
+        self._block_threshold = block_threshold
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        # perf_counter() of the latest timer run, written by the loop and read by the watchdog
+        self._last_tick = time.perf_counter()
+        self._reported_tick: Optional[float] = None
+
+        self._max_lag = 0.0
+        self._blocks = 0
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_stats(self) -> LoopLagMonitorStats:
+        return LoopLagMonitorStats(self._max_lag, self._blocks)
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self._interval
+            await asyncio.sleep(self._interval)
+            now = time.perf_counter()
+            self._last_tick = now
+            lag = max(0.0, now - expected)
+            LOOP_LAG_SECONDS.observe(lag)
+            self._max_lag = max(self._max_lag, lag)
+            if lag > self._block_threshold:
+                logger.warning(f"The event loop was blocked for {lag:.3f}s")
+
+    def _watch(self):
+        while not self._stopped.wait(self._interval):
+            last_tick = self._last_tick
+            blocked = time.perf_counter() - last_tick - self._interval
+            if blocked <= self._block_threshold or self._reported_tick == last_tick:
+                continue
+            # Report each block once, with the stack at the time it crossed the threshold
+            self._reported_tick = last_tick
+            self._blocks += 1
+            LOOP_BLOCKS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(unknown)\n"
+            logger.warning(f"The event loop has been blocked for {blocked:.3f}s, in:\n{stack.rstrip()}")
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from .edge import is_not_allowed_to_access
+from .profile import Profile, ProfilePool
+
+if TYPE_CHECKING:
+    from EdgeGPT import Chatbot
+
+# Number of ready conversations kept for each profile
+WARM_CONVERSATIONS_PER_PROFILE = 1
+
+# Ready conversations older than this are replaced, Bing expires conversations which are never used
+WARM_CONVERSATION_MAX_AGE_SECONDS = 10 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationWarmerStats:
+    def __init__(self, ready, hits, misses):
+        self.ready: int = ready
+        self.hits: int = hits
+        self.misses: int = misses
+
+
+class ConversationWarmer:
+    """
+    Keep already created conversations ready for each profile, so that a reset or a switch does not wait for the handshake.
+    Conversations are created and closed in the background.
+    """
+
+    def __init__(self,
+                 profile_pool: ProfilePool,
+                 create_conversation: Callable[[Profile], Awaitable['Chatbot']],
+                 size: int = WARM_CONVERSATIONS_PER_PROFILE,
+                 max_age_seconds: float = WARM_CONVERSATION_MAX_AGE_SECONDS):
+        self._pool = profile_pool
+        self._create_conversation = create_conversation
+        self._size = size
+        self._max_age_seconds = max_age_seconds
+
+        # profile index -> (creation time, conversation)
+        self._ready: Dict[int, Deque[Tuple[float, 'Chatbot']]] = {}
+        self._refill_tasks: Dict[int, asyncio.Task] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._maintain_task: Optional[asyncio.Task] = None
+
+        self._hits = 0
+        self._misses = 0
+
+    def start(self):
+        if self._maintain_task is None or self._maintain_task.done():
+            self._maintain_task = asyncio.get_running_loop().create_task(self._maintain())
+
+    def take(self, profile: Profile) -> Optional['Chatbot']:
+        """
+        Take a ready conversation of the profile, or None if there is none. The profile is refilled in the background.
+        """
+        ready = self._ready.get(profile.index)
+        conversation = None
+        now = time.monotonic()
+        while ready:
+            created_at, candidate = ready.popleft()
+            if now - created_at < self._max_age_seconds:
+                conversation = candidate
+                break
+            self.discard(candidate)
+        if conversation is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        if self._maintain_task is not None:
+            self._refill(profile)
+        return conversation
+
+    def discard(self, conversation: 'Chatbot'):
+        """
+        Close a conversation in the background
+        """
+        self._run_in_background(self._close(conversation))
+
+    def discard_profile(self, profile: Profile):
+        """
+        Close the ready conversations of a profile, e.g. after its cookies have changed. The profile is refilled unless it has been retired.
+        """
+        task = self._refill_tasks.pop(profile.index, None)
+        if task is not None:
+            task.cancel()
+        ready = self._ready.get(profile.index)
+        while ready:
+            self.discard(ready.popleft()[1])
+        if self._maintain_task is not None and not profile.retired:
+            self._refill(profile)
+
+    def get_stats(self) -> ConversationWarmerStats:
+        return ConversationWarmerStats(sum(len(ready) for ready in self._ready.values()), self._hits, self._misses)
+
+    async def close(self):
+        if self._maintain_task is not None:
+            self._maintain_task.cancel()
+        for task in list(self._refill_tasks.values()):
+            task.cancel()
+        for ready in self._ready.values():
+            while ready:
+                self.discard(ready.popleft()[1])
+        if len(self._background_tasks) > 0:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+    async def _maintain(self):
+        while True:
+            now = time.monotonic()
+            for profile in self._pool.profiles:
+                ready = self._ready.setdefault(profile.index, deque())
+                while ready and now - ready[0][0] >= self._max_age_seconds:
+                    self.discard(ready.popleft()[1])
+                if not profile.retired:
+                    self._refill(profile)
+            await asyncio.sleep(self._max_age_seconds / 2)
+
+    def _refill(self, profile: Profile):
+        task = self._refill_tasks.get(profile.index)
+        if task is not None and not task.done():
+            return
+        self._refill_tasks[profile.index] = asyncio.get_running_loop().create_task(self._refill_profile(profile))
+
+    async def _refill_profile(self, profile: Profile):
+        ready = self._ready.setdefault(profile.index, deque())
+        while len(ready) < self._size and not profile.retired and not profile.is_cooling_down():
+            try:
+                conversation = await self._create_conversation(profile)
+            except Exception as e:
+                if is_not_allowed_to_access(e):
+                    self._pool.cooldown(profile, f"Not allowed to access: {e}")
+                    return
+                logger.exception(f"Error occurs during warming up a conversation of profile {profile.index + 1}")
+                return
+            ready.append((time.monotonic(), conversation))
+
+    def _run_in_background(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    @staticmethod
+    async def _close(conversation: 'Chatbot'):
+        try:
+            await conversation.close()
+        except Exception:
+            pass
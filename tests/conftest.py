@@ -0,0 +1,14 @@
+import json
+from typing import List
+
+import pytest
+
+
+@pytest.fixture
+def cookie_paths(tmp_path) -> List[str]:
+    paths = []
+    for index in range(2):
+        path = tmp_path / f"cookies-{index}.json"
+        path.write_text(json.dumps([{'name': '_U', 'value': f"u{index}"}]), encoding='utf-8')
+        paths.append(str(path))
+    return paths
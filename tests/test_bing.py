@@ -0,0 +1,158 @@
+import asyncio
+
+from bing_chat_bot.bing import BingBot, BingBotOptions, BingBotResponse
+from bing_chat_bot.cache import ResponseCache
+from bing_chat_bot.profile import ProfilePool
+
+
+def test_follow_up_after_cache_hit_is_not_answered_from_cache(cookie_paths):
+    cache = ResponseCache(["balanced"])
+    cache.put("What is X?", "balanced", BingBotResponse(True, "X is a letter."))
+    cache.put("tell me more", "balanced", BingBotResponse(True, "An answer to another conversation."))
+    bing = BingBot(ProfilePool(cookie_paths), cache)
+
+    first = asyncio.run(bing.converse("What is X?"))
+
+    assert first.message == "X is a letter."
+    # The follow-up depends on the cached exchange, so it has to go to Bing with that exchange as context
+    assert bing._get_cached_response("tell me more") is None
+    assert cache.get_stats().hits == 1
+
+
+class FakeChatbot:
+    def __init__(self, response: dict):
+        self.response = response
+        self.contexts = []
+
+    async def ask(self, prompt, conversation_style, webpage_context=None):
+        self.contexts.append(webpage_context)
+        return self.response
+
+    async def close(self):
+        pass
+
+
+def test_message_rejected_at_the_conversation_limit_is_carried_over(cookie_paths, monkeypatch):
+    full = FakeChatbot({'item': {'result': {'value': 'Throttled', 'message': "Request is throttled."}, 'messages': []}})
+    fresh = FakeChatbot({'item': {
+        'result': {'value': 'Success', 'message': None},
+        'throttling': {'numUserMessagesInConversation': 1, 'maxNumUserMessagesInConversation': 20},
+        'messages': [{'author': 'bot', 'text': "The answer", 'suggestedResponses': []}]
+    }})
+
+    async def create_chatbot(profile):
+        return fresh
+
+    monkeypatch.setattr("bing_chat_bot.bing.create_chatbot", create_chatbot)
+    pool = ProfilePool(cookie_paths)
+    # A restored conversation which does not know how many messages it has left, with carry-over disabled
+    bing = BingBot(pool, options=BingBotOptions(carry_over_turns_left=0))
+    bing._bot = full
+    bing._turns = 20
+    bing._recent_turns.append(("What is X?", "X is a letter."))
+
+    bing_resp = asyncio.run(bing.converse("tell me more"))
+
+    assert bing_resp.success and bing_resp.message == "The answer"
+    assert "What is X?" in fresh.contexts[0]
+    assert not any(profile.is_cooling_down() for profile in pool.profiles)
+
+
+def _success(text: str) -> dict:
+    return {'item': {
+        'result': {'value': 'Success', 'message': None},
+        'throttling': {'numUserMessagesInConversation': 1, 'maxNumUserMessagesInConversation': 20},
+        'messages': [{'author': 'bot', 'text': text, 'suggestedResponses': []}]
+    }}
+
+
+class SlowChatbot:
+    def __init__(self, delay: float, response: dict):
+        self.delay = delay
+        self.response = response
+        self.cancelled = False
+        self.closed = False
+
+    async def ask(self, prompt, conversation_style, webpage_context=None):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return self.response
+
+    async def close(self):
+        self.closed = True
+
+
+def _create_bing(cookie_paths, monkeypatch, primary: SlowChatbot, other: SlowChatbot, timeout: float = 5) -> BingBot:
+    async def create_chatbot(profile):
+        return other
+
+    monkeypatch.setattr("bing_chat_bot.bing.create_chatbot", create_chatbot)
+    monkeypatch.setattr(BingBot, "_get_hedge_delay", lambda self: 0.02)
+    bing = BingBot(ProfilePool(cookie_paths), options=BingBotOptions(request_timeout_seconds=timeout))
+    bing._bot = primary
+    return bing
+
+
+def test_request_past_the_deadline_resets_the_conversation(cookie_paths, monkeypatch):
+    stuck = SlowChatbot(5, _success("Too late"))
+    fresh = SlowChatbot(0, _success("The answer"))
+    bing = _create_bing(cookie_paths, monkeypatch, stuck, fresh, timeout=0.05)
+    monkeypatch.setattr(BingBot, "_get_hedge_delay", lambda self: None)
+
+    async def run():
+        return await bing.converse("What is X?"), await bing.converse("What is X?")
+
+    timed_out, answered = asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert not timed_out.success and "within 0.05 seconds" in timed_out.message
+    assert stuck.cancelled and stuck.closed
+    assert answered.success and answered.message == "The answer"
+
+
+def test_hedge_wins_when_the_primary_is_slow(cookie_paths, monkeypatch):
+    primary = SlowChatbot(5, _success("Primary"))
+    hedge = SlowChatbot(0.02, _success("Hedge"))
+    bing = _create_bing(cookie_paths, monkeypatch, primary, hedge)
+    primary_profile, hedge_profile = bing._pool.profiles
+
+    async def run():
+        bing_resp = await bing.converse("What is X?")
+        # The losing conversation is closed in the background
+        await asyncio.sleep(0.01)
+        return bing_resp
+
+    bing_resp = asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert bing_resp.message == "Hedge"
+    assert bing._bot is hedge and bing._lease.profile is hedge_profile
+    assert primary.cancelled and primary.closed
+    assert len(primary_profile.conversation_usages) == 0 and primary_profile.in_flight == 0
+
+
+def test_primary_wins_and_the_hedge_is_cancelled(cookie_paths, monkeypatch):
+    primary = SlowChatbot(0.06, _success("Primary"))
+    hedge = SlowChatbot(5, _success("Hedge"))
+    bing = _create_bing(cookie_paths, monkeypatch, primary, hedge)
+    primary_profile, hedge_profile = bing._pool.profiles
+
+    async def run():
+        bing_resp = await bing.converse("What is X?")
+        await asyncio.sleep(0.01)
+        return bing_resp
+
+    bing_resp = asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert bing_resp.message == "Primary"
+    assert bing._bot is primary and bing._lease.profile is primary_profile
+    assert hedge.cancelled and hedge.closed
+    assert len(hedge_profile.conversation_usages) == 0 and hedge_profile.in_flight == 0
+
+
+def test_failed_primary_does_not_win_over_a_successful_hedge(cookie_paths, monkeypatch):
+    primary = SlowChatbot(0.04, {'item': {'result': {'value': 'Throttled', 'message': "Request is throttled."}, 'messages': []}})
+    hedge = SlowChatbot(0.08, _success("Hedge"))
+    bing = _create_bing(cookie_paths, monkeypatch, primary, hedge)
+
+    bing_resp = asyncio.run(asyncio.wait_for(bing.converse("What is X?"), timeout=2))
+    assert bing_resp.success and bing_resp.message == "Hedge"
+    assert bing._bot is hedge
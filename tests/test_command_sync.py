@@ -0,0 +1,60 @@
+import asyncio
+
+from bing_chat_bot.command_sync import CommandSyncState, default_state_path, sync_commands_if_changed
+
+
+class FakeCommand:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.type = 1
+        self.id = None
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'description': self.description, 'type': self.type}
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeBot:
+    def __init__(self, commands, user_id: int = 1):
+        self.pending_application_commands = commands
+        self.user = FakeUser(user_id)
+        self._application_commands = {}
+        self.syncs = 0
+
+    async def sync_commands(self):
+        self.syncs += 1
+        for index, command in enumerate(self.pending_application_commands):
+            command.id = str(1000 + index)
+            self._application_commands[command.id] = command
+
+
+def _sync(bot, state) -> bool:
+    return asyncio.run(sync_commands_if_changed(bot, state))
+
+
+def test_unchanged_commands_are_not_synced_again(tmp_path):
+    state = CommandSyncState(str(tmp_path / "commands.json"))
+    assert _sync(FakeBot([FakeCommand("chat", "Chat"), FakeCommand("reset", "Reset")]), state)
+
+    # A restart with the same commands takes their ids from the state
+    restarted = FakeBot([FakeCommand("chat", "Chat"), FakeCommand("reset", "Reset")])
+    assert not _sync(restarted, state)
+    assert restarted.syncs == 0
+    assert [command.id for command in restarted.pending_application_commands] == ["1000", "1001"]
+    assert set(restarted._application_commands) == {"1000", "1001"}
+
+    changed = FakeBot([FakeCommand("chat", "Chat with Bing"), FakeCommand("reset", "Reset")])
+    assert _sync(changed, state)
+    # The same commands of another application are synced too
+    assert _sync(FakeBot([FakeCommand("chat", "Chat with Bing"), FakeCommand("reset", "Reset")], user_id=2), state)
+
+
+def test_default_state_path_is_per_token():
+    first, second = default_state_path("token-1"), default_state_path("token-2")
+    assert first != second and first == default_state_path("token-1")
+    assert "token-1" not in first
@@ -0,0 +1,109 @@
+import asyncio
+import json
+
+from bing_chat_bot.coordinator import CoordinatedProfilePool, ProfileCoordinator
+
+
+def test_workers_share_the_in_flight_slots_of_a_profile(cookie_paths, tmp_path):
+    async def run():
+        socket_path = str(tmp_path / "coordinator.sock")
+        coordinator = ProfileCoordinator(cookie_paths, socket_path, max_in_flight_per_profile=1)
+        await coordinator.start()
+        workers = [CoordinatedProfilePool(cookie_paths, socket_path) for _ in range(2)]
+        settings = []
+        workers[1].on_setting_changed = lambda name, value: settings.append((name, value))
+        for worker in workers:
+            await worker.connect()
+        while any(worker._writer is None for worker in workers):
+            await asyncio.sleep(0.01)
+
+        first = workers[0].acquire(0)
+        second = workers[1].acquire(0)
+        await first.begin_request()
+        waiting = asyncio.get_running_loop().create_task(second.begin_request())
+        await asyncio.sleep(0.1)
+        # The other worker already holds the only slot of the profile
+        blocked = not waiting.done()
+        first.end_request()
+        await asyncio.wait_for(waiting, timeout=1)
+        second.end_request()
+
+        workers[0].publish_setting("formatter_options", {'show_links': True})
+        while len(settings) == 0:
+            await asyncio.sleep(0.01)
+
+        for worker in workers:
+            await worker.close()
+        await coordinator.close()
+        return blocked, settings
+
+    assert asyncio.run(run()) == (True, [("formatter_options", {'show_links': True})])
+
+
+def test_profiles_are_identified_by_their_cookie_file(cookie_paths, tmp_path):
+    async def run():
+        extra_path = tmp_path / "cookies-extra.json"
+        extra_path.write_text(json.dumps([{'name': '_U', 'value': "extra"}]), encoding='utf-8')
+        socket_path = str(tmp_path / "coordinator.sock")
+        coordinator = ProfileCoordinator(cookie_paths, socket_path, max_in_flight_per_profile=1)
+        await coordinator.start()
+        # The workers have found the cookie files in other orders, and one of them has a file the coordinator does not know
+        workers = [CoordinatedProfilePool(cookie_paths, socket_path), CoordinatedProfilePool([cookie_paths[1], cookie_paths[0], str(extra_path)], socket_path)]
+        for worker in workers:
+            await worker.connect()
+        while any(worker._writer is None for worker in workers):
+            await asyncio.sleep(0.01)
+
+        workers[1].cooldown(workers[1].profiles[0], "test")
+        while not workers[0].profiles[1].is_cooling_down():
+            await asyncio.sleep(0.01)
+        cooling_down = [profile.is_cooling_down() for profile in workers[0].profiles]
+
+        # The coordinator rejects the slot of the unknown profile, and the worker goes on with its own bound
+        lease = workers[1].acquire(2)
+        await asyncio.wait_for(lease.begin_request(), timeout=1)
+        lease.end_request()
+
+        for worker in workers:
+            await worker.close()
+        await coordinator.close()
+        return cooling_down, [profile.cookie_path for profile in coordinator._pool.profiles if profile.is_cooling_down()]
+
+    assert asyncio.run(run()) == ([False, True], [cookie_paths[1]])
+
+
+def test_a_slot_is_only_released_for_the_profile_it_was_granted_for(cookie_paths, tmp_path):
+    async def run():
+        socket_path = str(tmp_path / "coordinator.sock")
+        coordinator = ProfileCoordinator(cookie_paths, socket_path, max_in_flight_per_profile=1)
+        await coordinator.start()
+        connections = [await asyncio.open_unix_connection(socket_path) for _ in range(2)]
+
+        async def send(index, message):
+            connections[index][1].write(json.dumps(message).encode('utf-8') + b"\n")
+            await connections[index][1].drain()
+
+        async def granted(index) -> bool:
+            try:
+                while True:
+                    message = json.loads(await asyncio.wait_for(connections[index][0].readline(), timeout=0.2))
+                    if message['op'] == 'granted':
+                        return True
+            except asyncio.TimeoutError:
+                return False
+
+        await send(0, {'op': 'acquire', 'profile': cookie_paths[0], 'id': 1})
+        first = await granted(0)
+        await send(1, {'op': 'acquire', 'profile': cookie_paths[0], 'id': 1})
+        # Released for the wrong profile, so the slot is still held
+        await send(0, {'op': 'release', 'profile': cookie_paths[1], 'id': 1})
+        wrong_release = await granted(1)
+        await send(0, {'op': 'release', 'profile': cookie_paths[0], 'id': 1})
+        release = await granted(1)
+
+        for _, writer in connections:
+            writer.close()
+        await coordinator.close()
+        return first, wrong_release, release
+
+    assert asyncio.run(run()) == (True, False, True)
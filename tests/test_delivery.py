@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import aiohttp
+
+from bing_chat_bot.delivery import CHANNEL_BURST, MessageDelivery, TextAttachment, text_attachment_file
+from bing_chat_bot.formatter import FormatterResponse, FormatterResponseType
+
+
+def test_text_attachment_is_sent_with_its_encoded_size():
+    text = "Ünïcode " * 5000 + "😀"
+    file = text_attachment_file(text)
+    form = aiohttp.FormData()
+    form.add_field("files[0]", file.fp, filename=file.filename)
+    payload = form()
+
+    attachment = TextAttachment(text)
+    assert attachment.read() == text.encode('utf-8')
+    assert attachment.size == len(text.encode('utf-8'))
+    # The multipart body has a known length, so the upload is not chunked
+    assert payload.size is not None and payload.size > attachment.size
+
+    attachment.seek(0)
+    assert attachment.read(10) == text.encode('utf-8')[:10]
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, sent: list, latency: float = 0):
+        self.id = channel_id
+        self.sent = sent
+        self.latency = latency
+
+    async def send(self, content=None, **params):
+        await asyncio.sleep(self.latency)
+        self.sent.append((self.id, content, time.monotonic()))
+        return FakeMessage(self, content)
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, content: str = None):
+        self.channel = channel
+        self.content = content
+
+    async def reply(self, mention_author=False, content=None, **params):
+        return await self.channel.send(content, **params)
+
+
+def _texts(*texts):
+    return [FormatterResponse(FormatterResponseType.NORMAL, text) for text in texts]
+
+
+def test_queued_replies_and_later_sends_keep_their_order_in_a_channel():
+    sent = []
+
+    async def run():
+        delivery = MessageDelivery()
+        # The first reply is slow to send, so later sends would overtake it if they were not ordered
+        slow = FakeMessage(FakeChannel(1, sent, latency=0.01))
+        other = FakeMessage(FakeChannel(2, sent))
+        delivery.queue(_texts("a1", "a2", "a3"), slow)
+        delivery.queue(_texts("b1"), other)
+        delivery.queue(_texts("c1", "c2"), slow)
+        await delivery.send(slow, reply=True, content="d1")
+        await delivery.close()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert [content for channel, content, _ in sent if channel == 1] == ["a1", "a2", "a3", "c1", "c2", "d1"]
+    # Another channel does not wait for it
+    assert sent[0][1] == "b1"
+
+
+def test_sends_beyond_the_burst_of_a_channel_are_paced(monkeypatch):
+    monkeypatch.setattr("bing_chat_bot.delivery.CHANNEL_REQUESTS_PER_SECOND", 20.0)
+    sent = []
+
+    async def run():
+        delivery = MessageDelivery()
+        await delivery.deliver(_texts(*[str(index) for index in range(CHANNEL_BURST + 2)]), FakeMessage(FakeChannel(1, sent)))
+        await delivery.deliver(_texts("other"), FakeMessage(FakeChannel(2, sent)))
+
+    asyncio.run(asyncio.wait_for(run(), timeout=2))
+    times = [sent_at for channel, _, sent_at in sent if channel == 1]
+    assert times[CHANNEL_BURST - 1] - times[0] < 0.04
+    # One token comes back every 0.05 seconds
+    assert times[-1] - times[CHANNEL_BURST - 1] >= 0.09
+    assert [content for channel, content, _ in sent if channel == 2] == ["other"]
+
+
+def test_failed_reply_is_logged_and_does_not_block_the_channel(caplog):
+    sent = []
+
+    class FailingMessage(FakeMessage):
+        async def reply(self, mention_author=False, content=None, **params):
+            raise RuntimeError("send failed")
+
+    async def run():
+        delivery = MessageDelivery()
+        channel = FakeChannel(1, sent)
+        delivery.queue(_texts("lost"), FailingMessage(channel))
+        await delivery.deliver(_texts("next"), FakeMessage(channel))
+
+    asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert [content for _, content, _ in sent] == ["next"]
+    assert "Error occurs during delivering a response in channel 1" in caplog.text
@@ -0,0 +1,64 @@
+import random
+import re
+
+import pytest
+
+from bing_chat_bot.formatter import Formatter
+
+_FENCE_PATTERN = re.compile(r"```[\w+#.-]*")
+
+# Pieces of the generated texts, with fences at and not at line starts
+_PIECES = ["word ", "longerword ", "\n", "\n\n", "```", "```python\n", "    ", "  \n", "x" * 30, " ```js\n", "`", "\n```\n"]
+
+
+def _content(text: str) -> str:
+    """
+    The text without the fences and whitespace, which the splitting may add or remove
+    """
+    return re.sub(r"\s", "", _FENCE_PATTERN.sub("", text))
+
+
+def _assert_split(text: str, limit_length: int):
+    chunks = Formatter.split_text(text, limit_length)
+    assert _content("\n".join(chunks)) == _content(text)
+    assert all(len(chunk) <= limit_length for chunk in chunks)
+    if text.count("```") % 2 == 0:
+        assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
+    return chunks
+
+
+def test_split_keeps_fences_not_at_line_start():
+    text = "Here is the code: ```python\n" + "".join(f"print({i})\n" for i in range(30)) + "``` and the rest " + "word " * 20
+    chunks = _assert_split(text, 80)
+    assert chunks[0].startswith("Here is the code: ```python\n")
+    assert all(chunk.startswith("```python\n") for chunk in chunks[1:-1])
+
+
+@pytest.mark.parametrize("limit_length", range(36, 44))
+def test_split_does_not_break_inside_a_fence_line(limit_length):
+    text = "x" * 30 + " ```python\n" + "y" * 60 + "\n```"
+    chunks = _assert_split(text, limit_length)
+    assert chunks[0] == "x" * 30
+    assert all(chunk.startswith("```python\ny") for chunk in chunks[1:])
+
+
+def test_split_code_chunk_of_only_whitespace():
+    text = "intro " * 5 + "```python\n" + " \n" * 30 + "print(1)\n```"
+    chunks = _assert_split(text, 40)
+    assert "```python```" not in "".join(chunks)
+    assert all(not chunk.endswith("```python\n```") for chunk in chunks)
+
+
+def test_split_cuts_a_fence_line_longer_than_the_limit():
+    text = "```" + "x" * 60 + "\nprint(1)\n```"
+    chunks = _assert_split(text, 25)
+    assert all(chunk.startswith("```x") for chunk in chunks[:-1])
+    assert chunks[-1] == "```\nprint(1)\n```"
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_split_round_trip_and_fence_balance(seed):
+    rnd = random.Random(seed)
+    text = "".join(rnd.choice(_PIECES) for _ in range(rnd.randint(5, 120)))
+    limit_length = rnd.randint(20, 120)
+    _assert_split(text, limit_length)
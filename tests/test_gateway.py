@@ -0,0 +1,124 @@
+import asyncio
+import json
+
+import aiohttp
+from aiohttp.test_utils import TestClient, TestServer
+
+from bing_chat_bot.gateway import Gateway
+from bing_chat_bot.profile import ProfilePool
+from bing_chat_bot.scheduler import RequestScheduler
+from bing_chat_bot.session import SessionManager
+
+
+def _success(text: str) -> dict:
+    return {'item': {
+        'result': {'value': 'Success', 'message': None},
+        'throttling': {'numUserMessagesInConversation': 1, 'maxNumUserMessagesInConversation': 20},
+        'messages': [{'author': 'bot', 'text': text, 'suggestedResponses': [], 'adaptiveCards': [{'body': [{'text': text}, {'text': ""}]}]}]
+    }}
+
+
+class FakeChatbot:
+    def __init__(self, prompts, release: asyncio.Event):
+        self.prompts = prompts
+        self.release = release
+
+    async def ask(self, prompt, conversation_style, webpage_context=None):
+        self.prompts.append(prompt)
+        await self.release.wait()
+        return _success(f"Answer to {prompt}")
+
+    async def ask_stream(self, prompt, conversation_style, webpage_context=None):
+        self.prompts.append(prompt)
+        yield False, "Answer"
+        yield False, "Answer to"
+        yield True, _success(f"Answer to {prompt}")
+
+    async def close(self):
+        pass
+
+
+def _run_gateway(cookie_paths, monkeypatch, test, max_in_flight: int = 4, **gateway_options):
+    prompts = []
+
+    async def run():
+        release = asyncio.Event()
+        release.set()
+
+        async def create_chatbot(profile):
+            return FakeChatbot(prompts, release)
+
+        monkeypatch.setattr("bing_chat_bot.bing.create_chatbot", create_chatbot)
+        sessions = SessionManager(ProfilePool(cookie_paths))
+        scheduler = RequestScheduler(lambda request: request.context.run(), max_in_flight=max_in_flight)
+        gateway = Gateway(sessions, scheduler, **gateway_options)
+        async with TestClient(TestServer(gateway.create_app())) as client:
+            await test(client, release)
+        await sessions.close()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    return prompts
+
+
+def test_requests_without_a_valid_token_are_rejected(cookie_paths, monkeypatch):
+    async def test(client, release):
+        for headers in ({}, {'Authorization': "Bearer wrong"}, {'Authorization': "secret"}):
+            resp = await client.post("/v1/conversations/a/messages", json={'text': "hi"}, headers=headers)
+            assert resp.status == 401
+        resp = await client.post("/v1/conversations/a/messages", json={'text': "hi"}, headers={'Authorization': "Bearer secret"})
+        assert resp.status == 200
+        assert (await resp.json())['message'] == "Answer to hi"
+
+    assert _run_gateway(cookie_paths, monkeypatch, test, tokens=["other", "secret"]) == ["hi"]
+
+
+def test_batch_size_is_limited(cookie_paths, monkeypatch):
+    async def test(client, release):
+        for prompts in ([], ["a", ""], ["a", "b", "c"], "a"):
+            resp = await client.post("/v1/batch", json={'prompts': prompts})
+            assert resp.status == 400
+        resp = await client.post("/v1/batch", json={'prompts': ["a", "b"]})
+        assert resp.status == 200
+        assert [r['message'] for r in (await resp.json())['responses']] == ["Answer to a", "Answer to b"]
+
+    assert sorted(_run_gateway(cookie_paths, monkeypatch, test, max_batch=2)) == ["a", "b"]
+
+
+def test_request_of_a_client_which_has_gone_is_not_sent_to_bing(cookie_paths, monkeypatch):
+    monkeypatch.setattr("bing_chat_bot.gateway.DISCONNECT_POLL_SECONDS", 0.01)
+
+    async def test(client, release):
+        release.clear()
+        # Holds the only in-flight slot
+        busy = asyncio.get_running_loop().create_task(client.post("/v1/conversations/a/messages", json={'text': "first"}))
+        await asyncio.sleep(0.05)
+        try:
+            await client.post("/v1/conversations/b/messages", json={'text': "gone"}, timeout=aiohttp.ClientTimeout(total=0.05))
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(0.05)
+        release.set()
+        assert (await (await busy).json())['message'] == "Answer to first"
+        resp = await client.post("/v1/conversations/b/messages", json={'text': "next"})
+        assert (await resp.json())['message'] == "Answer to next"
+
+    assert _run_gateway(cookie_paths, monkeypatch, test, max_in_flight=1) == ["first", "next"]
+
+
+def test_streaming_responses(cookie_paths, monkeypatch):
+    async def test(client, release):
+        resp = await client.post("/v1/conversations/a/messages", json={'text': "hi", 'stream': True})
+        assert resp.headers['Content-Type'] == "application/x-ndjson"
+        lines = [json.loads(line) for line in (await resp.read()).decode('utf-8').splitlines()]
+        assert lines[:-1] == [{'partial': "Answer"}, {'partial': "Answer to"}]
+        assert lines[-1]['response']['message'] == "Answer to hi"
+
+        async with client.ws_connect("/v1/ws") as ws:
+            await ws.send_json({'id': 1, 'session': "b", 'text': "hello", 'stream': True})
+            events = []
+            while len(events) == 0 or 'response' not in events[-1]:
+                events.append(await ws.receive_json())
+        assert [event.get('partial') for event in events[:-1]] == ["Answer", "Answer to"]
+        assert events[-1]['id'] == 1 and events[-1]['response']['message'] == "Answer to hello"
+
+    _run_gateway(cookie_paths, monkeypatch, test)
@@ -0,0 +1,61 @@
+import asyncio
+
+from bing_chat_bot.delivery import MessageDelivery
+from bing_chat_bot.formatter import FormatterResponse, FormatterResponseType
+from bing_chat_bot.metrics import LARGE_TEXT_FALLBACKS, SPLIT_FAILURES, Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_metrics_are_rendered_in_the_prometheus_text_format():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter("test_events_total", "Events", ["reason"]))
+    gauge = registry.register(Gauge("test_in_flight", "In flight", ["profile"]))
+    histogram = registry.register(Histogram("test_seconds", "Latency", buckets=(0.1, 1)))
+    counter.inc(reason='say "hi"\n')
+    counter.inc(2, reason='say "hi"\n')
+    gauge.set_function(lambda: [({'profile': 1}, 3)])
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render() == "\n".join([
+        "# HELP test_events_total Events",
+        "# TYPE test_events_total counter",
+        'test_events_total{reason="say \\"hi\\"\\n"} 3',
+        "# HELP test_in_flight In flight",
+        "# TYPE test_in_flight gauge",
+        'test_in_flight{profile="1"} 3',
+        "# HELP test_seconds Latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 5.55",
+        "test_seconds_count 3",
+    ]) + "\n"
+
+
+class FakeChannel:
+    id = 1
+
+
+class FakeMessage:
+    def __init__(self):
+        self.channel = FakeChannel()
+        self.replies = []
+
+    async def reply(self, mention_author=False, **params):
+        self.replies.append(params)
+        return self
+
+
+def test_text_file_fallback_is_counted_when_it_is_sent():
+    large_text = [FormatterResponse(FormatterResponseType.LARGE_TEXT, "a" * 5000)]
+    sent, split_failures = LARGE_TEXT_FALLBACKS.get(), SPLIT_FAILURES.get()
+    message = FakeMessage()
+
+    asyncio.run(MessageDelivery().deliver(large_text, message))
+    asyncio.run(MessageDelivery().deliver(large_text, message))
+
+    assert len(message.replies) == 2
+    assert LARGE_TEXT_FALLBACKS.get() == sent + 2
+    assert SPLIT_FAILURES.get() == split_failures
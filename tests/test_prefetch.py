@@ -0,0 +1,31 @@
+import asyncio
+
+from bing_chat_bot.profile import ProfilePool
+from bing_chat_bot.scheduler import RequestScheduler
+
+
+def test_speculations_are_placed_on_different_idle_profiles(cookie_paths):
+    pool = ProfilePool(cookie_paths)
+
+    first = pool.acquire_idle()
+    second = pool.acquire_idle()
+
+    # The first lease counts as busy although its request has not begun yet
+    assert first.profile is not second.profile
+    assert pool.acquire_idle() is None
+    first.release()
+    assert pool.acquire_idle().profile is first.profile
+
+
+def test_speculation_only_uses_spare_in_flight_capacity():
+    async def run():
+        async def handle(request):
+            pass
+
+        scheduler = RequestScheduler(handle, max_in_flight=1)
+        admitted = scheduler.take_speculative_tokens(1, 2)
+        async with scheduler.speculative_slot() as held:
+            # The only slot is held by the speculation
+            return admitted, held, scheduler.take_speculative_tokens(1, 2), scheduler.get_stats().in_flight
+
+    assert asyncio.run(run()) == (True, True, False, 1)
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import os
+
+from bing_chat_bot.initializer import BotManager
+from bing_chat_bot.profile import IN_FLIGHT_REQUESTS_PER_PROFILE, ProfilePool
+from bing_chat_bot.reload import ConfigReloader
+
+
+def _write(path, content: str):
+    with open(path, "w", encoding='utf-8') as f:
+        f.write(content)
+    # Make the change visible even within the timestamp granularity of the file system
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_invalid_config_is_rejected_and_the_previous_one_kept(cookie_paths, tmp_path):
+    config_path = str(tmp_path / "config.json")
+    _write(config_path, json.dumps({'request_timeout_seconds': 60}))
+    changes = []
+    reloader = ConfigReloader(ProfilePool(cookie_paths), cookie_paths, config_path,
+                              on_config_changed=lambda config, previous: changes.append(config))
+
+    for invalid in ("{not json", json.dumps({'request_timeout_seconds': -1}), json.dumps({'unknown': 1})):
+        _write(config_path, invalid)
+        reloader.check()
+        assert reloader.config == {'request_timeout_seconds': 60}
+    _write(config_path, json.dumps({'request_timeout_seconds': 30}))
+    reloader.check()
+
+    assert changes == [{'request_timeout_seconds': 30}]
+    assert reloader.get_stats().rejected == 3 and reloader.get_stats().reloads == 1
+
+
+def test_invalid_cookie_file_is_rejected_and_the_previous_cookies_kept(cookie_paths):
+    pool = ProfilePool(cookie_paths)
+    reloader = ConfigReloader(pool, cookie_paths)
+    cookies = pool.profiles[0].cookies
+
+    _write(cookie_paths[0], "[{")
+    reloader.check()
+    assert pool.profiles[0].cookies == cookies
+    assert reloader.get_stats().rejected == 1
+
+    _write(cookie_paths[0], json.dumps([{'name': '_U', 'value': "new"}]))
+    reloader.check()
+    assert pool.profiles[0].cookies == [{'name': '_U', 'value': "new"}]
+
+
+def test_swapping_profiles_keeps_the_leases_in_flight(cookie_paths):
+    async def run():
+        pool = ProfilePool(cookie_paths)
+        reloader = ConfigReloader(pool, cookie_paths)
+        leases = [pool.acquire(0), pool.acquire(1)]
+        for lease in leases:
+            await lease.begin_request()
+            lease.record_throttling(5, 20)
+
+        _write(cookie_paths[0], json.dumps([{'name': '_U', 'value': "new"}]))
+        os.remove(cookie_paths[1])
+        reloader.check()
+
+        # The requests in flight and the conversations go on with their profiles
+        assert [lease.profile for lease in leases] == pool.profiles
+        assert [profile.in_flight for profile in pool.profiles] == [1, 1]
+        assert [profile.conversations for profile in pool.profiles] == [1, 1]
+        for lease in leases:
+            lease.end_request()
+            lease.release()
+        assert [profile.in_flight for profile in pool.profiles] == [0, 0]
+        # New conversations are only placed on the profile which is still there, with the new cookies
+        assert all(pool.acquire().profile is pool.profiles[0] for _ in range(3))
+        assert pool.profiles[0].cookies == [{'name': '_U', 'value': "new"}]
+
+    asyncio.run(run())
+
+
+def test_request_cap_follows_the_reloaded_profiles(cookie_paths):
+    async def run():
+        manager = BotManager(cookie_paths)
+        scheduler = manager._scheduler
+        assert scheduler._semaphore._value == 2 * IN_FLIGHT_REQUESTS_PER_PROFILE
+
+        os.remove(cookie_paths[1])
+        manager.reloader.check()
+        await asyncio.sleep(0.01)
+        assert scheduler._semaphore._value == IN_FLIGHT_REQUESTS_PER_PROFILE
+
+        _write(cookie_paths[1], json.dumps([{'name': '_U', 'value': "u1"}]))
+        manager.reloader.check()
+        assert scheduler._semaphore._value == 2 * IN_FLIGHT_REQUESTS_PER_PROFILE
+
+    asyncio.run(run())
@@ -0,0 +1,73 @@
+import asyncio
+
+import discord
+
+from bing_chat_bot.bing import BingBotResponse
+from bing_chat_bot.initializer import BotManager
+
+CHANNEL_ID = 1111
+GUILD_ID = 2222
+MESSAGE_ID = 3333
+
+
+class RecordingContext(discord.ApplicationContext):
+    """
+    A real application context whose responses are recorded instead of sent
+    """
+
+    def __init__(self, bot: discord.Bot, interaction: discord.Interaction):
+        super().__init__(bot, interaction)
+        self.responses = []
+
+    async def respond(self, content, **kwargs):
+        self.responses.append(content)
+
+
+def create_context(bot: discord.Bot) -> RecordingContext:
+    # The guild is not cached, so the channel of the interaction is a PartialMessageable as in a fresh worker
+    interaction = discord.Interaction(data={
+        'id': '4444', 'application_id': '5555', 'type': 2, 'token': "token", 'version': 1,
+        'channel_id': str(CHANNEL_ID), 'guild_id': str(GUILD_ID),
+        'member': {'user': {'id': '6666', 'username': "user", 'discriminator': "0001", 'avatar': None},
+                   'roles': [], 'joined_at': "2023-01-01T00:00:00+00:00", 'deaf': False, 'mute': False},
+        'data': {'id': '7777', 'name': "replay", 'type': 1}
+    }, state=bot._connection)
+    return RecordingContext(bot, interaction)
+
+
+def run_replay(cookie_paths, prepare) -> list:
+    async def replay():
+        bot = discord.Bot(intents=discord.Intents.none())
+        bot_manager = BotManager(cookie_paths)
+        bot_manager.initialize(bot)
+        prepare(bot_manager)
+        sent = []
+
+        async def respond_messages(formatter_responses, original_message):
+            sent.append((original_message.channel.id, original_message.id, formatter_responses[0].value))
+
+        bot_manager._respond_messages = respond_messages
+        command = next(command for command in bot.pending_application_commands if command.name == 'replay')
+        ctx = create_context(bot)
+        await command.callback(ctx, 1)
+        await bot_manager.sessions.close()
+        return ctx.responses + sent
+
+    return asyncio.run(replay())
+
+
+def test_replay_from_history(cookie_paths):
+    def prepare(bot_manager: BotManager):
+        rendered = bot_manager._formatter.render(BingBotResponse(True, "The answer"))
+        bot_manager.history.add(CHANNEL_ID, rendered, CHANNEL_ID, MESSAGE_ID)
+
+    assert run_replay(cookie_paths, prepare) == ["Re-presenting the last message", (CHANNEL_ID, MESSAGE_ID, "The answer")]
+
+
+def test_replay_of_restored_session(cookie_paths):
+    def prepare(bot_manager: BotManager):
+        session = bot_manager.sessions.get(CHANNEL_ID)
+        session.bing_resp_cache = BingBotResponse(True, "The stored answer")
+        session.original_message_ids = (CHANNEL_ID, MESSAGE_ID)
+
+    assert run_replay(cookie_paths, prepare) == ["Re-presenting the last message", (CHANNEL_ID, MESSAGE_ID, "The stored answer")]
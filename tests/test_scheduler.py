@@ -0,0 +1,214 @@
+import asyncio
+
+import pytest
+
+from bing_chat_bot.scheduler import GUILD_BURST, GUILD_REQUESTS_PER_MINUTE, USER_BURST, RequestScheduler, ScheduledRequest
+
+
+def test_requests_beyond_the_burst_wait_without_raising_the_capacity():
+    async def run():
+        handled = []
+
+        async def handle(request):
+            handled.append(request.text)
+
+        scheduler = RequestScheduler(handle, max_in_flight=GUILD_BURST * 2)
+        # Like the prompts of a gateway batch, each in a conversation of its own
+        for index in range(GUILD_BURST * 2):
+            scheduler.submit(ScheduledRequest(("batch", index), "client", ("client", index), str(index), mergeable=False))
+        await asyncio.sleep(0.2)
+        bucket = scheduler._guild_buckets["client"]
+        return len(handled), bucket._capacity, bucket._rate
+
+    assert asyncio.run(run()) == (GUILD_BURST, GUILD_BURST, GUILD_REQUESTS_PER_MINUTE / 60)
+
+
+def test_cancelled_requests_are_dropped_and_their_tokens_given_back():
+    async def run():
+        handled = []
+        release = asyncio.Event()
+
+        async def handle(request):
+            handled.append(request.text)
+            await release.wait()
+
+        scheduler = RequestScheduler(handle, max_in_flight=1)
+        scheduler.submit(ScheduledRequest("first", "guild", "user-1", "first"))
+        # Takes its tokens, then waits for the only in-flight slot
+        waiting = ScheduledRequest("second", "guild", "user-2", "second")
+        scheduler.submit(waiting)
+        await asyncio.sleep(0.05)
+        tokens_taken = scheduler._guild_buckets["guild"]._tokens
+        waiting.cancelled = True
+        release.set()
+        await asyncio.sleep(0.05)
+        return handled, tokens_taken, scheduler._guild_buckets["guild"]._tokens, scheduler._user_buckets["user-2"]._tokens
+
+    handled, tokens_taken, guild_tokens, user_tokens = asyncio.run(run())
+    assert handled == ["first"]
+    assert guild_tokens == pytest.approx(tokens_taken + 1, abs=0.05)
+    assert user_tokens == pytest.approx(USER_BURST, abs=0.05)
+
+
+def test_direct_messages_of_different_users_do_not_share_a_bucket():
+    async def run():
+        handled = []
+
+        async def handle(request):
+            handled.append(request.user_key)
+
+        scheduler = RequestScheduler(handle, max_in_flight=4)
+        # More direct messages than the burst of a guild, each from another user in their own channel
+        for user in range(GUILD_BURST * 2):
+            assert scheduler.submit(ScheduledRequest(("dm", user), None, user, "hi")).accepted
+        while len(handled) < GUILD_BURST * 2:
+            await asyncio.sleep(0.01)
+        return sorted(handled)
+
+    assert asyncio.run(asyncio.wait_for(run(), timeout=2)) == list(range(GUILD_BURST * 2))
+
+
+def test_requests_of_a_channel_are_handled_in_order():
+    async def run():
+        handled = []
+
+        async def handle(request):
+            # Later requests would overtake a slow one if the channel were not serialised
+            await asyncio.sleep(0.03 if request.text == "0" else 0)
+            handled.append((request.channel_key, request.text))
+
+        scheduler = RequestScheduler(handle, max_in_flight=4)
+        for index in range(4):
+            for channel in ("a", "b"):
+                scheduler.submit(ScheduledRequest(channel, "guild", f"user-{index}", str(index)))
+        while len(handled) < 8:
+            await asyncio.sleep(0.01)
+        return handled
+
+    handled = asyncio.run(asyncio.wait_for(run(), timeout=2))
+    for channel in ("a", "b"):
+        assert [text for key, text in handled if key == channel] == ["0", "1", "2", "3"]
+
+
+def test_messages_of_a_user_are_coalesced_within_the_window():
+    async def run():
+        handled = []
+        release = asyncio.Event()
+
+        async def handle(request):
+            handled.append((request.text, request.merged_count))
+            await release.wait()
+
+        scheduler = RequestScheduler(handle, max_in_flight=1, coalesce_seconds=0.1)
+        scheduler.submit(ScheduledRequest("channel", "guild", "user", "busy"))
+        await asyncio.sleep(0.02)
+        results = [scheduler.submit(ScheduledRequest("channel", "guild", "user", "hello"))]
+        results.append(scheduler.submit(ScheduledRequest("channel", "guild", "user", "world")))
+        await asyncio.sleep(0.15)
+        # Past the window, a new request is queued
+        results.append(scheduler.submit(ScheduledRequest("channel", "guild", "user", "late")))
+        # A request which expects its own answer is never merged
+        results.append(scheduler.submit(ScheduledRequest("channel", "guild", "user", "own", mergeable=False)))
+        release.set()
+        while len(handled) < 4:
+            await asyncio.sleep(0.01)
+        return handled, [(result.accepted, result.merged) for result in results], scheduler.get_stats().merged
+
+    handled, results, merged = asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert handled == [("busy", 1), ("hello\nworld", 2), ("late", 1), ("own", 1)]
+    assert results == [(True, False), (True, True), (True, False), (True, False)]
+    assert merged == 1
+
+
+def test_a_full_channel_rejects_new_messages_and_reports_positions():
+    async def run():
+        release = asyncio.Event()
+
+        async def handle(request):
+            await release.wait()
+
+        scheduler = RequestScheduler(handle, max_in_flight=1, max_queue_per_channel=2)
+        positions = [scheduler.submit(ScheduledRequest("channel", "guild", "user-0", "0")).position]
+        await asyncio.sleep(0.02)
+        for index in range(1, 3):
+            result = scheduler.submit(ScheduledRequest("channel", "guild", f"user-{index}", str(index)))
+            assert result.accepted
+            positions.append(result.position)
+        rejected = scheduler.submit(ScheduledRequest("channel", "guild", "user-3", "3"))
+        # Another channel has a queue of its own
+        other = scheduler.submit(ScheduledRequest("other", "guild", "user-3", "3"))
+        stats = scheduler.get_stats()
+        release.set()
+        return positions, rejected.accepted, other.accepted, stats.rejected, stats.queued
+
+    positions, rejected, other, rejected_count, queued = asyncio.run(run())
+    assert positions == [0, 1, 2]
+    assert not rejected and other
+    assert rejected_count == 1
+    assert queued == 3
+
+
+def test_requests_in_flight_are_capped_across_channels():
+    async def run():
+        in_flight = 0
+        max_seen = 0
+        done = 0
+
+        async def handle(request):
+            nonlocal in_flight, max_seen, done
+            in_flight += 1
+            max_seen = max(max_seen, in_flight)
+            await asyncio.sleep(0.02)
+            in_flight -= 1
+            done += 1
+
+        scheduler = RequestScheduler(handle, max_in_flight=2)
+        for index in range(6):
+            scheduler.submit(ScheduledRequest(f"channel-{index}", "guild", f"user-{index}", "hi"))
+        await asyncio.sleep(0.01)
+        stats = scheduler.get_stats()
+        while done < 6:
+            await asyncio.sleep(0.01)
+        return max_seen, stats.in_flight, stats.queued
+
+    max_seen, stats_in_flight, stats_queued = asyncio.run(asyncio.wait_for(run(), timeout=2))
+    assert max_seen == 2
+    assert stats_in_flight == 2
+    # The others keep their place in the queues of their channels
+    assert stats_queued == 4
+
+
+def test_lowered_cap_applies_as_the_requests_in_flight_complete():
+    async def run():
+        in_flight = 0
+        releases = []
+
+        async def handle(request):
+            nonlocal in_flight
+            in_flight += 1
+            release = asyncio.Event()
+            releases.append(release)
+            await release.wait()
+            in_flight -= 1
+
+        scheduler = RequestScheduler(handle, max_in_flight=3)
+        for index in range(6):
+            scheduler.submit(ScheduledRequest(f"channel-{index}", "guild", f"user-{index}", "hi"))
+        await asyncio.sleep(0.01)
+        scheduler.set_max_in_flight(1)
+        # The requests in flight are not interrupted
+        assert in_flight == 3
+        for index in range(3):
+            releases[index].set()
+        await asyncio.sleep(0.01)
+        lowered = in_flight
+        scheduler.set_max_in_flight(2)
+        await asyncio.sleep(0.01)
+        raised = in_flight
+        while len(releases) < 6 or any(not release.is_set() for release in releases):
+            for release in releases:
+                release.set()
+            await asyncio.sleep(0.01)
+        return lowered, raised
+
+    assert asyncio.run(asyncio.wait_for(run(), timeout=2)) == (1, 2)
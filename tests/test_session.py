@@ -0,0 +1,57 @@
+import asyncio
+
+from bing_chat_bot.profile import ProfilePool
+from bing_chat_bot.session import SessionManager
+
+
+def test_least_recently_used_session_is_evicted(cookie_paths):
+    async def run():
+        sessions = SessionManager(ProfilePool(cookie_paths), max_sessions=2)
+        sessions.get(1)
+        sessions.get(2)
+        # Channel 1 becomes the most recently used
+        sessions.get(1)
+        sessions.get(3)
+
+        assert sessions.find(2) is None
+        assert sessions.find(1) is not None and sessions.find(3) is not None
+        assert sessions.get_stats().evictions == 1
+        await sessions.close()
+
+    asyncio.run(run())
+
+
+def test_idle_sessions_are_swept_without_traffic(cookie_paths):
+    async def run():
+        sessions = SessionManager(ProfilePool(cookie_paths), idle_seconds=0.05, sweep_seconds=0.02)
+        sessions.start()
+        sessions.get(1)
+        with sessions.use(2):
+            await asyncio.sleep(0.2)
+            # The session in use is kept however long the request takes
+            assert sessions.find(1) is None
+            assert sessions.find(2) is not None
+        assert sessions.get_stats().size == 1
+        await asyncio.sleep(0.2)
+
+        assert sessions.get_stats().size == 0
+        assert sessions.get_stats().evictions == 2
+        await sessions.close()
+
+    asyncio.run(run())
+
+
+def test_pinned_sessions_survive_eviction_until_released(cookie_paths):
+    async def run():
+        sessions = SessionManager(ProfilePool(cookie_paths), max_sessions=1)
+        with sessions.use(1) as pinned:
+            sessions.get(2)
+            sessions.get(3)
+            assert sessions.find(1) is pinned
+            assert sessions.find(2) is None
+        # Released beyond the limit, it was just used, so the least recently used one goes instead
+        assert sessions.find(1) is pinned
+        assert sessions.find(3) is None
+        await sessions.close()
+
+    asyncio.run(run())
@@ -0,0 +1,74 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+
+import pytest
+
+from bing_chat_bot.sharding import run_sharded
+
+
+def _start_sharded(cookie_paths, tmp_path) -> multiprocessing.Process:
+    async def run_idle_worker(profile_pool, worker_index, shard_ids):
+        while profile_pool._writer is None:
+            await asyncio.sleep(0.01)
+        (tmp_path / f"connected-{worker_index}").touch()
+        await asyncio.Event().wait()
+
+    parent = multiprocessing.get_context("fork").Process(target=run_sharded,
+                                                         args=(cookie_paths, 2, 2, str(tmp_path / "coordinator.sock"), run_idle_worker))
+    parent.start()
+    deadline = time.monotonic() + 10
+    while not all((tmp_path / f"connected-{index}").exists() for index in range(2)) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return parent
+
+
+def _worker_pids(parent_pid: int):
+    with open(f"/proc/{parent_pid}/task/{parent_pid}/children") as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+def _wait_gone(pids, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        alive = []
+        for pid in pids:
+            try:
+                # Reaped by the parent, or re-parented and then reaped by init
+                os.kill(pid, 0)
+                with open(f"/proc/{pid}/stat") as f:
+                    if f.read().split()[2] != 'Z':
+                        alive.append(pid)
+            except (ProcessLookupError, FileNotFoundError):
+                pass
+        if not alive:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/task"), reason="needs /proc")
+def test_sigterm_stops_the_coordinator_and_the_workers(cookie_paths, tmp_path):
+    parent = _start_sharded(cookie_paths, tmp_path)
+    workers = _worker_pids(parent.pid)
+    assert len(workers) == 2
+
+    os.kill(parent.pid, signal.SIGTERM)
+    parent.join(10)
+
+    assert parent.exitcode == 0
+    assert _wait_gone(workers)
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/task"), reason="needs /proc")
+def test_workers_exit_when_the_coordinator_is_gone(cookie_paths, tmp_path):
+    parent = _start_sharded(cookie_paths, tmp_path)
+    workers = _worker_pids(parent.pid)
+    assert len(workers) == 2
+
+    os.kill(parent.pid, signal.SIGKILL)
+    parent.join(10)
+
+    assert _wait_gone(workers)
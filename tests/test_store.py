@@ -0,0 +1,30 @@
+import asyncio
+import threading
+
+from bing_chat_bot.store import SessionStore
+
+
+def test_session_is_readable_while_its_write_is_committed(tmp_path):
+    async def flush_and_read():
+        store = SessionStore(str(tmp_path / "sessions.db"))
+        committing = threading.Event()
+        release = threading.Event()
+        write = store._write
+
+        def slow_write(*args):
+            committing.set()
+            release.wait()
+            write(*args)
+
+        store._write = slow_write
+        store.save_session(1, {'turn': 1})
+        flush = asyncio.get_running_loop().create_task(store._flush())
+        await asyncio.get_running_loop().run_in_executor(None, committing.wait)
+        during_commit = store.load_session(1)
+        release.set()
+        await flush
+        after_commit = store.load_session(1)
+        await store.close()
+        return during_commit, after_commit
+
+    assert asyncio.run(flush_and_read()) == ({'turn': 1}, {'turn': 1})
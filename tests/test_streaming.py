@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from bing_chat_bot.formatter import TEXT_SPLIT_THRESHOLD, FormatterResponse, FormatterResponseType
+from bing_chat_bot.streaming import StreamingReply
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, content: str):
+        self.id = message_id
+        self.content = content
+
+
+class FakeDelivery:
+    def __init__(self):
+        self.operations = []
+        self.messages = []
+
+    async def send(self, original_message, reply=False, **params):
+        message = FakeMessage(len(self.messages), params['content'])
+        self.messages.append(message)
+        self.operations.append(("send", message.id, params['content'], reply, time.monotonic()))
+        return message
+
+    async def edit(self, message, **params):
+        message.content = params['content']
+        self.operations.append(("edit", message.id, params['content'], params.get('embed'), time.monotonic()))
+        return message
+
+    async def delete(self, message):
+        self.operations.append(("delete", message.id))
+
+
+def _words(count: int) -> str:
+    return " ".join(f"word{index}" for index in range(count))
+
+
+def test_updates_within_the_interval_are_merged_into_one_edit():
+    delivery = FakeDelivery()
+
+    async def run():
+        reply = StreamingReply(object(), delivery, edit_interval=0.1)
+        for index in range(10):
+            await reply.update(f"partial {index}")
+        await asyncio.sleep(0.02)
+        for index in range(10, 20):
+            await reply.update(f"partial {index}")
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.15)
+
+    asyncio.run(run())
+    assert [operation[:3] for operation in delivery.operations] == [("send", 0, "partial 9"), ("edit", 0, "partial 19")]
+    assert delivery.operations[1][-1] - delivery.operations[0][-1] >= 0.1
+
+
+def test_text_past_the_limit_rolls_over_to_new_messages():
+    delivery = FakeDelivery()
+    text = _words(TEXT_SPLIT_THRESHOLD // 4)
+
+    async def run():
+        reply = StreamingReply(object(), delivery, edit_interval=0)
+        await reply.update(text[:TEXT_SPLIT_THRESHOLD // 2])
+        await asyncio.sleep(0.01)
+        await reply.update(text)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    sends = [operation for operation in delivery.operations if operation[0] == "send"]
+    # Only the first message is a reply, the rest follow it
+    assert [(operation[1], operation[3]) for operation in sends] == [(0, True), (1, False)]
+    assert all(len(message.content) <= TEXT_SPLIT_THRESHOLD for message in delivery.messages)
+    assert "".join(message.content for message in delivery.messages).replace(" ", "") == text.replace(" ", "")
+
+
+def test_finish_replaces_the_partial_text():
+    delivery = FakeDelivery()
+    embed = object()
+
+    async def run():
+        reply = StreamingReply(object(), delivery, edit_interval=0)
+        await reply.update(_words(TEXT_SPLIT_THRESHOLD // 4))
+        await asyncio.sleep(0.01)
+        # A pending flush of stale text is dropped
+        await reply.update("stale")
+        return await reply.finish([FormatterResponse(FormatterResponseType.NORMAL, "The answer"),
+                                   FormatterResponse(FormatterResponseType.EMBED, embed)])
+
+    assert asyncio.run(run())
+    assert [operation[:4] for operation in delivery.operations[2:]] == [("edit", 0, "The answer", embed), ("delete", 1)]
+
+
+def test_finish_with_a_file_removes_the_streamed_messages():
+    delivery = FakeDelivery()
+
+    async def run():
+        reply = StreamingReply(object(), delivery, edit_interval=0)
+        await reply.update("partial")
+        await asyncio.sleep(0.01)
+        return await reply.finish([FormatterResponse(FormatterResponseType.LARGE_TEXT, "a" * 10000)])
+
+    assert not asyncio.run(run())
+    assert [operation[:2] for operation in delivery.operations] == [("send", 0), ("delete", 0)]
+
+
+def test_abort_removes_the_streamed_messages_and_the_pending_flush():
+    delivery = FakeDelivery()
+
+    async def run():
+        reply = StreamingReply(object(), delivery, edit_interval=0.1)
+        await reply.update("partial")
+        await asyncio.sleep(0.01)
+        await reply.update("more")
+        await reply.abort()
+        await asyncio.sleep(0.15)
+
+    asyncio.run(run())
+    assert [operation[:2] for operation in delivery.operations] == [("send", 0), ("delete", 0)]